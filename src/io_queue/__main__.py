@@ -1,11 +1,178 @@
 """Command-line interface."""
+import importlib
+import json
+import os
+import sys
+import time
+import types
+from typing import List, Tuple
+
 import click
 
 
-@click.command()
+def _import(name: str) -> types.ModuleType:
+    """Import a module of this package by its bare name.
+
+    The modules import each other by bare name, so their directory has to
+    be on the path.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    if here not in sys.path:
+        sys.path.insert(0, here)
+    return importlib.import_module(name)
+
+
+def _floats(value: str) -> List[float]:
+    """Parse a comma separated list such as ``1e3,1e4``."""
+    return [float(v) for v in value.split(",") if v]
+
+
+def _ints(value: str) -> List[int]:
+    """Parse a comma separated list of integers."""
+    return [int(float(v)) for v in value.split(",") if v]
+
+
+@click.group(invoke_without_command=True)
 @click.version_option()
-def main() -> None:
+@click.pass_context
+def main(ctx: click.Context) -> None:
     """IOQueue."""
+    if ctx.invoked_subcommand is None:
+        click.echo(ctx.get_help())
+
+
+@main.command()
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--json", "as_json", is_flag=True, help="Print machine-readable JSON.")
+def stats(path: str, as_json: bool) -> None:
+    """Show row counts per status for every queue table in PATH."""
+    info = _import("admin").stats(path)
+    if as_json:
+        click.echo(json.dumps(info, indent=2))
+        return
+    click.echo(f"{path}: {info['size_bytes'] / 2 ** 20:.1f} MiB")
+    for table, table_info in info["tables"].items():
+        by_status = ", ".join(f"{k}={v}" for (k, v) in sorted(table_info["by_status"].items()))
+        click.echo(f"  {table}: {table_info['count']} rows ({by_status})")
+
+
+@main.command()
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--interval", default=2.0, show_default=True, help="Seconds between refreshes.")
+@click.option("--iterations", default=0, help="Stop after this many refreshes (0 runs forever).")
+def top(path: str, interval: float, iterations: int) -> None:
+    """Continuously show backlog and processing rates per queue table."""
+    admin = _import("admin")
+    previous, t_previous = None, None
+    i = 0
+    while iterations <= 0 or i < iterations:
+        info = admin.stats(path)
+        now = time.time()
+        done_counts = {}
+        lines = [f"{time.strftime('%H:%M:%S')}  {path}  {info['size_bytes'] / 2 ** 20:.1f} MiB",
+                 f"{'table':<32}{'backlog':>10}{'active':>10}{'done':>12}{'done/s':>10}"]
+        for table, table_info in info["tables"].items():
+            by_status = table_info["by_status"]
+            backlog = by_status.get("inited", 0) + by_status.get("ready", 0)
+            active = by_status.get("unack", 0)
+            done = table_info["count"] - backlog - active
+            rate = 0.0
+            if previous is not None and table in previous:
+                rate = (done - previous[table]) / max(now - t_previous, 1e-9)
+            lines.append(f"{table:<32}{backlog:>10}{active:>10}{done:>12}{rate:>10.1f}")
+            done_counts[table] = done
+        previous, t_previous = done_counts, now
+        if i > 0:
+            click.clear()
+        click.echo("\n".join(lines))
+        i += 1
+        if iterations <= 0 or i < iterations:
+            time.sleep(interval)
+
+
+@main.command()
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--table", default=None, help="Only requeue this table; by default every queue but task queues."
+)
+@click.option(
+    "--status",
+    "statuses",
+    multiple=True,
+    default=["unack", "failed"],
+    show_default=True,
+    help="Statuses to move back to ready.",
+)
+@click.option("--older-than", default=0.0, help="Only rows written this many seconds ago.")
+def requeue(path: str, table: str, statuses: Tuple[str, ...], older_than: float) -> None:
+    """Move stuck or failed rows in PATH back to ready."""
+    moved = _import("admin").requeue(path, table=table, statuses=statuses, older_than=older_than)
+    for name, n in moved.items():
+        click.echo(f"{name}: requeued {n} rows")
+
+
+@main.command()
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--older-than",
+    default=None,
+    type=float,
+    help="Delete finished rows written this many seconds ago.",
+)
+@click.option("--no-vacuum", is_flag=True, help="Skip releasing free pages.")
+def compact(path: str, older_than: float, no_vacuum: bool) -> None:
+    """Apply retention to PATH and release free pages."""
+    result = _import("admin").compact(path, older_than=older_than, vacuum=not no_vacuum)
+    for name, n in result["deleted"].items():
+        click.echo(f"{name}: deleted {n} rows")
+    click.echo(f"{result['size_before']} -> {result['size_after']} bytes")
+
+
+@main.command()
+@click.option("--sizes", default="1e3,1e4", show_default=True, help="Row counts.")
+@click.option("--widths", default="4,16", show_default=True, help="Columns per row.")
+@click.option("--dims", default="0,16", show_default=True, help="Vector dimensions.")
+@click.option("--procs", default="1,2", show_default=True, help="Concurrent processes.")
+@click.option("--batch", default=1000, show_default=True, help="Rows per call.")
+@click.option("--label", default=None, help="Name stored with the results.")
+@click.option("--out", default="bench_results.json", show_default=True, help="JSON output.")
+def bench(
+    sizes: str, widths: str, dims: str, procs: str, batch: int, label: str, out: str
+) -> None:
+    """Run the benchmark suite and write the results as JSON."""
+    report = _import("benchmarks").run(
+        sizes=_floats(sizes),
+        widths=_ints(widths),
+        dims=_ints(dims),
+        procs=_ints(procs),
+        batch=batch,
+        label=label,
+        out=out,
+    )
+    for r in report["results"]:
+        params = ", ".join(f"{k}={r[k]}" for k in ("width", "dim", "procs") if k in r)
+        rate = "n/a" if r["rows_per_sec"] is None else f"{r['rows_per_sec']:.0f}"
+        click.echo(f"{r['name']:<16}{r['rows']:>10} rows {rate:>14} rows/s  {params}")
+    click.echo(f"Wrote {out}")
+
+
+@main.command()
+@click.argument("path", type=click.Path(dir_okay=False))
+@click.option(
+    "--address",
+    default="io_queue.sock",
+    show_default=True,
+    help="Unix socket path, or HOST:PORT to listen on TCP.",
+)
+@click.option("--wal", is_flag=True, help="Put PATH in WAL mode so reads never block.")
+@click.option("--max-batch", default=1000, show_default=True, help="Requests per transaction.")
+def serve(path: str, address: str, wal: bool, max_batch: int) -> None:
+    """Serve the queues of PATH to QueueClient workers."""
+    server = _import("server").QueueServer(
+        path, address, queue_kwargs={"wal": wal}, max_batch=max_batch
+    )
+    click.echo(f"Serving {path} on {address}")
+    server.serve_forever()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,202 @@
+"""
+Operational helpers behind the `io_queue` command line: inspect queue
+files, move stuck rows back to ready and reclaim disk space.
+
+Inspection opens files with read-only URI connections and reads every
+table inside one read transaction, so the numbers come from a single
+consistent snapshot and never take a write lock away from workers.
+"""
+import os
+import sqlite3
+import time
+
+from linker_state import TASK_TABLE_PREFIX
+from sqliteack_queue import AckStatus
+from sqliteack_queue import FINISHED_STATUSES
+from sqliteack_queue import SQLiteAckQueue
+
+
+STATUS_NAMES = {value: name for (name, value) in vars(AckStatus).items()
+                if not name.startswith("_")}
+
+_SQL_TABLES = "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+_SQL_BY_STATUS = "SELECT status, COUNT(*) FROM {table_name} GROUP BY status"
+_SQL_REQUEUE = """
+    UPDATE {table_name} SET status = %s
+    WHERE status IN ({statuses}) AND timestamp < ?
+""" % AckStatus.ready
+
+
+def connect_readonly(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    return sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+
+
+def queue_tables(con):
+    """ Names of tables that look like queues, i.e. have a status column.
+    """
+    tables = []
+    for (name,) in con.execute(_SQL_TABLES).fetchall():
+        columns = [row[1] for row in con.execute(f"PRAGMA table_info({name})").fetchall()]
+        if "status" in columns and "timestamp" in columns:
+            tables.append(name)
+    return tables
+
+
+def file_size(path):
+    """ Bytes used by the database file plus its WAL, if any.
+    """
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+
+def status_code(name):
+    """ Accept a status as its AckStatus name (`unack`, `ack_failed`,
+    `failed`) or its numeric value.
+    """
+    if name in STATUS_NAMES:
+        return name
+    for candidate in (name, f"ack_{name}"):
+        if hasattr(AckStatus, candidate):
+            return getattr(AckStatus, candidate)
+    raise ValueError(f"Unknown status {name}, expected one of {sorted(STATUS_NAMES.values())}")
+
+
+def stats(path):
+    """ Row counts per status for every queue table in `path`.
+    """
+    con = connect_readonly(path)
+    try:
+        # One read transaction for every table gives a consistent snapshot
+        con.execute("BEGIN")
+        tables = {}
+        for table in queue_tables(con):
+            cursor = con.execute(_SQL_BY_STATUS.format(table_name=table))
+            by_status = {STATUS_NAMES.get(str(status), str(status)): n
+                         for (status, n) in cursor.fetchall()}
+            tables[table] = {'count': sum(by_status.values()), 'by_status': by_status}
+        con.execute("COMMIT")
+    finally:
+        con.close()
+    return {'path': path, 'size_bytes': file_size(path), 'tables': tables}
+
+
+def requeue(path, table=None, statuses=(AckStatus.unack, AckStatus.ack_failed), older_than=0):
+    """ Move rows with one of `statuses` that were written more than
+    `older_than` seconds ago back to ready. Returns rows moved per table.
+    Without `table` this covers every queue table but the task queues of
+    a Linker, whose leases it manages itself.
+    """
+    codes = ",".join(status_code(s) for s in statuses)
+    con = sqlite3.connect(path)
+    try:
+        tables = [table] if table else [name for name in queue_tables(con)
+                                        if not name.startswith(TASK_TABLE_PREFIX)]
+        moved = {}
+        for name in tables:
+            query = _SQL_REQUEUE.format(table_name=name, statuses=codes)
+            moved[name] = con.execute(query, (time.time() - older_than,)).rowcount
+        con.commit()
+    finally:
+        con.close()
+    return moved
+
+
+def compact(path, older_than=None, vacuum=True):
+    """ Delete finished rows older than `older_than` seconds (skipped if
+    None) and give free pages back to the file system. The first compact
+    of a file switches it to incremental auto-vacuum, which needs one
+    full VACUUM; later ones only release free pages.
+    """
+    size_before = file_size(path)
+    con = sqlite3.connect(path)
+    deleted = {}
+    try:
+        if older_than is not None:
+            codes = ",".join(FINISHED_STATUSES)
+            for name in queue_tables(con):
+                query = SQLiteAckQueue._SQL_CLEAR_ACKED.format(table_name=name, statuses=codes)
+                deleted[name] = con.execute(query, (time.time() - older_than,)).rowcount
+            con.commit()
+        if vacuum:
+            shrink(con)
+    finally:
+        con.close()
+    return {'deleted': deleted, 'size_before': size_before, 'size_after': file_size(path)}
+
+
+def shrink(con):
+    """ Release free pages of the database open on `con`.
+    """
+    (auto_vacuum,) = con.execute("PRAGMA auto_vacuum").fetchone()
+    # 2 is INCREMENTAL; switching modes only takes effect after a VACUUM
+    if auto_vacuum != 2:
+        con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        con.execute("VACUUM")
+    else:
+        con.execute("PRAGMA incremental_vacuum")
+        con.commit()
+
+
+def test_admin(fn="test_admin.db"):
+    if os.path.exists(fn):
+        os.remove(fn)
+    q = SQLiteAckQueue(fn, table_name="adminq")
+    q.puts([{'idx': i, 'text': "x" * 1000} for i in range(100)])
+    keys, _ = q.gets(30, return_keys=True)
+    q.acks(keys[:20])
+    q.acks(keys[20:25], status=AckStatus.ack_failed)
+
+    info = stats(fn)
+    assert info['size_bytes'] > 0
+    assert info['tables']['adminq'] == {
+        'count': 100, 'by_status': {'inited': 70, 'acked': 20, 'unack': 5, 'ack_failed': 5}}
+
+    # Unack and failed rows go back to ready, task queues only by name
+    tasks = SQLiteAckQueue(fn, table_name=f"{TASK_TABLE_PREFIX}link")
+    tasks.put({'task': 0})
+    tasks.gets(1)
+    assert requeue(fn, statuses=("unack", "failed")) == {'adminq': 10}
+    assert q.free() == 80 and tasks.free() == 0
+    assert requeue(fn, table=f"{TASK_TABLE_PREFIX}link") == {f"{TASK_TABLE_PREFIX}link": 1}
+
+    # Retention drops finished rows and the file shrinks
+    result = compact(fn, older_than=0)
+    assert result['deleted']['adminq'] == 20
+    assert q.count() == 80
+    assert result['size_after'] < result['size_before']
+    (auto_vacuum,) = sqlite3.connect(fn).execute("PRAGMA auto_vacuum").fetchone()
+    assert auto_vacuum == 2
+
+    # The queue can apply the same retention to its own table
+    keys, _ = q.gets(10, return_keys=True)
+    q.acks(keys)
+    assert q.clear_acked_data() == 10
+    q.shrink_disk_usage()
+    assert q.count() == 70
+    os.remove(fn)
+
+
+def test_stats_readonly(fn="test_admin.db"):
+    if os.path.exists(fn):
+        os.remove(fn)
+    q = SQLiteAckQueue(fn, table_name="adminq")
+    q.puts([{'idx': i} for i in range(3)])
+    con = connect_readonly(fn)
+    try:
+        con.execute("DELETE FROM adminq")
+        raise RuntimeError("Expected to raise OperationalError")
+    except sqlite3.OperationalError:
+        pass
+    con.close()
+    try:
+        stats("does_not_exist.db")
+        raise RuntimeError("Expected to raise FileNotFoundError")
+    except FileNotFoundError:
+        pass
+    os.remove(fn)
+
+
+if __name__ == '__main__':
+    test_admin()
+    test_stats_readonly()
@@ -0,0 +1,70 @@
+"""
+Autoscaler decides how many long-lived workers each link should have.
+The target is driven by the link's backlog (rows ready to process), the
+throughput a single worker has been observed to sustain, and a cap on
+the number of workers. The Linker creates or retires workers in bulk to
+move toward the target rather than spawning one task per pending batch.
+"""
+import math
+
+
+class Autoscaler:
+    def __init__(self, max_workers=8, min_workers=0, drain_time=60.0, smoothing=0.3):
+        self.max_workers = max_workers
+        self.min_workers = min_workers
+        self.drain_time = drain_time
+        self.smoothing = smoothing
+        self.items_per_sec = {}
+
+    def observe(self, name, n_items, duration):
+        """ Record that one worker of link `name` processed `n_items`
+        in `duration` seconds.
+        """
+        if n_items <= 0 or duration <= 0:
+            return
+        rate = n_items / duration
+        prev = self.items_per_sec.get(name)
+        if prev is None:
+            self.items_per_sec[name] = rate
+        else:
+            a = self.smoothing
+            self.items_per_sec[name] = a * rate + (1 - a) * prev
+
+    def target(self, name, backlog, batch_size, max_workers=None):
+        """ Number of workers link `name` should have for `backlog` rows.
+        """
+        if backlog <= 0:
+            return 0
+        max_workers = max_workers or self.max_workers
+        # Never run more workers than there are batches to hand out
+        n = int(math.ceil(backlog / max(batch_size, 1)))
+        rate = self.items_per_sec.get(name)
+        if rate:
+            # Enough workers to drain the backlog in `drain_time` seconds
+            n = min(n, int(math.ceil(backlog / (rate * self.drain_time))))
+        return max(1, self.min_workers, min(n, max_workers))
+
+
+def test_autoscaler_target():
+    scaler = Autoscaler(max_workers=4, drain_time=10.0)
+    # Nothing to do, no workers
+    assert scaler.target("link", 0, 10) == 0
+    # Fewer batches than the cap
+    assert scaler.target("link", 25, 10) == 3
+    # Capped at max workers
+    assert scaler.target("link", 1000, 10) == 4
+    assert scaler.target("link", 1000, 10, max_workers=2) == 2
+
+    # A single fast worker drains 1000 rows in under 10 seconds
+    scaler.observe("link", 500, 1.0)
+    assert scaler.target("link", 1000, 10) == 1
+    # A slow worker needs help
+    scaler.observe("slow", 5, 1.0)
+    assert scaler.target("slow", 100, 10) == 2
+    # Empty batches are ignored
+    scaler.observe("empty", 0, 1.0)
+    assert "empty" not in scaler.items_per_sec
+
+
+if __name__ == '__main__':
+    test_autoscaler_target()
@@ -0,0 +1,39 @@
+"""
+Backends pair a queue class with the IOQueues class that joins two of its
+queues. Linker picks one by name so a DAG can run on SQLite files or
+entirely in memory without changing any link code.
+"""
+from dataclasses import dataclass
+from typing import Type
+
+from io_queues import IOQueues
+from memory_queue import MemoryAckQueue
+from memory_queue import MemoryIOQueues
+from sqliteack_queue import SQLiteAckQueue
+
+
+@dataclass
+class Backend:
+    queue_class: Type
+    ioqueues_class: Type
+    # Whether data written through this backend outlives the process
+    persistent: bool = True
+
+
+BACKENDS = {}
+
+
+def register_backend(name, queue_class, ioqueues_class, persistent=True):
+    BACKENDS[name] = Backend(queue_class, ioqueues_class, persistent)
+
+
+def get_backend(name):
+    if isinstance(name, Backend):
+        return name
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name}, expected one of {sorted(BACKENDS)}")
+    return BACKENDS[name]
+
+
+register_backend("sqlite", SQLiteAckQueue, IOQueues)
+register_backend("memory", MemoryAckQueue, MemoryIOQueues, persistent=False)
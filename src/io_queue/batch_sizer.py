@@ -0,0 +1,150 @@
+"""
+BatchSizer tunes how many rows a link claims per batch. It measures the
+wall time and throughput (items/s) of every batch a link processes and
+moves the batch size toward the number of items that would take
+`target_duration` seconds, staying between `min_size` and `max_size`.
+
+The chosen size is persisted in a small table so that a restarted
+pipeline begins with the last size that worked instead of the default.
+"""
+import os
+import sqlite3
+import time
+
+
+class BatchSizer:
+    _TABLE_NAME = "batch_sizes"
+    _SQL_CREATE = (
+        "CREATE TABLE IF NOT EXISTS {table_name} ("
+        "name TEXT PRIMARY KEY, batch_size INTEGER, items_per_sec REAL, "
+        "timestamp FLOAT)"
+    )
+    _SQL_SELECT = "SELECT batch_size, items_per_sec FROM {table_name} WHERE name = ?"
+    _SQL_UPSERT = (
+        "INSERT OR REPLACE INTO {table_name} "
+        "(name, batch_size, items_per_sec, timestamp) VALUES (?, ?, ?, ?)"
+    )
+
+    _con = None
+
+    def __init__(self, path, name, batch_size=1, min_size=1, max_size=10000,
+                 target_duration=10.0, smoothing=0.3, max_growth=2.0,
+                 persist_interval=5.0, table_name=None):
+        self.path = path
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_duration = target_duration
+        self.smoothing = smoothing
+        self.max_growth = max_growth
+        self.persist_interval = persist_interval
+        if table_name:
+            self._TABLE_NAME = table_name
+        self.items_per_sec = None
+        self.last_duration = None
+        self.last_persisted = 0
+        self._batch_size = self.clamp(batch_size)
+        self.con.execute(self._SQL_CREATE.format(table_name=self._TABLE_NAME))
+        self.con.commit()
+        self.load()
+
+    @property
+    def con(self):
+        if self._con is None:
+            self._con = sqlite3.connect(self.path)
+        return self._con
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    def clamp(self, size):
+        return int(max(self.min_size, min(self.max_size, size)))
+
+    def load(self):
+        """ Warm start from the last persisted batch size, if any.
+        """
+        cursor = self.con.execute(self._SQL_SELECT.format(table_name=self._TABLE_NAME),
+                                  (self.name,))
+        row = cursor.fetchone()
+        if row is not None:
+            batch_size, items_per_sec = row
+            self._batch_size = self.clamp(batch_size)
+            self.items_per_sec = items_per_sec
+
+    def persist(self):
+        query = self._SQL_UPSERT.format(table_name=self._TABLE_NAME)
+        self.con.execute(query, (self.name, self._batch_size, self.items_per_sec, time.time()))
+        self.con.commit()
+        self.last_persisted = time.time()
+
+    def observe(self, n_items, duration):
+        """ Record that a batch of `n_items` took `duration` seconds
+        and return the batch size to use next.
+        """
+        self.last_duration = duration
+        # Empty or instant batches carry no information about per-item cost
+        if n_items <= 0 or duration <= 0:
+            return self._batch_size
+        rate = n_items / duration
+        if self.items_per_sec is None:
+            self.items_per_sec = rate
+        else:
+            a = self.smoothing
+            self.items_per_sec = a * rate + (1 - a) * self.items_per_sec
+        target = self.items_per_sec * self.target_duration
+        # Limit how fast we grow or shrink so one outlier batch
+        # cannot swing the size by orders of magnitude
+        upper = self._batch_size * self.max_growth
+        lower = self._batch_size / self.max_growth
+        self._batch_size = self.clamp(max(lower, min(upper, target)))
+        if time.time() - self.last_persisted > self.persist_interval:
+            self.persist()
+        return self._batch_size
+
+
+def test_batch_sizer_converges(fn="test_batch_sizes.db"):
+    if os.path.exists(fn):
+        os.remove(fn)
+    sizer = BatchSizer(fn, "link", batch_size=10, min_size=2, max_size=1000,
+                       target_duration=1.0)
+    # 1000 items/s means ~1000 items per one second batch, but growth
+    # is limited to 2x per batch
+    assert sizer.observe(10, 0.01) == 20
+    for _ in range(20):
+        sizer.observe(sizer.batch_size, sizer.batch_size / 1000.)
+    assert sizer.batch_size == 1000
+
+    # Now items got very slow: 5 items/s shrinks the batch to the lower bound
+    for _ in range(50):
+        sizer.observe(sizer.batch_size, sizer.batch_size / 5.)
+    assert 2 <= sizer.batch_size <= 6
+
+    # Empty batches do not change the size
+    size = sizer.batch_size
+    assert sizer.observe(0, 0.5) == size
+    os.remove(fn)
+
+
+def test_batch_sizer_warm_start(fn="test_batch_sizes.db"):
+    if os.path.exists(fn):
+        os.remove(fn)
+    sizer = BatchSizer(fn, "link", batch_size=10, target_duration=1.0,
+                       persist_interval=0)
+    sizer.observe(10, 0.05)
+    assert sizer.batch_size == 20
+
+    # A new sizer for the same link starts from the persisted size
+    sizer2 = BatchSizer(fn, "link", batch_size=10, target_duration=1.0)
+    assert sizer2.batch_size == 20
+    assert sizer2.items_per_sec == sizer.items_per_sec
+
+    # Other links are not affected
+    sizer3 = BatchSizer(fn, "other", batch_size=10)
+    assert sizer3.batch_size == 10
+    os.remove(fn)
+
+
+if __name__ == '__main__':
+    test_batch_sizer_converges()
+    test_batch_sizer_warm_start()
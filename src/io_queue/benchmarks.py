@@ -0,0 +1,310 @@
+"""
+Benchmarks for the queue, IOQueues and Linker hot paths. Every case runs
+against fresh files in a scratch directory and reports rows/s; `run`
+sweeps row counts, column widths, vector dimensions and process counts
+and writes the results, with enough environment detail to tell runs
+apart, as JSON. `compare` diffs two result files to spot regressions.
+
+    python benchmarks.py                      # small default sweep
+    io_queue bench --sizes 1e3,1e6 --out results.json
+"""
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from io_queues import IOQueues
+from linker import Linker
+from sqliteack_queue import SQLiteAckQueue
+
+
+def make_items(start, n, width, dim):
+    """ Rows with `width` scalar columns and, if `dim`, one vector column.
+    """
+    items = []
+    for i in range(start, start + n):
+        item = {'id': i}
+        for c in range(width - 1):
+            item[f"c{c}"] = f"value-{i}-{c}" if c % 2 else i * 0.5
+        if dim:
+            item['vec'] = [float(i + d) for d in range(dim)]
+        items.append(item)
+    return items
+
+
+def _fill(q, n, width, dim, batch):
+    for start in range(0, n, batch):
+        q.puts(make_items(start, min(batch, n - start), width, dim))
+
+
+def _timed(fn):
+    t0 = time.perf_counter()
+    fn()
+    return time.perf_counter() - t0
+
+
+def bench_puts(workdir, n, width=4, dim=0, batch=1000):
+    q = SQLiteAckQueue(os.path.join(workdir, "puts.db"), unique_column="id")
+    return _timed(lambda: _fill(q, n, width, dim, batch))
+
+
+def bench_gets_acks(workdir, n, width=4, dim=0, batch=1000):
+    """ Time claiming every row, then time acking every row.
+    """
+    q = SQLiteAckQueue(os.path.join(workdir, "gets.db"), unique_column="id")
+    _fill(q, n, width, dim, batch)
+    claimed = []
+
+    def gets():
+        while True:
+            keys, items = q.gets(batch, return_keys=True)
+            if not keys:
+                break
+            claimed.append(keys)
+
+    def acks():
+        for keys in claimed:
+            q.acks(keys)
+
+    return _timed(gets), _timed(acks)
+
+
+def bench_sets(workdir, n, width=4, dim=0, batch=1000):
+    q = SQLiteAckQueue(os.path.join(workdir, "sets.db"), unique_column="id")
+    _fill(q, n, width, dim, batch)
+
+    def sets():
+        for start in range(0, n, batch):
+            ids = range(start, min(start + batch, n))
+            q.sets([{'id': i} for i in ids], [{'score': i * 2.0} for i in ids])
+
+    return _timed(sets)
+
+
+def bench_size_ready(workdir, n, width=4, dim=0, batch=1000, repeat=5):
+    """ Time `repeat` backlog estimates with half the inputs processed.
+    """
+    ioq = IOQueues(os.path.join(workdir, "ready.db"), input_q_name="inq",
+                   output_q_name="outq", input_q_id_column="id", output_q_id_column="id")
+    _fill(ioq.input_q, n, width, dim, batch)
+    _fill(ioq.output_q, n // 2, 1, 0, batch)
+    return _timed(lambda: [ioq.size_ready() for _ in range(repeat)]) / repeat
+
+
+def bench_array_roundtrip(workdir, n, width=1, dim=16, batch=1000):
+    """ Time writing and reading back rows with a `dim` vector column.
+    """
+    q = SQLiteAckQueue(os.path.join(workdir, "array.db"))
+
+    def roundtrip():
+        _fill(q, n, width, dim, batch)
+        while q.gets(batch):
+            pass
+
+    return _timed(roundtrip)
+
+
+def _retry_locked(call, rollback=None, patience=60.0):
+    """ `call()`, retried with jittered exponential backoff while another
+    process holds the database lock, for up to `patience` seconds. A
+    failed attempt may have left writes pending, e.g. a claim whose commit
+    was refused, so `rollback()` undoes them before the next one.
+    """
+    deadline = time.monotonic() + patience
+    delay = 0.001
+    while True:
+        try:
+            return call()
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) and "busy" not in str(e):
+                raise
+            if rollback is not None:
+                rollback()
+            if time.monotonic() > deadline:
+                raise
+        time.sleep(delay * random.uniform(0.5, 1.5))
+        delay = min(delay * 2, 0.1)
+
+
+def _drain_worker(path, batch):
+    q = SQLiteAckQueue(path, unique_column="id")
+
+    def rollback():
+        with q._locked():
+            q._con.rollback()
+
+    while True:
+        keys, _ = _retry_locked(lambda: q.gets(batch, return_keys=True), rollback)
+        if not keys:
+            return
+        _retry_locked(lambda: q.acks(keys), rollback)
+
+
+def bench_concurrent(workdir, n, width=4, dim=0, batch=1000, procs=2):
+    """ Time `procs` processes claiming and acking one shared queue.
+    """
+    path = os.path.join(workdir, f"concurrent_{procs}.db")
+    q = SQLiteAckQueue(path, unique_column="id")
+    _fill(q, n, width, dim, batch)
+    ctx = multiprocessing.get_context("fork" if sys.platform != "win32" else "spawn")
+
+    workers = []
+
+    def drain():
+        workers.extend(ctx.Process(target=_drain_worker, args=(path, batch)) for _ in range(procs))
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+    seconds = _timed(drain)
+    failed = [w.exitcode for w in workers if w.exitcode != 0]
+    if failed or q.done() != n:
+        raise RuntimeError(f"Concurrent drain of {path} incomplete: {q.done()} of {n} rows "
+                           f"acked, worker exit codes {failed}")
+    return seconds
+
+
+def bench_linker(workdir, n, width=4, dim=0, batch=1000):
+    """ Time a two link DAG end to end.
+    """
+    l = Linker(os.path.join(workdir, "dag_q.db"), os.path.join(workdir, "dag_tasks.db"))
+
+    @l.link(input_q_name="bench_in", output_q_name="bench_mid", batch_size=batch)
+    def first(items, **cfg):
+        return [{**item, 'first': 1} for item in items]
+
+    @l.link(input_q_name="bench_mid", output_q_name="bench_out", batch_size=batch)
+    def second(items, **cfg):
+        return [{'id': item['id'], 'second': 2} for item in items]
+
+    _fill(l.links['first'].ioqueues.input_q, n, width, dim, batch)
+    return _timed(l.run_until_complete)
+
+
+def environment(label=None):
+    return {
+        'label': label,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def run(sizes=(1000, 10000), widths=(4, 16), dims=(0, 16), procs=(1, 2), batch=1000,
+        out=None, label=None, workdir=None):
+    """ Run every benchmark over the grid of parameters. Returns the
+    results and writes them to `out` as JSON if given.
+    """
+    results = []
+
+    def record(name, n, seconds, **params):
+        results.append({'name': name, 'rows': n, 'seconds': seconds,
+                        'rows_per_sec': n / seconds if seconds > 0 else None, **params})
+
+    for n in sizes:
+        n = int(n)
+        for width in widths:
+            for dim in dims:
+                params = dict(width=width, dim=dim, batch=batch)
+                scratch = tempfile.mkdtemp(dir=workdir)
+                try:
+                    record('puts', n, bench_puts(scratch, n, width, dim, batch), **params)
+                    t_gets, t_acks = bench_gets_acks(scratch, n, width, dim, batch)
+                    record('gets', n, t_gets, **params)
+                    record('acks', n, t_acks, **params)
+                    record('sets', n, bench_sets(scratch, n, width, dim, batch), **params)
+                    record('size_ready', n, bench_size_ready(scratch, n, width, dim, batch),
+                           **params)
+                    record('linker', n, bench_linker(scratch, n, width, dim, batch), **params)
+                    for p in procs:
+                        record('concurrent', n, bench_concurrent(scratch, n, width, dim, batch, p),
+                               procs=p, **params)
+                finally:
+                    shutil.rmtree(scratch)
+            for dim in [d for d in dims if d]:
+                scratch = tempfile.mkdtemp(dir=workdir)
+                try:
+                    record('array_roundtrip', n, bench_array_roundtrip(scratch, n, 1, dim, batch),
+                           width=1, dim=dim, batch=batch)
+                finally:
+                    shutil.rmtree(scratch)
+    report = {'environment': environment(label), 'results': results}
+    if out:
+        with open(out, "w") as fh:
+            json.dump(report, fh, indent=2)
+    return report
+
+
+def _key(result):
+    return tuple(sorted((k, v) for (k, v) in result.items()
+                        if k not in ('seconds', 'rows_per_sec')))
+
+
+def compare(baseline, current, threshold=0.1):
+    """ Cases in `current` that are more than `threshold` slower than in
+    `baseline`, as (case, baseline rows/s, current rows/s). Both may be
+    reports or paths to JSON reports.
+    """
+    reports = []
+    for report in (baseline, current):
+        if isinstance(report, str):
+            with open(report) as fh:
+                report = json.load(fh)
+        reports.append({_key(r): r['rows_per_sec'] for r in report['results']})
+    before, after = reports
+    regressions = []
+    for key, rate in after.items():
+        old = before.get(key)
+        if old and rate and rate < old * (1 - threshold):
+            regressions.append((dict(key), old, rate))
+    return regressions
+
+
+def test_benchmarks_smoke(fn="test_bench.json"):
+    report = run(sizes=(50,), widths=(3,), dims=(0, 4), procs=(2,), batch=20, out=fn)
+    names = {r['name'] for r in report['results']}
+    assert names == {'puts', 'gets', 'acks', 'sets', 'size_ready', 'linker', 'concurrent',
+                     'array_roundtrip'}
+    assert all(r['seconds'] > 0 for r in report['results'])
+    with open(fn) as fh:
+        assert json.load(fh)['environment']['sqlite'] == sqlite3.sqlite_version
+
+    # A report never regresses against itself, but does against a faster one
+    assert compare(fn, fn) == []
+    faster = json.loads(json.dumps(report))
+    for r in faster['results']:
+        r['rows_per_sec'] *= 10
+    assert len(compare(faster, report)) == len(report['results'])
+    os.remove(fn)
+
+
+def test_retry_locked():
+    calls, rollbacks = [], []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise sqlite3.OperationalError("database is locked")
+        return "done"
+
+    assert _retry_locked(flaky, lambda: rollbacks.append(1)) == "done"
+    assert len(calls) == 3 and len(rollbacks) == 2
+    try:
+        _retry_locked(lambda: sqlite3.connect(":memory:").execute("SELECT * FROM missing"))
+    except sqlite3.OperationalError:
+        pass
+    else:
+        assert False, "errors other than a lock are not retried"
+
+
+if __name__ == '__main__':
+    run(out="bench_results.json")
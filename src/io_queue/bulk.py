@@ -0,0 +1,257 @@
+"""
+Bulk import and export between queues and Parquet, Arrow IPC or NDJSON
+files. Files are read and written one record batch at a time and rows
+go in through a single `executemany` per batch, so memory stays constant
+however large the file is. Array columns are written as fixed-size list
+columns when every row has the same length. Exports to Parquet and Arrow
+read the rows twice: a first pass settles one schema for the whole file,
+promoting types that differ between batches. NDJSON stores bytes values
+as `{"$bytes": <base64>}` objects, which are decoded again on load.
+
+Parquet and Arrow need `pyarrow`, which is imported only when used.
+"""
+import base64
+import json
+import os
+
+
+FORMATS = {
+    '.parquet': "parquet",
+    '.pq': "parquet",
+    '.arrow': "arrow",
+    '.feather': "arrow",
+    '.ipc': "arrow",
+    '.ndjson': "ndjson",
+    '.jsonl': "ndjson",
+    '.json': "ndjson",
+}
+
+
+def file_format(path, format=None):
+    if format is not None:
+        if format not in FORMATS.values():
+            raise ValueError(f"Unknown format {format}, expected one of {sorted(set(FORMATS.values()))}")
+        return format
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in FORMATS:
+        raise ValueError(f"Cannot tell the format of {path}, pass format=")
+    return FORMATS[ext]
+
+
+def read_batches(path, format=None, batch_size=65536):
+    """ Yield the rows of a file as lists of at most `batch_size` dicts.
+    """
+    format = file_format(path, format)
+    if format == "ndjson":
+        with open(path) as fh:
+            batch = []
+            for line in fh:
+                if line.strip():
+                    batch.append(json.loads(line, object_hook=_from_json))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        return
+    import pyarrow as pa
+    if format == "parquet":
+        import pyarrow.parquet as pq
+        for record_batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield record_batch.to_pylist()
+        return
+    with pa.memory_map(path) as source:
+        try:
+            reader = pa.ipc.open_file(source)
+            record_batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        except pa.ArrowInvalid:
+            source.seek(0)
+            record_batches = pa.ipc.open_stream(source)
+        for record_batch in record_batches:
+            for start in range(0, record_batch.num_rows, batch_size):
+                yield record_batch.slice(start, batch_size).to_pylist()
+
+
+def load_file(q, path, format=None, batch_size=65536):
+    """ Bulk insert every row of `path` into queue `q`, committing once
+    per batch. Returns the number of rows inserted.
+    """
+    n = 0
+    for items in read_batches(path, format, batch_size):
+        n += q.puts(items, return_keys=False)
+    return n
+
+
+def _schema(items):
+    """ Arrow schema inferred from `items`, with lists of equal length
+    turned into fixed-size lists.
+    """
+    import pyarrow as pa
+    schema = pa.RecordBatch.from_pylist(items).schema
+    fields = []
+    for field in schema:
+        if pa.types.is_list(field.type):
+            lengths = {len(item[field.name]) for item in items
+                       if item.get(field.name) is not None}
+            if len(lengths) == 1:
+                field = pa.field(field.name, pa.list_(field.type.value_type, lengths.pop()))
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def _unified_schema(batches):
+    """ One Arrow schema for all of `batches`, promoting types that
+    differ between them: nulls to the type seen later, integers to
+    floats, fixed-size lists of different lengths to lists.
+    """
+    import pyarrow as pa
+    schema = None
+    for items in batches:
+        batch_schema = _schema(items)
+        if schema is None:
+            schema = batch_schema
+        else:
+            schema = pa.unify_schemas([schema, batch_schema], promote_options="permissive")
+    return schema
+
+
+def _to_json(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"$bytes": base64.b64encode(bytes(value)).decode("ascii")}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _from_json(obj):
+    if len(obj) == 1 and "$bytes" in obj:
+        return base64.b64decode(obj["$bytes"])
+    return obj
+
+
+class _Writer:
+    def __init__(self, path, format, schema=None):
+        self.path = path
+        self.format = format
+        self.writer = None
+        self.schema = schema
+
+    def write(self, items):
+        if self.format == "ndjson":
+            if self.writer is None:
+                self.writer = open(self.path, "w")
+            self.writer.write("".join(json.dumps(item, default=_to_json) + "\n" for item in items))
+            return
+        import pyarrow as pa
+        if self.writer is None:
+            if self.schema is None:
+                self.schema = _schema(items)
+            if self.format == "parquet":
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(self.path, self.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.path, self.schema)
+        batch = pa.RecordBatch.from_pylist(items, schema=self.schema)
+        if self.format == "parquet":
+            self.writer.write_batch(batch)
+        else:
+            self.writer.write(batch)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        elif self.format == "ndjson":
+            open(self.path, "w").close()
+
+
+def dump(q, path, status=None, format=None, batch_size=65536):
+    """ Stream the rows of queue `q` to `path` without claiming them.
+    `status` may be one status or a list of them. Returns the number of
+    rows written.
+    """
+    format = file_format(path, format)
+    where, params = None, ()
+    if status is not None:
+        params = (status,) if isinstance(status, str) else tuple(status)
+        where = "status IN ({})".format(", ".join("?" for _ in params))
+    schema = None
+    if format != "ndjson":
+        # The whole file needs one schema, so settle it before writing
+        schema = _unified_schema(q.iter_batches(batch_size, where=where, params=params))
+    writer = _Writer(path, format, schema)
+    n = 0
+    try:
+        for items in q.iter_batches(batch_size, where=where, params=params):
+            writer.write(items)
+            n += len(items)
+    finally:
+        writer.close()
+    return n
+
+
+def test_bulk_roundtrip(n=1000):
+    from sqliteack_queue import AckStatus
+    from sqliteack_queue import SQLiteAckQueue
+    fn = "test_bulk.db"
+    if os.path.exists(fn):
+        os.remove(fn)
+    q = SQLiteAckQueue(fn, table_name="src", unique_column="id")
+    q.puts([{'id': f"r{i}", 'score': i * 0.5, 'vec': [i, i + 1, i + 2]} for i in range(n)])
+    keys, _ = q.gets(100, return_keys=True)
+    q.acks(keys)
+
+    formats = ["ndjson"]
+    try:
+        import pyarrow
+        formats += ["parquet", "arrow"]
+    except ImportError:
+        pass
+    for format in formats:
+        out = f"test_bulk.{format}"
+        assert q.dump(out, batch_size=300) == n
+        assert dump(q, out, status=AckStatus.acked) == 100
+        copy = SQLiteAckQueue(fn, table_name=f"copy_{format}", unique_column="id")
+        assert copy.load_file(out, batch_size=30) == 100
+        # Loading again inserts nothing thanks to the unique column
+        assert copy.load_file(out) == 0
+        rows = list(copy.iter_rows())
+        assert rows[0] == {'id': "r0", 'score': 0.0, 'vec': [0, 1, 2]}
+        os.remove(out)
+
+    if "parquet" in formats:
+        import pyarrow.parquet as pq
+        q.dump("test_bulk.parquet")
+        vec_type = pq.read_schema("test_bulk.parquet").field("vec").type
+        assert vec_type.list_size == 3
+        os.remove("test_bulk.parquet")
+    os.remove(fn)
+
+
+def test_bulk_mixed_batches():
+    from sqliteack_queue import SQLiteAckQueue
+    fn = "test_bulk.db"
+    if os.path.exists(fn):
+        os.remove(fn)
+    q = SQLiteAckQueue(fn, table_name="src")
+    # Later batches hold floats, longer vectors, a value for a column
+    # that was null so far and bytes
+    q.puts([{'id': i, 'score': i, 'note': None, 'vec': [i, i], 'raw': b"\x00\xff"} for i in range(4)])
+    q.puts([{'id': i, 'score': i + 0.5, 'note': "x", 'vec': [i, i, i], 'raw': b"\x01"} for i in range(4, 8)])
+    expected = list(q.iter_rows())
+
+    formats = ["ndjson"]
+    try:
+        import pyarrow
+        formats += ["parquet", "arrow"]
+    except ImportError:
+        pass
+    for format in formats:
+        out = f"test_bulk.{format}"
+        assert q.dump(out, batch_size=4) == 8
+        rows = [row for batch in read_batches(out) for row in batch]
+        assert rows == expected
+        os.remove(out)
+    os.remove(fn)
+
+
+if __name__ == '__main__':
+    test_bulk_roundtrip()
+    test_bulk_mixed_batches()
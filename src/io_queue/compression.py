@@ -0,0 +1,170 @@
+"""
+Transparent compression of large text and blob values. Values shorter
+than `threshold` bytes are stored as they are; larger ones are
+compressed with zlib (stdlib) or zstd (needs `zstandard`) and prefixed
+with a small header, so readers can tell compressed cells from raw ones
+and tables may freely mix both. Raw bytes values that happen to start
+with the header's magic are stored behind a short "raw" header, so they
+are never mistaken for compressed cells.
+
+Small, similar values such as HTML pages of one site compress much
+better with a preset dictionary trained on samples of them:
+
+    compressor = Compressor("zstd").train(sample_pages)
+    q = SQLiteAckQueue(path, compress=compressor)
+
+The dictionary is not stored in the queue, so keep `compressor.dictionary`
+to decompress the same rows later.
+"""
+import struct
+import zlib
+
+
+# Header: magic, method, kind of the original value, dictionary id
+MAGIC = b"\xffQ"
+_HEADER = struct.Struct("<2sccI")
+_METHODS = {'zlib': b"z", 'zstd': b"s"}
+_KINDS = {str: b"t", bytes: b"b"}
+# Escapes raw bytes values that start with MAGIC
+_RAW = MAGIC + b"r"
+
+
+def _dictionary_id(dictionary):
+    return zlib.crc32(dictionary) if dictionary else 0
+
+
+def is_compressed(value):
+    return (type(value) is bytes and len(value) >= _HEADER.size and value[:2] == MAGIC
+            and value[2:3] in _METHODS.values() and value[3:4] in _KINDS.values())
+
+
+def _raw(value):
+    """ `value` as stored uncompressed. """
+    if type(value) is bytes and value[:2] == MAGIC:
+        return _RAW + value
+    return value
+
+
+class Compressor:
+    def __init__(self, method="zlib", level=None, threshold=512, dictionary=None):
+        if method not in _METHODS:
+            raise ValueError(f"Unknown compression {method}, expected one of {sorted(_METHODS)}")
+        self.method = method
+        self.threshold = threshold
+        self.dictionary = dictionary
+        self._dict_id = _dictionary_id(dictionary)
+        if method == "zlib":
+            self.level = 6 if level is None else level
+        else:
+            import zstandard
+            self.level = 3 if level is None else level
+            zdict = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            self._zstd_c = zstandard.ZstdCompressor(level=self.level, dict_data=zdict)
+            self._zstd_d = zstandard.ZstdDecompressor(dict_data=zdict)
+
+    def train(self, samples, size=16384):
+        """ A copy of this compressor with a dictionary trained on
+        `samples` (str or bytes values like the ones to compress).
+        """
+        samples = [s.encode() if isinstance(s, str) else s for s in samples]
+        if self.method == "zstd":
+            import zstandard
+            dictionary = zstandard.train_dictionary(size, samples).as_bytes()
+        else:
+            # zlib has no trainer; its preset dictionary is just bytes
+            # likely to occur, most useful ones last
+            dictionary = b"".join(samples)[-size:]
+        return Compressor(self.method, self.level, self.threshold, dictionary)
+
+    def compress(self, value):
+        """ Compress str or bytes values of at least `threshold` bytes;
+        anything else is returned unchanged, except for bytes starting
+        with MAGIC, which are escaped.
+        """
+        kind = _KINDS.get(type(value))
+        if kind is None or len(value) < self.threshold:
+            return _raw(value)
+        data = value.encode() if kind == b"t" else value
+        if self.method == "zlib":
+            if self.dictionary:
+                c = zlib.compressobj(self.level, zdict=self.dictionary)
+                packed = c.compress(data) + c.flush()
+            else:
+                packed = zlib.compress(data, self.level)
+        else:
+            packed = self._zstd_c.compress(data)
+        header = _HEADER.pack(MAGIC, _METHODS[self.method], kind, self._dict_id)
+        if len(header) + len(packed) >= len(data):
+            # Incompressible, not worth the decode cost
+            return _raw(value)
+        return header + packed
+
+    def decompress(self, value):
+        """ Undo `compress`; values without a header, such as rows
+        written before compression was turned on, are returned unchanged.
+        """
+        if type(value) is bytes and value[:3] == _RAW:
+            return value[3:]
+        if not is_compressed(value):
+            return value
+        _, method, kind, dict_id = _HEADER.unpack_from(value)
+        if dict_id != self._dict_id:
+            raise ValueError("Value was compressed with a different dictionary")
+        packed = value[_HEADER.size:]
+        if method == b"z":
+            if self.dictionary:
+                d = zlib.decompressobj(zdict=self.dictionary)
+                data = d.decompress(packed) + d.flush()
+            else:
+                data = zlib.decompress(packed)
+        elif self.method == "zstd":
+            data = self._zstd_d.decompress(packed)
+        else:
+            raise ValueError("Value was compressed with zstd, which this compressor does not use")
+        return data.decode() if kind == b"t" else data
+
+
+def get_compressor(compress):
+    """ Accept a Compressor, a method name, True for zlib defaults or
+    None/False for no compression.
+    """
+    if compress is None or compress is False:
+        return None
+    if compress is True:
+        return Compressor()
+    if isinstance(compress, str):
+        return Compressor(compress)
+    return compress
+
+
+def test_compressor():
+    c = Compressor(threshold=100)
+    html = "<html>" + "<p>hello world</p>" * 200 + "</html>"
+    packed = c.compress(html)
+    assert is_compressed(packed) and len(packed) < len(html) // 10
+    assert c.decompress(packed) == html
+    assert c.decompress(c.compress(html.encode())) == html.encode()
+    # Small and non-text values are left alone
+    assert c.compress("short") == "short"
+    assert c.compress(12345) == 12345
+    # Raw bytes that look like a header are escaped, compressed or not
+    for raw in (MAGIC + bytes(range(40)), MAGIC + b"r", MAGIC + bytes(range(256)) * 4):
+        assert c.decompress(c.compress(raw)) == raw
+    assert c.decompress(MAGIC + b"?") == MAGIC + b"?"
+
+    # A trained dictionary helps small similar values
+    pages = [f"<html><head><title>Page {i}</title></head><body>item {i}</body></html>"
+             for i in range(200)]
+    trained = Compressor(threshold=0).train(pages, size=1024)
+    plain = Compressor(threshold=0)
+    assert len(trained.compress(pages[-1])) < len(plain.compress(pages[-1]))
+    assert trained.decompress(trained.compress(pages[0])) == pages[0]
+    try:
+        plain.decompress(trained.compress(pages[0]))
+        raise RuntimeError("Expected to raise ValueError")
+    except ValueError:
+        pass
+
+
+if __name__ == '__main__':
+    test_compressor()
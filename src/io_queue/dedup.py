@@ -0,0 +1,124 @@
+"""
+An in-memory duplicate filter for queues with a `unique_column`. Every
+value ever inserted is added to a Bloom filter, so values that are
+certainly new skip the duplicate lookup:
+
+    Bloom filter miss    certainly new, inserted
+    Bloom filter hit     checked exactly with one indexed lookup per batch
+
+Hits are never trusted on their own, since rows may have been deleted
+since, by this process, another one or `io_queue compact`. Misses still
+go through `INSERT OR IGNORE`, so rows inserted by other processes are
+deduplicated by SQLite as before. The filter is saved next to the
+database and topped up from rows added since on the next start.
+"""
+import hashlib
+import math
+import os
+import struct
+
+
+class BloomFilter:
+    def __init__(self, capacity=1_000_000, error_rate=0.01, bits=None, n_hashes=None):
+        self.n_bits = bits or max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.n_hashes = n_hashes or max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+
+    def _positions(self, value):
+        # Double hashing: k positions from one 128 bit digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        n_bits = self.n_bits
+        return [(h1 + i * h2) % n_bits for i in range(self.n_hashes)]
+
+    def add(self, value):
+        bits = self.bits
+        for pos in self._positions(value):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, value):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(value))
+
+
+class DedupFilter:
+    # Header: magic, bits, hashes, largest key covered
+    _HEADER = struct.Struct("<4sQIq")
+    _MAGIC = b"IQBF"
+
+    def __init__(self, capacity=1_000_000, error_rate=0.01):
+        self.bloom = BloomFilter(capacity, error_rate)
+        # Rows up to this key have been added to the filter
+        self.max_key = 0
+
+    def add(self, value):
+        self.bloom.add(value)
+
+    def split(self, values):
+        """ Sort `values` into (new, maybe_seen): certainly new and to be
+        checked exactly.
+        """
+        new, maybe_seen = [], []
+        for value in values:
+            if value in self.bloom:
+                maybe_seen.append(value)
+            else:
+                new.append(value)
+        return new, maybe_seen
+
+    def save(self, path):
+        bloom = self.bloom
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(self._HEADER.pack(self._MAGIC, bloom.n_bits, bloom.n_hashes, self.max_key))
+            fh.write(bloom.bits)
+        os.replace(tmp, path)
+
+    def load(self, path):
+        """ Replace the Bloom filter with the one saved at `path`. Returns
+        False if there is none or it has other dimensions.
+        """
+        if not os.path.exists(path):
+            return False
+        with open(path, "rb") as fh:
+            header = fh.read(self._HEADER.size)
+            if len(header) < self._HEADER.size:
+                return False
+            magic, n_bits, n_hashes, max_key = self._HEADER.unpack(header)
+            if (magic, n_bits, n_hashes) != (self._MAGIC, self.bloom.n_bits, self.bloom.n_hashes):
+                return False
+            bits = fh.read()
+        if len(bits) != len(self.bloom.bits):
+            return False
+        self.bloom.bits = bytearray(bits)
+        self.max_key = max_key
+        return True
+
+
+def test_bloom_filter(n=5000):
+    bloom = BloomFilter(capacity=n, error_rate=0.01)
+    for i in range(n):
+        bloom.add(f"https://example.com/{i}")
+    assert all(f"https://example.com/{i}" in bloom for i in range(n))
+    false_hits = sum(f"https://other.org/{i}" in bloom for i in range(n))
+    assert false_hits < n * 0.03
+
+
+def test_dedup_filter(fn="test_dedup.bloom"):
+    f = DedupFilter(capacity=1000)
+    for i in range(100):
+        f.add(str(i))
+    new, maybe_seen = f.split(["99", "5", "new"])
+    assert maybe_seen == ["99", "5"] and new == ["new"]
+    f.max_key = 100
+    f.save(fn)
+    g = DedupFilter(capacity=1000)
+    assert g.load(fn) and g.max_key == 100 and "5" in g.bloom
+    # A filter of another size cannot be reused
+    assert not DedupFilter(capacity=10).load(fn)
+    os.remove(fn)
+
+
+if __name__ == '__main__':
+    test_bloom_filter()
+    test_dedup_filter()
@@ -5,13 +5,26 @@ as they get places into the output queue.
 
 """
 import os
-from uuid import uuid4
-from loguru import logger
+import sqlite3
+import time
+from log import logger
 from sqliteack_queue import AckStatus
+from sqliteack_queue import FINISHED_STATUSES
 
 from sqliteack_queue import SQLiteAckQueue
 
+
+def queue_file(filename, table_name):
+    """ Database file of `table_name` when every queue gets its own file,
+    e.g. queues.db -> queues.links.db.
+    """
+    base, ext = os.path.splitext(filename)
+    return f"{base}.{table_name}{ext or '.db'}"
+
+
 class IOQueues:
+    queue_class = SQLiteAckQueue
+
     _SQL_SIZE_DELTA = """
     SELECT COUNT(*) 
     FROM {input_q_name} 
@@ -19,6 +32,8 @@ class IOQueues:
     ON {input_q_name}.{input_q_id_column}={output_q_name}.{output_q_id_column}
     WHERE {output_q_name}.{output_q_id_column} IS NULL
      AND {input_q_name}.status < %s
+     AND {input_q_name}._id > {watermark}
+     {skip_filter}
     """ % (AckStatus.unack)
 
     _SQL_GETS = """
@@ -28,20 +43,155 @@ class IOQueues:
     ON {input_q_name}.{input_q_id_column}={output_q_name}.{output_q_id_column}
     WHERE {output_q_name}.{output_q_id_column} IS NULL
      AND {input_q_name}.status < %s
+     AND {input_q_name}._id > {watermark}
+     {skip_filter}
+     {group_filter}
+     {order_by}
      LIMIT {batch_size}
     """ % (AckStatus.unack)
 
+    # The group of the first ready input
+    _SQL_NEXT_GROUP = """
+    SELECT {input_q_name}.{group_column}
+    FROM {input_q_name}
+    LEFT JOIN {output_q_name}
+    ON {input_q_name}.{input_q_id_column}={output_q_name}.{output_q_id_column}
+    WHERE {output_q_name}.{output_q_id_column} IS NULL
+     AND {input_q_name}.status < %s
+     AND {input_q_name}._id > {watermark}
+     {skip_filter}
+     {order_by}
+     LIMIT 1
+    """ % (AckStatus.unack)
+
+    # The first group below its cap, ordered by each group's first ready
+    # input; see SQLiteAckQueue._SQL_NEXT_GROUP_UNDER_CAP
+    _SQL_NEXT_GROUP_UNDER_CAP = """
+    SELECT waiting.{group_column}
+    FROM (SELECT {input_q_name}.{group_column}, {first}
+          FROM {input_q_name}
+          LEFT JOIN {output_q_name}
+          ON {input_q_name}.{input_q_id_column}={output_q_name}.{output_q_id_column}
+          WHERE {output_q_name}.{output_q_id_column} IS NULL
+           AND {input_q_name}.status < %s
+           AND {input_q_name}._id > {watermark}
+           {skip_filter}
+          GROUP BY {input_q_name}.{group_column}) AS waiting
+    LEFT JOIN ({active}) AS active
+    ON active.{group_column} IS waiting.{group_column}
+    WHERE IFNULL(active.n, 0) < {group_limit}
+    ORDER BY {first_order}
+    LIMIT 1
+    """ % (AckStatus.unack)
+
+    # Inputs whose value is already in the skip queue are never claimed
+    _SQL_IN_SKIP_Q = """EXISTS (SELECT 1 FROM {skip_table}
+                     WHERE {skip_table}.{skip_column}={input_q_name}.{skip_column})"""
+    _SQL_SKIP_FILTER = "AND NOT " + _SQL_IN_SKIP_Q
+    _SQL_HAS_OUTPUT = """EXISTS (SELECT 1 FROM {output_q_name}
+                     WHERE {output_q_name}.{key_column}={input_q_name}.{key_column})"""
+    # Skipped inputs are done, so that they do not hold back the watermark
+    _SQL_DONE_SKIPPED = """
+    UPDATE {input_q_name} SET status = %s
+    WHERE status < %s AND _id > {watermark} {upto}
+     AND ({skipped})
+    """ % (AckStatus.ack_done, AckStatus.unack)
+    _SQL_PRESENT = "SELECT DISTINCT {column} FROM {table_name} WHERE {column} IN ({params})"
+    _SQL_SAMPLE = "SELECT {column} FROM {table_name} WHERE {column} IS NOT NULL LIMIT 1"
+
+    # Only inputs that are still waiting or checked out may be completed,
+    # so a batch whose lease was lost and finished elsewhere is rejected
+    _SQL_COMPLETE_INPUTS = """
+    UPDATE {input_q_name} SET status = %s
+    WHERE _id IN ({indices}) AND status < %s
+    """ % (AckStatus.ack_done, AckStatus.acked)
+
+    _SQL_TASK_HEARTBEAT = """
+    UPDATE {task_table} SET timestamp = ? WHERE _id = ?
+    """
+
+    # A rowid range scan that stops at the first input not yet done.
+    # Failed inputs are not done: they may be requeued
+    _SQL_FIRST_PENDING = """
+    SELECT _id FROM {input_q_name} WHERE _id > ? AND status NOT IN (%s)
+    ORDER BY _id LIMIT 1
+    """ % ",".join(FINISHED_STATUSES)
+    _SQL_MAX_KEY = "SELECT MAX(_id) FROM {input_q_name}"
+    _SQL_RELEASE_CLAIMED = """
+    UPDATE {input_q_name} SET status = %s WHERE status = %s
+    """ % (AckStatus.ready, AckStatus.unack)
+
     def __init__(self, filename, input_q_name=None, output_q_name=None, 
                  input_q_id_column=None,
                  output_q_id_column=None,
                  batch_size=1, name=None,
-                 queue_kwargs={}):
+                 queue_kwargs={}, split_files=False,
+                 group_column=None, group_limit=None,
+                 skip_if_present=None, skip_if_key_present=None):
         self.filename = filename
         self.input_q_name = input_q_name
         self.output_q_name = output_q_name
-        self.input_q = SQLiteAckQueue(filename, table_name=input_q_name, **queue_kwargs) if input_q_name else None
-        self.output_q = SQLiteAckQueue(filename, table_name=output_q_name, **queue_kwargs) if output_q_name else None
+        self.split_files = split_files
+        # Table name of the output queue as seen from the input queue
+        self._output_table = output_q_name
+        # Batches of the input queue hold inputs of one group only
+        input_kwargs = queue_kwargs
+        if group_column:
+            input_kwargs = dict(queue_kwargs, group_column=group_column, group_limit=group_limit)
+        if split_files:
+            # Every queue table lives in its own file so that stages do
+            # not share a write lock; the input queue attaches the output
+            # file for the anti-join
+            self.output_q = self.queue_class(queue_file(filename, output_q_name),
+                                             table_name=output_q_name,
+                                             **queue_kwargs) if output_q_name else None
+            self.input_q = self.queue_class(queue_file(filename, input_q_name),
+                                            table_name=input_q_name,
+                                            **input_kwargs) if input_q_name else None
+            if self.input_q is not None and self.output_q is not None:
+                schema = self.input_q.attach(self.output_q.path)
+                self._output_table = f"{schema}.{output_q_name}"
+        else:
+            self.input_q = self.queue_class(filename, table_name=input_q_name, **input_kwargs) if input_q_name else None
+            # Share the input queue's connection so that outputs and input
+            # acks can be committed in one transaction
+            self.output_q = self.queue_class(filename, table_name=output_q_name, share_with=self.input_q,
+                                             **queue_kwargs) if output_q_name else None
+        # Inputs and outputs are matched by this key, so inputs whose key
+        # an earlier run already wrote are neither loaded nor claimed
+        self.skip_key_column = None
+        if skip_if_key_present:
+            if isinstance(skip_if_key_present, str):
+                skip_if_key_present = [skip_if_key_present]
+            if len(skip_if_key_present) != 1:
+                raise ValueError("skip_if_key_present takes the one key column shared "
+                                 "by input and output rows")
+            self.skip_key_column = skip_if_key_present[0]
+            for id_column in (input_q_id_column, output_q_id_column):
+                if id_column and id_column != self.skip_key_column:
+                    raise ValueError(f"skip_if_key_present matches inputs and outputs by "
+                                     f"{self.skip_key_column!r}, not {id_column!r}")
+            input_q_id_column = output_q_id_column = self.skip_key_column
+        # Rows whose `skip_column` value is in the skip queue are not
+        # loaded, claimed or, for links without inputs, written
+        self.skip_q = None
+        self.skip_column = None
+        self._skip_table = None
+        if skip_if_present:
+            skip_q_name, self.skip_column = skip_if_present
+            q = self.input_q or self.output_q
+            if split_files:
+                self.skip_q = self.queue_class(queue_file(filename, skip_q_name),
+                                               table_name=skip_q_name, **queue_kwargs)
+                self._skip_table = f"{q.attach(self.skip_q.path)}.{skip_q_name}"
+            else:
+                self.skip_q = self.queue_class(filename, table_name=skip_q_name, share_with=q,
+                                               **queue_kwargs)
+                self._skip_table = skip_q_name
+        self._indexed = set()
         self.batch_size = batch_size 
+        # Every input with a key up to the watermark is done
+        self.watermark = 0
         self.input_q_id_column = input_q_id_column or "_id"
         self.output_q_id_column = output_q_id_column or "_id"
         self.name = name
@@ -50,59 +200,336 @@ class IOQueues:
         self.input_q.acks(keys)
     
     def load(self, rows):
-        """ Place data rows in the output queue.
+        """ Place data rows in the input queue, except those already
+        processed. Returns the keys of the rows placed.
         """
-        self.input_q.puts(rows)
+        return self.input_q.puts(self._todo(rows, self.skip_key_column))
 
     def puts(self, rows):
         """ Place data rows in the output queue.
         """
+        if self.input_q is None:
+            rows = self._todo(rows)
         self.output_q.puts(rows)
 
+    def _todo(self, rows, key_column=None):
+        """ `rows` without those whose skip column value is in the skip
+        queue and, with `key_column`, those whose key is already in the
+        output queue. Both are looked up in bulk through an index.
+        """
+        if self.skip_q is not None and rows:
+            present = self._present(self.skip_q, self._skip_table, self.skip_column,
+                                    [row.get(self.skip_column) for row in rows])
+            rows = [row for row in rows if row.get(self.skip_column) not in present]
+        if key_column is not None and self.output_q is not None and rows:
+            present = self._present(self.output_q, self._output_table, key_column,
+                                    [row.get(key_column) for row in rows])
+            rows = [row for row in rows if row.get(key_column) not in present]
+        return rows
+
+    def _present(self, q, table, column, values):
+        """ Those of `values` found in `column` of the table of `q`, which
+        is `table` as seen from the input queue's connection.
+        """
+        values = list({v for v in values if v is not None})
+        if not values or not self._has_column(q, column):
+            return set()
+        self._index(q, column)
+        reader = self.input_q or self.output_q
+        present = set()
+        # Stay below SQLite's limit on query parameters
+        for i in range(0, len(values), 500):
+            chunk = values[i:i + 500]
+            query = self._SQL_PRESENT.format(table_name=table, column=column,
+                                             params=",".join("?" * len(chunk)))
+            present.update(v for (v,) in reader._read(query, chunk))
+        return present
+
+    def _has_column(self, q, column):
+        """ Whether the table of `q` has `column`, which another queue
+        object on the same table may have added since `q` read its schema.
+        """
+        if column not in q.columns:
+            q._ensure_table()
+            q.columns = q.read_columns()
+        return column in q.columns
+
+    def _index(self, q, column):
+        if (q._TABLE_NAME, column) not in self._indexed:
+            with q._locked():
+                q.create_index(column)
+            self._indexed.add((q._TABLE_NAME, column))
+
+    def _prepare_output(self):
+        """ Create the output table, with the key column the ready joins
+        probe it by and its index, before they read it. Returns False
+        while no input has a key yet.
+        """
+        if self.output_q is None:
+            return True
+        self.output_q._ensure_table()
+        column = self.skip_key_column
+        if not column:
+            return True
+        if not self._has_column(self.input_q, column):
+            return False
+        if not self._has_column(self.output_q, column):
+            # Type the column like the keys it will hold
+            rows = self.input_q._read(self._SQL_SAMPLE.format(table_name=self.input_q_name,
+                                                              column=column))
+            with self.output_q._locked():
+                self.output_q.create_column(column, rows[0][0] if rows else None)
+                self.output_q.flush()
+        self._index(self.output_q, column)
+        return True
+
+    def _skip_filter(self):
+        column = self.skip_column
+        if self.skip_q is None or self.input_q is None:
+            return ""
+        if not (self._has_column(self.input_q, column) and self._has_column(self.skip_q, column)):
+            return ""
+        self._index(self.skip_q, column)
+        return self._SQL_SKIP_FILTER.format(skip_table=self._skip_table, skip_column=column,
+                                            input_q_name=self.input_q_name)
+
+    def complete(self, input_keys, output_rows, tasks=None, task_key=None):
+        """ Write `output_rows`, mark `input_keys` as done and record
+        progress on the task row `task_key` of `tasks` in one commit.
+
+        Inputs may fan out to any number of output rows. Returns False
+        and writes nothing if any input was already completed, e.g. by
+        another worker after this batch's lease timed out.
+        """
+        q = self.input_q or self.output_q
+        with q._locked():
+            if tasks is not None and task_key is not None:
+                # Attaching commits, so it must come before the batch
+                self._task_table(q, tasks)
+            if self.split_files and self.output_q is not None and q.con.in_transaction:
+                # The pending write-behind transaction may have read the
+                # attached output file, which keeps its writer out
+                q.flush()
+            done = self._complete(input_keys, output_rows, tasks, task_key)
+            q._commit(len(input_keys) + len(output_rows) if done else 0)
+        return done
+
+    def _complete(self, input_keys, output_rows, tasks=None, task_key=None):
+        """ `complete` without committing, for callers that hold the
+        queue lock and commit themselves.
+        """
+        if self.input_q is None:
+            output_rows = self._todo(output_rows)
+        q = self.input_q or self.output_q
+        con = q.con
+        task_table = None
+        if tasks is not None and task_key is not None:
+            task_table = self._task_table(q, tasks)
+        # A savepoint lets us undo just this batch even when the
+        # write-behind buffer holds other callers' pending writes
+        if not con.in_transaction:
+            con.execute("BEGIN")
+        con.execute("SAVEPOINT complete")
+        try:
+            if self.input_q is not None and len(input_keys) > 0:
+                keys = set(input_keys)
+                query = self._SQL_COMPLETE_INPUTS.format(
+                    input_q_name=self.input_q_name,
+                    indices=",".join(str(k) for k in keys),
+                )
+                cursor = con.execute(query)
+                if cursor.rowcount != len(keys):
+                    con.execute("ROLLBACK TO complete")
+                    con.execute("RELEASE complete")
+                    return False
+            if self.output_q is not None and len(output_rows) > 0:
+                if self.split_files and self.input_q is not None:
+                    # Outputs live in another file and commit first;
+                    # if we die before the inputs are acked they are
+                    # retried after the timeout (at least once)
+                    self.output_q.puts(output_rows)
+                    self.output_q.flush()
+                else:
+                    self.output_q._puts(output_rows)
+            if task_table is not None:
+                con.execute(self._SQL_TASK_HEARTBEAT.format(task_table=task_table),
+                            (time.time(), task_key))
+        except BaseException:
+            con.execute("ROLLBACK TO complete")
+            con.execute("RELEASE complete")
+            raise
+        con.execute("RELEASE complete")
+        if self.input_q is not None:
+            self.input_q._m_acks.inc(len(set(input_keys)))
+        return True
+
+    def _task_table(self, q, tasks):
+        """ Name of the `tasks` table as seen from the connection of
+        `q`, attaching its database file if it lives elsewhere.
+        """
+        return f"{q.attach(tasks.path)}.{tasks._TABLE_NAME}"
+
     def gets(self, batch_size=None, return_keys=False):
         """ Get an interator over batches from the input queue
         that are not in the output q.
         """
-        if batch_size is None:
-            batch_size = self.batch_size
         if self.input_q is None:
             return None
-        query = self._SQL_GETS.format(
+        keys, items = [], []
+        if self._prepare_output():
+            with self.input_q._locked():
+                keys, items = self._gets(batch_size)
+                self.input_q._commit(len(keys))
+        if return_keys:
+            return keys, items
+        else:
+            return items
+
+    def _gets(self, batch_size=None):
+        """ `gets` without committing, returning (keys, items). The
+        output queue must have been prepared.
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+        t0 = time.perf_counter()
+        group_column = self.input_q.group_column
+        if group_column and group_column in self.input_q.columns:
+            group, batch_size = self._next_group(batch_size)
+            if batch_size == 0:
+                return [], []
+            query = self._format_gets(batch_size, group_filter=f"AND {self.input_q_name}.{group_column} IS ?")
+            cursor = self.input_q.con.execute(query, (group,))
+        else:
+            cursor = self.input_q.con.execute(self._format_gets(batch_size))
+        rows = cursor.fetchall()
+        keys = [row[0] for row in rows]
+        columns = list(map(lambda x: x[0], cursor.description))
+        items = self.input_q._items_from_rows(columns, rows)
+        self.input_q._updates(keys, AckStatus.unack)
+        # A full batch only passed over the inputs below its last key
+        self._done_skipped(max(keys) if keys and len(keys) >= batch_size else None)
+        self.input_q._m_claims.inc(len(keys))
+        self.input_q._m_claim_seconds.observe(time.perf_counter() - t0)
+        return keys, items
+
+    def _done_skipped(self, upto=None):
+        """ Mark the ready inputs, up to key `upto`, that claims pass over
+        because they are skipped as done. Returns their number.
+        """
+        skipped = []
+        if self._skip_filter():
+            skipped.append(self._SQL_IN_SKIP_Q.format(skip_table=self._skip_table,
+                                                      skip_column=self.skip_column,
+                                                      input_q_name=self.input_q_name))
+        if self.skip_key_column and self.output_q is not None:
+            skipped.append(self._SQL_HAS_OUTPUT.format(output_q_name=self._output_table,
+                                                       key_column=self.skip_key_column,
+                                                       input_q_name=self.input_q_name))
+        if not skipped:
+            return 0
+        query = self._SQL_DONE_SKIPPED.format(
             input_q_name=self.input_q_name,
-            output_q_name=self.output_q_name,
+            watermark=int(self.watermark),
+            upto=f"AND _id <= {int(upto)}" if upto is not None else "",
+            skipped=" OR ".join(skipped),
+        )
+        return self.input_q.con.execute(query).rowcount
+
+    def _next_group(self, batch_size):
+        """ The group to claim from next and how many of its inputs may
+        be claimed, (None, 0) when no group has ready inputs under its cap.
+        """
+        q = self.input_q
+        fmt = dict(table_name=self.input_q_name, group_column=q.group_column)
+        query_fmt = dict(
+            skip_filter=self._skip_filter(),
+            input_q_name=self.input_q_name,
+            output_q_name=self._output_table,
             input_q_id_column=self.input_q_id_column,
             output_q_id_column=self.output_q_id_column,
-            batch_size=batch_size
+            group_column=q.group_column,
+            watermark=int(self.watermark),
         )
-        cursor = self.input_q.con.execute(query)
-        rows = cursor.fetchall()
-        keys = [row[0] for row in rows]
-        columns = list(map(lambda x: x[0], cursor.description))
-        items = [{c: v for (c, v) in zip(columns, row) if c not in ['_id', 'timestamp', 'status']}
-                 for row in rows]
-        items = self.input_q.unflatten_array_columns(items)
-        self.input_q.updates(keys, AckStatus.unack)
-        if return_keys:
-            return keys, items
+        if q.group_limit:
+            first, first_order = q._group_first(self.input_q_name)
+            query = self._SQL_NEXT_GROUP_UNDER_CAP.format(
+                first=first, first_order=first_order, group_limit=int(q.group_limit),
+                active=q._SQL_GROUP_ACTIVE_COUNTS.format(**fmt), **query_fmt)
         else:
-            return items
+            query = self._SQL_NEXT_GROUP.format(
+                order_by=self._order_by() or f"ORDER BY {self.input_q_name}._id", **query_fmt)
+        found = q.con.execute(query).fetchall()
+        if not found:
+            return None, 0
+        (group,), = found
+        if q.group_limit:
+            ((active,),) = q.con.execute(q._SQL_GROUP_ACTIVE.format(**fmt), (group,)).fetchall()
+            batch_size = max(0, min(batch_size, int(q.group_limit) - active))
+        return group, batch_size
+
+    def _order_by(self):
+        if self.input_q.priorities:
+            return f"ORDER BY {self.input_q_name}._rank DESC, {self.input_q_name}._id ASC"
+        return ""
+
+    def _format_gets(self, batch_size, group_filter=""):
+        return self._SQL_GETS.format(
+            order_by=self._order_by(),
+            skip_filter=self._skip_filter(),
+            group_filter=group_filter,
+            input_q_name=self.input_q_name,
+            output_q_name=self._output_table,
+            input_q_id_column=self.input_q_id_column,
+            output_q_id_column=self.output_q_id_column,
+            watermark=int(self.watermark),
+            batch_size=batch_size
+        )
 
     def size_ready(self):
         """ Estimate how many rows are in input q that are not 
         in the output q and also not in submitted and ongoing jobs.
         """
-        if self.input_q is None:
+        if self.input_q is None or not self._prepare_output():
             return 0
         query = self._SQL_SIZE_DELTA.format(
             input_q_name=self.input_q_name,
-            output_q_name=self.output_q_name,
+            output_q_name=self._output_table,
             input_q_id_column=self.input_q_id_column,
-            output_q_id_column=self.output_q_id_column
+            output_q_id_column=self.output_q_id_column,
+            watermark=int(self.watermark),
+            skip_filter=self._skip_filter(),
             )
-        cursor = self.input_q.con.execute(query)
-        (n,) = cursor.fetchone()
+        ((n,),) = self.input_q._read(query)
         return n
 
+    def advance_watermark(self, full_scan=False):
+        """ Move the watermark up to just below the first input that is
+        not done yet and return it. This only reads the rows finished
+        since the last call, unless `full_scan` starts over from 0, e.g.
+        after rows were requeued by hand.
+        """
+        if self.input_q is None:
+            return self.watermark
+        start = 0 if full_scan else self.watermark
+        rows = self.input_q._read(self._SQL_FIRST_PENDING.format(input_q_name=self.input_q_name),
+                                  (start,))
+        if rows:
+            self.watermark = rows[0][0] - 1
+        else:
+            ((max_key,),) = self.input_q._read(self._SQL_MAX_KEY.format(input_q_name=self.input_q_name))
+            self.watermark = max_key or 0
+        return self.watermark
+
+    def release_claimed(self):
+        """ Make every checked out input ready again right away, for use
+        when no worker can still be holding them. Returns their number.
+        """
+        q = self.input_q
+        with q._locked():
+            cursor = q.con.execute(self._SQL_RELEASE_CLAIMED.format(input_q_name=self.input_q_name))
+            q._commit(cursor.rowcount)
+        return cursor.rowcount
+
 
 def test_ioq_puts(n=25):
     fn = 'test_cache'
@@ -134,6 +561,18 @@ def test_ioq_gets(n=25):
     os.remove('./test_cache')
 
 
+def test_ioq_priorities(n=25):
+    fn = 'test_cache'
+    if os.path.exists(fn):
+        os.remove(fn)
+    ioq = IOQueues("./test_cache", input_q_name="test_inputq", output_q_name="test_outputq",
+                   queue_kwargs=dict(priorities=True))
+    ioq.load([dict(idx=idx) for idx in range(n)])
+    ioq.input_q.puts([dict(idx=-1)], priority=5)
+    assert ioq.gets(2) == [dict(idx=-1), dict(idx=0)]
+    os.remove('./test_cache')
+
+
 def test_ioq_end_to_end(n=25):
     import time
     fn = 'test_cache'
@@ -203,8 +642,148 @@ def test_ioq_e2e_join(n=25):
     os.remove('./test_cache')
 
 
+def test_ioq_complete(n=25):
+    fn = 'test_cache'
+    for f in [fn, 'test_tasks']:
+        if os.path.exists(f):
+            os.remove(f)
+
+    ioq = IOQueues(fn, input_q_name="test_inputq", output_q_name="test_outputq")
+    tasks = SQLiteAckQueue('test_tasks', table_name="tasks_test")
+    task_key = tasks.put({'task_index': 0})
+    ioq.load([dict(idx=idx) for idx in range(n)])
+
+    # Each input fans out to two outputs
+    keys, batch = ioq.gets(10, return_keys=True)
+    outputs = [{'idx': item['idx'], 'copy': c} for item in batch for c in range(2)]
+    assert ioq.complete(keys, outputs, tasks=tasks, task_key=task_key)
+    assert ioq.output_q.count() == 20
+    assert ioq.input_q.done() == 10
+    assert ioq.input_q.free() == n - 10
+    # The task heartbeat was written through the attached tasks file
+    (ts,) = tasks.con.execute("SELECT timestamp FROM tasks_test").fetchone()
+    assert ts > time.time() - 5
+
+    # Completing the same inputs again is rejected and writes nothing
+    assert not ioq.complete(keys, outputs)
+    assert ioq.output_q.count() == 20
+    os.remove(fn)
+    os.remove('test_tasks')
+
+
+def test_ioq_watermark(n=10):
+    from admin import requeue
+    fn = 'test_cache'
+    if os.path.exists(fn):
+        os.remove(fn)
+    ioq = IOQueues(fn, input_q_name="test_inputq", output_q_name="test_outputq")
+    ioq.load([dict(idx=idx) for idx in range(n)])
+    keys, batch = ioq.gets(n, return_keys=True)
+    assert ioq.complete(keys[:5], batch[:5])
+    ioq.input_q.acks(keys[5:], status=AckStatus.ack_failed)
+    # Failed inputs hold the watermark back, so they are claimed again
+    # once requeued
+    assert ioq.advance_watermark() == keys[5] - 1
+    requeue(fn, "test_inputq")
+    assert ioq.size_ready() == n - 5
+    assert [item['idx'] for item in ioq.gets(n)] == list(range(5, n))
+    os.remove(fn)
+
+
+def test_ioq_skip_done(n=10):
+    from memory_queue import MemoryIOQueues, drop_stores
+    fn = 'test_cache'
+    if os.path.exists(fn):
+        os.remove(fn)
+    for ioq_class in (IOQueues, MemoryIOQueues):
+        ioq = ioq_class(fn, input_q_name="urls", output_q_name="pages",
+                        skip_if_key_present="url", skip_if_present=("blocked", "url"))
+        ioq.skip_q.puts([dict(url="1")])
+        ioq.output_q.puts([dict(url="0"), dict(url="2")])
+        # Inputs put by an upstream stage are only filtered when claimed,
+        # which marks the skipped ones done
+        ioq.input_q.puts([dict(url=str(idx)) for idx in range(n)])
+        keys, batch = ioq.gets(n, return_keys=True)
+        assert [item['url'] for item in batch] == [str(idx) for idx in range(3, n)]
+        assert ioq.complete(keys, batch)
+        assert ioq.input_q.done() == n
+        if ioq_class is IOQueues:
+            assert ioq.advance_watermark() == n
+        ioq.input_q.close()
+        try:
+            ioq_class(fn, input_q_name="urls", output_q_name="pages",
+                      input_q_id_column="id", skip_if_key_present="url")
+        except ValueError:
+            pass
+        else:
+            assert False, "conflicting id columns are rejected"
+    drop_stores(fn)
+    os.remove(fn)
+
+
+def test_ioq_split_files(n=25):
+    fn = 'test_split.db'
+    ioq = IOQueues(fn, input_q_name="inq", output_q_name="outq",
+                   input_q_id_column="idx", output_q_id_column="idx", split_files=True)
+    assert ioq.input_q.path == 'test_split.inq.db'
+    assert ioq.output_q.path == 'test_split.outq.db'
+    ioq.load([dict(idx=idx) for idx in range(n)])
+    ioq.output_q.puts([dict(idx=idx) for idx in range(5)])
+    # The anti-join sees the output queue through the attached file
+    assert ioq.size_ready() == n - 5
+
+    keys, batch = ioq.gets(10, return_keys=True)
+    assert all(item['idx'] >= 5 for item in batch)
+    assert ioq.complete(keys, batch)
+    assert ioq.output_q.count() == 15
+    assert ioq.input_q.done() == 10
+    assert ioq.size_ready() == n - 15
+    assert not os.path.exists(fn)
+    os.remove(ioq.input_q.path)
+    os.remove(ioq.output_q.path)
+
+    # With write-behind the outputs are on disk before the input acks
+    ioq = IOQueues(fn, input_q_name="inq", output_q_name="outq", split_files=True,
+                   queue_kwargs=dict(write_behind=True, flush_interval=60))
+    ioq.load([dict(idx=idx) for idx in range(n)])
+    keys, batch = ioq.gets(10, return_keys=True)
+    assert ioq.complete(keys, batch)
+    con = sqlite3.connect(ioq.output_q.path)
+    assert con.execute("SELECT COUNT(*) FROM outq").fetchone() == (10,)
+    con.close()
+    ioq.input_q.flush()
+    os.remove(ioq.input_q.path)
+    os.remove(ioq.output_q.path)
+
+
+def test_ioq_groups(n=5):
+    from memory_queue import MemoryIOQueues
+    fn = 'test_cache'
+    if os.path.exists(fn):
+        os.remove(fn)
+    for ioq_class in (IOQueues, MemoryIOQueues):
+        ioq = ioq_class("./test_cache", input_q_name="urls", output_q_name="pages",
+                        input_q_id_column="url", output_q_id_column="url",
+                        group_column="host", group_limit=2)
+        ioq.load([dict(url=f"{host}/{i}", host=host) for host in "ab" for i in range(n)])
+        ioq.output_q.puts([dict(url="a/0"), dict(url="a/1")])
+        # Inputs already in the output queue are skipped, the cap counts
+        # checked out inputs of the group
+        keys, batch = ioq.gets(10, return_keys=True)
+        assert [item['url'] for item in batch] == ["a/2", "a/3"]
+        assert [item['host'] for item in ioq.gets(10)] == ["b", "b"]
+        assert ioq.gets(10) == []
+        ioq.complete(keys, batch)
+        assert [item['url'] for item in ioq.gets(10)] == ["a/4"]
+    os.remove('./test_cache')
+
+
 if __name__ == '__main__':
     test_ioq_puts()
     test_ioq_gets()
     test_ioq_end_to_end()
-    test_ioq_e2e_join()
\ No newline at end of file
+    test_ioq_e2e_join()
+    test_ioq_complete()
+    test_ioq_watermark()
+    test_ioq_skip_done()
+    test_ioq_priorities()
\ No newline at end of file
@@ -1,11 +1,22 @@
-import math
 import os.path
+import time
 from dataclasses import dataclass
+from itertools import islice
 from typing import Callable
+from typing import Optional
 
-from loguru import logger
+from log import logger
 
+from autoscaler import Autoscaler
+from backends import get_backend
+from batch_sizer import BatchSizer
 from io_queues import IOQueues
+from io_queues import queue_file
+from linker_state import TASK_TABLE_PREFIX
+from linker_state import TOPOLOGY
+from linker_state import LinkerState
+from metrics import REGISTRY
+from metrics import write_textfile
 from sqliteack_queue import AckStatus
 from sqliteack_queue import SQLiteAckQueue
 
@@ -29,54 +40,232 @@ class Link:
     ioqueues: IOQueues
     function: Callable
     tasks: SQLiteAckQueue
+    batch_sizer: Optional[BatchSizer] = None
+    max_workers: Optional[int] = None
+    # The decorated function itself, for runners that hand it batches
+    inner_function: Optional[Callable] = None
+
+    @property
+    def batch_size(self):
+        if self.batch_sizer is not None:
+            return self.batch_sizer.batch_size
+        return self.ioqueues.batch_size
 
     def set_inputs(self, rows):
-        return self.ioqueues.input_q.puts(rows)
+        return self.ioqueues.load(rows)
     
     def get_outputs(self, n):
-        return self.ioqueues.output_q.gets(n)
+        """ The first `n` output rows, read without claiming them. """
+        return list(islice(self.iter_rows(batch_size=n), n))
 
+    def iter_batches(self, batch_size=1000, **kwargs):
+        """ Stream the output queue in pages without claiming rows; see
+        `SQLiteAckQueue.iter_batches`.
+        """
+        return self.ioqueues.output_q.iter_batches(batch_size, **kwargs)
+
+    def iter_rows(self, batch_size=1000, **kwargs):
+        return self.ioqueues.output_q.iter_rows(batch_size, **kwargs)
 
-class Linker:
-    links = {}
-    _task_count = {}
 
-    def __init__(self, fn_q="queues.db", fn_tasks="tasks.db", submit_func=submit_func_default):
+class Linker:
+    # Tasks that have not finished or failed, and those of them whose
+    # lease ran out without a heartbeat
+    _SQL_LIVE_TASKS = "SELECT COUNT(*) FROM {table_name} WHERE status < %s" % AckStatus.ack_failed
+    _SQL_EXPIRE_TASKS = (
+        "UPDATE {table_name} SET status = %s WHERE status < %s AND timestamp < ?"
+        % (AckStatus.ack_failed, AckStatus.ack_failed)
+    )
+
+    def __init__(self, fn_q="queues.db", fn_tasks="tasks.db", submit_func=submit_func_default,
+                 autoscaler=None, backend="sqlite", registry=None, metrics_path=None,
+                 metrics_interval=5.0, file_per_queue=False, lease_seconds=60.0):
         self.fn_q = fn_q
         self.fn_tasks = fn_tasks
+        # Give every queue and task table its own database file so that
+        # links do not contend for one write lock
+        self.file_per_queue = file_per_queue
         self.submit_func = submit_func
-
-    def link(self, taskq_kwargs={}, **kwargs):
+        self.autoscaler = autoscaler or Autoscaler()
+        self.backend = get_backend(backend)
+        self.registry = registry or REGISTRY
+        # Optionally dump metrics for a textfile collector every interval
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        self._metrics_written = 0
+        self.links = {}
+        self._task_count = {}
+        # DAG topology, task counters and watermarks survive restarts;
+        # a task whose heartbeat is older than the lease is orphaned
+        self.state = LinkerState(fn_tasks if self.backend.persistent else ":memory:")
+        self.lease_seconds = lease_seconds
+        self._resumed = False
+
+    def link(self, taskq_kwargs={}, adaptive_batch=None, max_workers=None, **kwargs):
+        """ Register a function as a link in the DAG.
+
+        `max_workers` caps how many workers the autoscaler runs for this
+        link; it defaults to the Linker's autoscaler cap.
+
+        Pass `adaptive_batch=True` (or a dict of `BatchSizer` kwargs such as
+        `min_size`, `max_size` and `target_duration`) to tune the batch size
+        from observed batch durations instead of using a fixed `batch_size`.
+
+        Pass `skip_if_key_present=[column]` to skip inputs whose `column`
+        value is already in the output queue, e.g. from an earlier run, or
+        `skip_if_present=[queue_name, column]` to skip rows whose `column`
+        value is in another queue. Re-running a DAG then only computes
+        the rows that are missing.
+        """
         def wrapper(inner_func):
             name = inner_func.__name__
-            q = IOQueues(self.fn_q, name=name, **kwargs)
-            tasks = SQLiteAckQueue(self.fn_tasks, table_name=f"tasks_{name}", **taskq_kwargs)
+            # Queue metrics go to the registry of this Linker
+            queue_kwargs = {'registry': self.registry, **kwargs.get('queue_kwargs', {})}
+            fn_tasks, q_kwargs = self.fn_tasks, dict(kwargs, queue_kwargs=queue_kwargs)
+            if self.file_per_queue and self.backend.persistent:
+                fn_tasks = queue_file(self.fn_tasks, f"{TASK_TABLE_PREFIX}{name}")
+                q_kwargs['split_files'] = True
+            q = self.backend.ioqueues_class(self.fn_q, name=name, **q_kwargs)
+            tasks = self.backend.queue_class(fn_tasks, table_name=f"{TASK_TABLE_PREFIX}{name}",
+                                             **{'registry': self.registry, **taskq_kwargs})
+            sizer = None
+            if adaptive_batch:
+                sizer_kwargs = adaptive_batch if isinstance(adaptive_batch, dict) else {}
+                # Only persist batch sizes if the queues themselves persist
+                path = fn_tasks if self.backend.persistent else ":memory:"
+                sizer = BatchSizer(path, name, batch_size=q.batch_size, **sizer_kwargs)
+            m_batch = self.registry.histogram(
+                "io_queue_link_batch_seconds", "Wall time to process one batch", link=name)
+            m_items = self.registry.counter(
+                "io_queue_link_items", "Input items processed", link=name)
 
             def func(task_id, **kwargs):
+                # A worker retired before it started has nothing to do
+                if tasks.statuses([task_id]).get(task_id) == AckStatus.ack_retired:
+                    return
                 tasks.acks([task_id])
-                # If there's not input queue, just run the function
-                # with no arguments
-                args = [q.gets()] if q.input_q else []
-                out_rows = inner_func(*args, **kwargs)
-                if q.output_q_name:
-                    q.puts(out_rows)
+                # Workers are long lived: keep pulling batches until the
+                # input queue is drained or the autoscaler retires us
+                while True:
+                    t0 = time.time()
+                    batch_size = sizer.batch_size if sizer else None
+                    # If there's not input queue, just run the function
+                    # with no arguments
+                    keys, args = [], []
+                    if q.input_q:
+                        keys, batch = q.gets(batch_size, return_keys=True)
+                        args = [batch]
+                    if args and len(args[0]) == 0:
+                        break
+                    out_rows = inner_func(*args, **kwargs)
+                    # Outputs, input acks and the task heartbeat are
+                    # committed together
+                    if not q.complete(keys, out_rows if q.output_q_name else [],
+                                      tasks=tasks, task_key=task_id):
+                        logger.warning(f"Discarding batch for {name}: inputs were "
+                                       "already completed by another task")
+                    if not args:
+                        break
+                    dt = time.time() - t0
+                    m_batch.observe(dt)
+                    m_items.inc(len(args[0]))
+                    self.autoscaler.observe(name, len(args[0]), dt)
+                    if sizer:
+                        sizer.observe(len(args[0]), dt)
+                    if tasks.statuses([task_id]).get(task_id) == AckStatus.ack_retired:
+                        break
                 # Mark this task as complete
                 tasks.acks([task_id], status=AckStatus.ack_done)
 
-            self.links[name] = Link(q, func, tasks)
+            self.links[name] = Link(q, func, tasks, sizer, max_workers, inner_func)
+            self._restore_state(name, q)
             return func
         return wrapper
 
+    def _restore_state(self, name, q):
+        saved = self.state.load(name)
+        if saved is not None:
+            self._task_count[name] = saved["task_count"]
+            if all(saved[k] == getattr(q, k) for k in TOPOLOGY):
+                q.watermark = saved["watermark"]
+            else:
+                logger.info(f"Inputs of {name} changed since the last run, rescanning them")
+        self._save_state(name)
+
+    def _save_state(self, name):
+        q = self.links[name].ioqueues
+        self.state.save(name, {k: getattr(q, k) for k in TOPOLOGY},
+                        self._task_count.get(name, 0), q.watermark)
+
+    def resume(self, full_scan=False):
+        """ Reconcile work left behind by a previous coordinator instead
+        of waiting for timeouts: tasks whose lease ran out are marked
+        failed, inputs checked out on queues that no live task reads
+        become ready again and watermarks are brought up to date. Called
+        by `run_until_complete`; returns the inputs released per link.
+        """
+        self._resumed = True
+        if not self.backend.persistent:
+            return {}
+        cutoff = time.time() - self.lease_seconds
+        live_inputs = set()
+        for name, link in self.links.items():
+            tasks = link.tasks
+            with tasks._locked():
+                cursor = tasks.con.execute(
+                    self._SQL_EXPIRE_TASKS.format(table_name=tasks._TABLE_NAME), (cutoff,))
+                tasks._commit(cursor.rowcount)
+            if cursor.rowcount:
+                logger.info(f"Expired {cursor.rowcount} orphaned tasks of {name}")
+            ((n_live,),) = tasks._read(self._SQL_LIVE_TASKS.format(table_name=tasks._TABLE_NAME))
+            if n_live:
+                live_inputs.add(link.ioqueues.input_q_name)
+        released, seen = {}, set()
+        for name, link in self.links.items():
+            q = link.ioqueues
+            if q.input_q is None:
+                continue
+            if q.input_q_name not in live_inputs and q.input_q_name not in seen:
+                seen.add(q.input_q_name)
+                released[name] = q.release_claimed()
+                if released[name]:
+                    logger.info(f"Released {released[name]} orphaned inputs of {name}")
+            q.advance_watermark(full_scan=full_scan)
+            self._save_state(name)
+        return released
+
     def run_once(self):
         for name, link in self.links.items():
-            delta = link.ioqueues.size_ready()
-            n_tasks_required = int(math.ceil(delta / link.ioqueues.batch_size))
-            n_tasks_active = link.tasks.active()
-            while n_tasks_required >= n_tasks_active:
-                self.create_task(name, link)
-                n_tasks_active += 1
+            # Pending tasks have not started yet but will, so they count
+            n_workers = link.tasks.free() + link.tasks.active()
+            if link.ioqueues.input_q is None:
+                # Links without inputs run once whenever none is running
+                target = 0 if n_workers else 1
+            else:
+                if self.backend.persistent:
+                    watermark = link.ioqueues.watermark
+                    if link.ioqueues.advance_watermark() != watermark:
+                        self._save_state(name)
+                backlog = link.ioqueues.size_ready()
+                target = self.autoscaler.target(name, backlog, link.batch_size,
+                                                max_workers=link.max_workers)
+                self.registry.gauge("io_queue_link_backlog", "Input rows ready to process",
+                                    link=name).set(backlog)
+            self.registry.gauge("io_queue_link_tasks_inflight", "Tasks pending or running",
+                                link=name).set(n_workers)
+            self.registry.gauge("io_queue_link_items_per_second", "Smoothed items/s per worker",
+                                link=name).set(self.autoscaler.items_per_sec.get(name, 0))
+            if target > n_workers:
+                self.create_tasks(name, link, target - n_workers)
+            elif target < n_workers:
+                self.retire_tasks(name, link, n_workers - target)
+        if self.metrics_path and time.time() - self._metrics_written > self.metrics_interval:
+            write_textfile(self.metrics_path, self.registry)
+            self._metrics_written = time.time()
     
     def run_until_complete(self, **kwargs):
+        if not self._resumed:
+            self.resume()
         while not self._check_complete():
             self.run_once(**kwargs)
 
@@ -87,12 +276,27 @@ class Linker:
         return all(completes.values())
 
     def create_task(self, name, link):
+        self.create_tasks(name, link, 1)
+
+    def create_tasks(self, name, link, n):
         task_id = self._task_count.get(name, 0)
-        task_cfg = {'task_index': task_id}
-        logger.info(f"Creating task {task_id} for {name}")
-        key = link.tasks.put(task_cfg)
-        self.submit_func(link.function, key, **task_cfg)
-        self._task_count[name] = task_id + 1
+        task_cfgs = [{'task_index': task_id + i} for i in range(n)]
+        logger.info(f"Creating {n} tasks for {name} starting at {task_id}")
+        keys = link.tasks.puts(task_cfgs)
+        self._task_count[name] = task_id + n
+        self._save_state(name)
+        for key, task_cfg in zip(keys, task_cfgs):
+            self.submit_func(link.function, key, **task_cfg)
+
+    def retire_tasks(self, name, link, n):
+        """ Ask up to `n` of the newest unfinished tasks to stop after
+        their current batch.
+        """
+        keys = link.tasks.active_keys(n)
+        if len(keys) == 0:
+            return
+        logger.info(f"Retiring {len(keys)} tasks for {name}")
+        link.tasks.updates(keys, AckStatus.ack_retired)
 
 
 def test_ioq_simple(n=25):
@@ -120,6 +324,10 @@ def test_ioq_simple(n=25):
         # left to process
         l.run_until_complete()
 
+        # Outputs can be streamed without claiming them
+        streamed = [item['out'] for item in l.links['transform'].iter_rows(batch_size=10)]
+        assert sorted(streamed) == list(range(50, 75))
+
         # Check outputs are what we expected
         items = l.links['transform'].get_outputs(100)
         flat = [item['out'] for item in items]
@@ -181,6 +389,229 @@ def test_ioq_complex(n=5, batch_size=10):
     os.remove("tasks.db")
     os.remove("queues.db")
 
+def test_ioq_adaptive(n=200):
+    for fn in ['tasks.db', 'queues.db']:
+        if os.path.exists(fn):
+            os.remove(fn)
+
+    l = Linker('queues.db')
+    sizes = []
+
+    @l.link(input_q_name="inq_adaptive", output_q_name="outq_adaptive", batch_size=2,
+            adaptive_batch=dict(max_size=64, target_duration=1.0))
+    def adaptive(items, **cfg):
+        sizes.append(len(items))
+        return [{'out': item['idx'] + 1, **item} for item in items]
+
+    l.links['adaptive'].set_inputs([dict(idx=idx) for idx in range(n)])
+    l.run_until_complete()
+
+    # Fast batches grow toward the max size
+    assert sizes[0] == 2
+    assert max(sizes) > 2
+    assert l.links['adaptive'].batch_size <= 64
+    assert l.links['adaptive'].ioqueues.output_q.count() == n
+    os.remove("tasks.db")
+    os.remove("queues.db")
+
+
+def test_ioq_autoscale(n=100):
+    from metrics import Registry
+    for fn in ['tasks.db', 'queues.db']:
+        if os.path.exists(fn):
+            os.remove(fn)
+
+    # Queue up submissions instead of running them so we can
+    # observe how many workers are scheduled
+    submitted = []
+
+    def submit_func(func, task_id, **kwargs):
+        submitted.append((func, task_id, kwargs))
+
+    registry = Registry()
+    l = Linker('queues.db', submit_func=submit_func,
+               autoscaler=Autoscaler(max_workers=3), registry=registry)
+
+    @l.link(input_q_name="inq_scale", output_q_name="outq_scale", batch_size=10)
+    def scaled(items, **cfg):
+        return [{'out': item['idx'], **item} for item in items]
+
+    link = l.links['scaled']
+    link.set_inputs([dict(idx=idx) for idx in range(n)])
+
+    # 10 batches are pending but we cap at 3 workers
+    l.run_once()
+    assert len(submitted) == 3
+    assert link.tasks.count() == 3
+    assert registry.gauge("io_queue_link_backlog", link="scaled").value == n
+
+    # Workers are already scheduled so nothing new is created
+    l.run_once()
+    assert len(submitted) == 3
+
+    # A single long-lived worker drains the whole backlog
+    func, task_id, kwargs = submitted[0]
+    func(task_id, **kwargs)
+    assert link.ioqueues.output_q.count() == n
+    assert registry.counter("io_queue_link_items", link="scaled").value == n
+    # Queue metrics of the link's queues go to the same registry
+    assert registry.counter("io_queue_claims", table="inq_scale").value == n
+    assert registry.counter("io_queue_acks", table="inq_scale").value == n
+    assert registry.counter("io_queue_puts", table="outq_scale").value == n
+    assert registry.histogram("io_queue_link_batch_seconds", link="scaled").count == 10
+
+    # With no backlog the idle workers are retired before they start
+    l.run_once()
+    for func, task_id, kwargs in submitted[1:]:
+        func(task_id, **kwargs)
+    assert link.tasks.free() + link.tasks.active() == 0
+    assert link.ioqueues.output_q.count() == n
+    assert len(submitted) == 3
+    os.remove("tasks.db")
+    os.remove("queues.db")
+
+
+def test_ioq_memory(n=25):
+    from memory_queue import drop_stores
+    drop_stores()
+    l = Linker('queues.db', backend="memory")
+
+    @l.link(input_q_name="urls", output_q_name="links", batch_size=3,
+            input_q_id_column="url", output_q_id_column="url")
+    def crawler(items, **cfg):
+        return [{'link': f"{item['url']}/{c}.html", **item} for item in items for c in 'ab']
+
+    @l.link(input_q_name="links", output_q_name="vecs", batch_size=4,
+            input_q_id_column="link", output_q_id_column="link")
+    def transform(items, **cfg):
+        return [{'vector': [1, 2, 3], **item} for item in items]
+
+    l.links['crawler'].set_inputs([dict(url=f"{idx}.com") for idx in range(n)])
+    l.run_until_complete()
+
+    # Nothing touched the disk
+    assert not os.path.exists('queues.db')
+    assert not os.path.exists('tasks.db')
+    assert sum(len(b) for b in l.links['transform'].iter_batches(7)) == 2 * n
+    items = l.links['transform'].get_outputs(1000)
+    assert len(items) == 2 * n
+    assert sum(sum(item['vector']) for item in items) == 12 * n
+    drop_stores()
+
+
+def test_ioq_file_per_queue(n=20):
+    import glob
+    for fn in glob.glob("queues*.db") + glob.glob("tasks*.db"):
+        os.remove(fn)
+    l = Linker('queues.db', 'tasks.db', file_per_queue=True)
+
+    @l.link(input_q_name="urls", output_q_name="links", batch_size=30)
+    def crawler(items, **cfg):
+        return [{'link': f"{item['url']}/{c}.html", **item} for item in items for c in 'ab']
+
+    @l.link(input_q_name="links", output_q_name="vecs", batch_size=100)
+    def transform(items, **cfg):
+        return [{'vector': [1, 2, 3], **item} for item in items]
+
+    l.links['crawler'].set_inputs([dict(url=f"{idx}.com") for idx in range(n)])
+    l.run_until_complete()
+
+    items = l.links['transform'].get_outputs(1000)
+    assert len(items) == 2 * n
+    assert sorted(item['link'] for item in items)[:2] == ["0.com/a.html", "0.com/b.html"]
+    files = sorted(glob.glob("queues*.db") + glob.glob("tasks*.db"))
+    # The Linker's own state stays in the main tasks file
+    assert files == ["queues.links.db", "queues.urls.db", "queues.vecs.db",
+                     "tasks.db", "tasks.tasks_crawler.db", "tasks.tasks_transform.db"]
+    for fn in files:
+        os.remove(fn)
+
+
+def test_ioq_resume(n=50):
+    for fn in ['tasks.db', 'queues.db']:
+        if os.path.exists(fn):
+            os.remove(fn)
+
+    def dag(**kwargs):
+        l = Linker('queues.db', 'tasks.db', **kwargs)
+
+        @l.link(input_q_name="inq_resume", output_q_name="outq_resume", batch_size=10)
+        def double(items, **cfg):
+            return [{'out': item['idx'] * 2, **item} for item in items]
+        return l
+
+    # The first coordinator schedules two workers and dies while one of
+    # them holds a claimed batch
+    submitted = []
+    l = dag(submit_func=lambda func, task_id, **kwargs: submitted.append(task_id),
+            autoscaler=Autoscaler(max_workers=2))
+    q = l.links['double'].ioqueues
+    l.links['double'].set_inputs([dict(idx=idx) for idx in range(n)])
+    l.run_once()
+    keys, batch = q.gets(return_keys=True)
+    q.complete(keys, [{'out': item['idx'] * 2, **item} for item in batch])
+    q.gets(10)
+    l.run_once()
+    assert l.state.load("double")["watermark"] == 10
+
+    # A new coordinator restores counters and watermarks, and with every
+    # lease expired releases the claimed batch without waiting
+    l = dag(lease_seconds=-1)
+    assert l._task_count["double"] == 2
+    assert l.links['double'].ioqueues.watermark == 10
+    assert l.resume() == {'double': 10}
+    assert l.links['double'].tasks.active() == 0
+    l.run_until_complete()
+    assert l.links['double'].ioqueues.output_q.count() == n
+    # Task indices carry on from the previous run
+    assert l._task_count["double"] > 2
+    os.remove('tasks.db')
+    os.remove('queues.db')
+
+
+def test_ioq_skip_present(n=10):
+    for fn in ['tasks.db', 'queues.db']:
+        if os.path.exists(fn):
+            os.remove(fn)
+    downloaded = []
+
+    def dag(n_products):
+        l = Linker('queues.db', 'tasks.db')
+
+        @l.link(output_q_name="products", skip_if_present=["images", "url"])
+        def load_product(**cfg):
+            return [dict(url=f"{idx}.jpg") for idx in range(n_products)]
+
+        @l.link(input_q_name="products", output_q_name="images", batch_size=4,
+                skip_if_key_present=["url"])
+        def downloader(items, **cfg):
+            downloaded.extend(item['url'] for item in items)
+            return [dict(url=item['url'], size=len(item['url'])) for item in items]
+        return l
+
+    l = dag(n)
+    l.run_once()
+    l.run_until_complete()
+    assert len(downloaded) == n
+
+    # A re-run only loads and downloads the products that are missing
+    downloaded.clear()
+    l = dag(n + 5)
+    l.run_once()
+    l.run_until_complete()
+    assert sorted(downloaded) == sorted(f"{idx}.jpg" for idx in range(n, n + 5))
+    assert l.links['downloader'].ioqueues.output_q.count() == n + 5
+    assert l.links['downloader'].set_inputs([dict(url="0.jpg")]) == []
+    os.remove('tasks.db')
+    os.remove('queues.db')
+
+
 if __name__ == '__main__':
     test_ioq_simple()
-    test_ioq_complex()
\ No newline at end of file
+    test_ioq_complex()
+    test_ioq_adaptive()
+    test_ioq_autoscale()
+    test_ioq_memory()
+    test_ioq_file_per_queue()
+    test_ioq_resume()
+    test_ioq_skip_present()
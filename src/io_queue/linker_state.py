@@ -0,0 +1,91 @@
+"""
+LinkerState persists what a Linker coordinator knows about its DAG, so a
+restarted coordinator resumes in seconds instead of rebuilding it:
+
+    topology      input and output queue of every link and their id columns
+    task_count    next task index, so indices do not restart at 0
+    watermark     every input row with a key up to it is done, so the
+                  ready joins only scan rows above it
+
+Rows are keyed by link name in one small table next to the task queues.
+Task leases need no extra state: a task is live while its row in the
+task queue was created or heartbeat within the lease.
+"""
+import sqlite3
+import time
+
+TOPOLOGY = ("input_q_name", "output_q_name", "input_q_id_column", "output_q_id_column")
+# Task queues of links are named after the link with this prefix
+TASK_TABLE_PREFIX = "tasks_"
+
+
+class LinkerState:
+    _TABLE_NAME = "linker_state"
+    _SQL_CREATE = (
+        "CREATE TABLE IF NOT EXISTS {table_name} ("
+        "name TEXT PRIMARY KEY, input_q_name TEXT, output_q_name TEXT, "
+        "input_q_id_column TEXT, output_q_id_column TEXT, "
+        "task_count INTEGER, watermark INTEGER, timestamp FLOAT)"
+    )
+    _SQL_SELECT = "SELECT * FROM {table_name} WHERE name = ?"
+    _SQL_SELECT_ALL = "SELECT * FROM {table_name} ORDER BY name"
+    _SQL_UPSERT = (
+        "INSERT OR REPLACE INTO {table_name} "
+        "(name, input_q_name, output_q_name, input_q_id_column, output_q_id_column, "
+        "task_count, watermark, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+    )
+
+    _con = None
+
+    def __init__(self, path, table_name=None):
+        self.path = path
+        if table_name:
+            self._TABLE_NAME = table_name
+        self.con.execute(self._SQL_CREATE.format(table_name=self._TABLE_NAME))
+        self.con.commit()
+
+    @property
+    def con(self):
+        if self._con is None:
+            self._con = sqlite3.connect(self.path)
+            self._con.row_factory = sqlite3.Row
+        return self._con
+
+    def load(self, name):
+        """ The saved state of link `name` as a dict, or None. """
+        row = self.con.execute(self._SQL_SELECT.format(table_name=self._TABLE_NAME),
+                               (name,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def links(self):
+        rows = self.con.execute(self._SQL_SELECT_ALL.format(table_name=self._TABLE_NAME))
+        return {row["name"]: dict(row) for row in rows}
+
+    def save(self, name, topology, task_count, watermark):
+        query = self._SQL_UPSERT.format(table_name=self._TABLE_NAME)
+        self.con.execute(query, (name, *(topology[k] for k in TOPOLOGY),
+                                 task_count, watermark, time.time()))
+        self.con.commit()
+
+
+def test_linker_state(fn="test_linker_state.db"):
+    import os
+    if os.path.exists(fn):
+        os.remove(fn)
+    state = LinkerState(fn)
+    assert state.load("crawler") is None
+    topology = dict(input_q_name="urls", output_q_name="links",
+                    input_q_id_column="_id", output_q_id_column="_id")
+    state.save("crawler", topology, task_count=3, watermark=120)
+    state.save("crawler", topology, task_count=5, watermark=180)
+
+    # A new coordinator sees the latest state
+    row = LinkerState(fn).load("crawler")
+    assert row["task_count"] == 5 and row["watermark"] == 180
+    assert {k: row[k] for k in TOPOLOGY} == topology
+    assert list(LinkerState(fn).links()) == ["crawler"]
+    os.remove(fn)
+
+
+if __name__ == '__main__':
+    test_linker_state()
@@ -0,0 +1,31 @@
+"""
+The package logger. Importing loguru takes tens of milliseconds, most of
+it asyncio, which every worker process would pay at startup; this proxy
+imports it on the first log call instead.
+"""
+
+
+class _LazyLogger:
+    _logger = None
+
+    def __getattr__(self, name):
+        if _LazyLogger._logger is None:
+            from loguru import logger
+            _LazyLogger._logger = logger
+        return getattr(_LazyLogger._logger, name)
+
+
+logger = _LazyLogger()
+
+
+def test_lazy_logger():
+    import subprocess
+    import sys
+    code = ("import sys; from log import logger; assert 'loguru' not in sys.modules; "
+            "logger.debug('hi'); assert 'loguru' in sys.modules")
+    subprocess.run([sys.executable, "-c", code], check=True,
+                   cwd=__import__("os").path.dirname(__file__) or ".")
+
+
+if __name__ == '__main__':
+    test_lazy_logger()
@@ -0,0 +1,757 @@
+"""
+MemoryAckQueue keeps a queue entirely in process memory. It has the same
+API and the same ack, timeout and unique semantics as SQLiteAckQueue but
+stores rows in dicts bucketed by status, so ephemeral pipelines and tests
+run at memory speed without touching disk.
+
+Queues opened with the same path and table name share one store, just
+like tables in one SQLite file. A store can be snapshotted to SQLite, on
+demand or on shutdown, with the same table name, keys and statuses.
+"""
+import atexit
+import bisect
+import math
+import os
+import threading
+import time
+
+from uuid import uuid4
+
+from log import logger
+
+from io_queues import IOQueues
+from sqliteack_queue import AckStatus
+from sqliteack_queue import SQLiteAckQueue
+
+
+# One lock for every store so that IOQueues can move rows between an
+# input and an output store atomically
+_LOCK = threading.RLock()
+_STORES = {}
+_FREE = (AckStatus.inited, AckStatus.ready)
+
+
+class MemoryStore:
+    def __init__(self):
+        # _id -> [timestamp, status, item]
+        self.rows = {}
+        # status -> insertion ordered dict of _id -> None
+        self.buckets = {}
+        # unique column value -> _id
+        self.unique = {}
+        self.columns = []
+        # Columns that hold lists, read back as [] when missing
+        self.arrays = set()
+        self.next_id = 1
+        # _id -> claim rank, only kept for queues with priorities
+        self.ranks = {}
+        # (-rank, _id) entries of free rows in claim order, sorted. Rows
+        # that are claimed, deleted or re-ranked leave their entry
+        # behind; only the entry in `live` counts and the rest are
+        # dropped as claims pass them
+        self.free = []
+        self.live = {}
+        self._free_start = 0
+        # column -> {value: number of rows}, kept once asked for
+        self.indexes = {}
+
+    def add(self, key, row):
+        self.rows[key] = row
+        self.buckets.setdefault(row[1], {})[key] = None
+        for column, counts in self.indexes.items():
+            _count(counts, row[2].get(column), 1)
+        if row[1] in _FREE:
+            self._enter_free(key)
+
+    def remove(self, key):
+        row = self.rows.pop(key, None)
+        if row is None:
+            return None
+        self.buckets[row[1]].pop(key, None)
+        self.ranks.pop(key, None)
+        self.live.pop(key, None)
+        for column, counts in self.indexes.items():
+            _count(counts, row[2].get(column), -1)
+        return row
+
+    def update(self, key, fields):
+        item = self.rows[key][2]
+        for column, counts in self.indexes.items():
+            if column in fields:
+                _count(counts, item.get(column), -1)
+                _count(counts, fields[column], 1)
+        item.update(fields)
+
+    def move(self, key, status):
+        row = self.rows[key]
+        self.buckets[row[1]].pop(key, None)
+        self.buckets.setdefault(status, {})[key] = None
+        if status not in _FREE:
+            self.live.pop(key, None)
+        elif key not in self.live:
+            self._enter_free(key)
+        row[1] = status
+
+    def rerank(self, key, rank):
+        self.ranks[key] = rank
+        if key in self.live:
+            self._enter_free(key)
+
+    def _enter_free(self, key):
+        entry = (-self.ranks.get(key, 0), key)
+        self.live[key] = entry
+        bisect.insort(self.free, entry, lo=self._free_start)
+
+    def free_keys(self):
+        """ Keys of the free rows in claim order: highest rank first,
+        then by `_id` like SQLite. The store must not change while this
+        is iterated.
+        """
+        free, live = self.free, self.live
+        start = self._free_start
+        while start < len(free) and live.get(free[start][1]) is not free[start]:
+            start += 1
+        if len(free) - start > 2 * len(live) + 1024:
+            # Mostly entries left behind out of order, e.g. by group caps
+            free[:] = [entry for entry in free[start:] if live.get(entry[1]) is entry]
+            start = 0
+        elif start > 1024 and start > len(free) // 2:
+            del free[:start]
+            start = 0
+        self._free_start = start
+        for i in range(start, len(free)):
+            entry = free[i]
+            if live.get(entry[1]) is entry:
+                yield entry[1]
+
+    def index(self, column):
+        """ {value: number of rows} of `column`, kept up to date from now on.
+        """
+        counts = self.indexes.get(column)
+        if counts is None:
+            counts = self.indexes[column] = {}
+            for row in self.rows.values():
+                _count(counts, row[2].get(column), 1)
+        return counts
+
+
+def _count(counts, value, delta):
+    if value is None:
+        return
+    n = counts.get(value, 0) + delta
+    if n > 0:
+        counts[value] = n
+    else:
+        counts.pop(value, None)
+
+
+def drop_stores(path=None):
+    """ Forget every in-memory table, or only those under `path`.
+    """
+    with _LOCK:
+        for key in list(_STORES):
+            if path is None or key[0] == path:
+                del _STORES[key]
+
+
+class MemoryAckQueue:
+    _TABLE_NAME = SQLiteAckQueue._TABLE_NAME
+    _KEY_COLUMN = SQLiteAckQueue._KEY_COLUMN
+    last_timeout_application = 0
+
+    def __init__(
+        self,
+        path,
+        unique_column=None,
+        timeout=300,
+        max_size=None,
+        delete_on_ack=False,
+        serializer=None,
+        table_name=None,
+        share_with=None,
+        write_behind=False,
+        flush_size=None,
+        flush_interval=None,
+        snapshot_path=None,
+        payload=False,
+        promoted_columns=(),
+        compress=None,
+        compress_columns=None,
+        priorities=False,
+        aging_interval=None,
+        dedup=False,
+        wal=False,
+        mmap_size=0,
+        group_column=None,
+        group_limit=None,
+        registry=None,
+    ):
+        # `serializer`, `share_with`, the write-behind, payload, compression,
+        # dedup, WAL and mmap settings and `registry` are accepted for API
+        # compatibility; memory needs none of them and keeps no metrics.
+        # Rows are held uncompressed whatever `compress` says
+        if compress or compress_columns:
+            logger.warning(f"Memory queue {path} ignores compress and compress_columns: "
+                           "rows are kept uncompressed")
+        self.path = path
+        self.unique_column = unique_column
+        self.timeout = timeout
+        self.max_size = max_size
+        self.delete_on_ack = delete_on_ack
+        self.snapshot_path = snapshot_path
+        self.priorities = priorities
+        self.aging_interval = aging_interval
+        self.group_column = group_column
+        self.group_limit = group_limit
+        if table_name:
+            self._TABLE_NAME = table_name
+        self._lock = _LOCK
+        with _LOCK:
+            self.store = _STORES.setdefault((path, self._TABLE_NAME), MemoryStore())
+            if unique_column and unique_column not in self.store.columns:
+                self.store.columns.append(unique_column)
+        if snapshot_path:
+            atexit.register(self.snapshot)
+
+    @property
+    def columns(self):
+        return self.store.columns
+
+    def get(self):
+        return self.gets(1)
+
+    def gets(self, n, random_offset=False, ack=True, return_keys=False,
+             read_all=False):
+        with _LOCK:
+            self.apply_timeout()
+            if read_all:
+                keys = list(_take(self.store.rows, n))
+            else:
+                keys = self._take_group(self._free_keys(), n)
+            items = [self._item(key) for key in keys]
+            if ack:
+                self._updates(keys, AckStatus.unack)
+        if return_keys:
+            return keys, items
+        return items
+
+    def iter_batches(self, batch_size=1000, where=None, params=(), columns=None,
+                     return_keys=False, prefetch=False):
+        """ Yield every row in key order; see SQLiteAckQueue.iter_batches.
+        `where` is SQL and not supported here, `prefetch` is not needed.
+        """
+        if where is not None:
+            raise ValueError("The memory backend cannot filter rows with SQL")
+        with _LOCK:
+            all_keys = list(self.store.rows)
+        for start in range(0, len(all_keys), batch_size):
+            with _LOCK:
+                keys = [k for k in all_keys[start:start + batch_size] if k in self.store.rows]
+                items = [self._item(key) for key in keys]
+            if columns is not None:
+                items = [{k: v for (k, v) in item.items() if k in columns} for item in items]
+            if keys:
+                yield (keys, items) if return_keys else items
+
+    def iter_rows(self, batch_size=1000, **kwargs):
+        for batch in self.iter_batches(batch_size, **kwargs):
+            yield from batch
+
+    def _rank(self, priority, timestamp):
+        if self.aging_interval:
+            return priority - timestamp / self.aging_interval
+        return priority
+
+    def set_priority(self, keys, priority):
+        with _LOCK:
+            for key in keys:
+                self.store.rerank(key, self._rank(priority, self.store.rows[key][0]))
+
+    def _free_keys(self):
+        return self.store.free_keys()
+
+    def _take_group(self, keys, n):
+        """ Up to `n` of `keys`, all of the group of the first key whose
+        group is below its cap; see SQLiteAckQueue._select_group.
+        """
+        if not self.group_column:
+            return list(_take(keys, n))
+        rows = self.store.rows
+        active = {}
+        if self.group_limit:
+            for key in self.store.buckets.get(AckStatus.unack, {}):
+                group = rows[key][2].get(self.group_column)
+                active[group] = active.get(group, 0) + 1
+        found, group = [], None
+        for key in keys:
+            if len(found) >= n:
+                break
+            g = rows[key][2].get(self.group_column)
+            if not found:
+                room = int(self.group_limit) - active.get(g, 0) if self.group_limit else n
+                if room <= 0:
+                    continue
+                group, n = g, min(n, room)
+            elif g != group:
+                continue
+            found.append(key)
+        return found
+
+    def _item(self, key):
+        item = self.store.rows[key][2]
+        arrays = self.store.arrays
+        return {c: _copy(item.get(c)) if c not in arrays or item.get(c) is not None else []
+                for c in self.store.columns}
+
+    def put(self, item):
+        key, = self.puts([item])
+        return key
+
+    def puts(self, items, return_keys=True, priority=0):
+        # Wait for room before locking, so that consumers can drain
+        if items:
+            self.max_size_block()
+        with _LOCK:
+            return self._puts(items, return_keys, priority)
+
+    def _puts(self, items, return_keys=True, priority=0):
+        if len(items) == 0:
+            return [] if return_keys else 0
+        self._check_items(items)
+        store = self.store
+        priorities = priority if isinstance(priority, (list, tuple)) else [priority] * len(items)
+        keys = []
+        for item, p in zip(items, priorities):
+            value = item.get(self.unique_column) if self.unique_column else None
+            if value is not None and value in store.unique:
+                continue
+            key = store.next_id
+            store.next_id += 1
+            now = time.time()
+            if self.priorities:
+                store.ranks[key] = self._rank(p, now)
+            store.add(key, [now, AckStatus.inited, {k: _copy(v) for (k, v) in item.items()}])
+            if value is not None:
+                store.unique[value] = key
+            self._add_columns(item)
+            keys.append(key)
+        return keys if return_keys else len(keys)
+
+    def _add_columns(self, item):
+        store = self.store
+        for k, v in item.items():
+            if k not in store.columns:
+                store.columns.append(k)
+            if isinstance(v, list):
+                store.arrays.add(k)
+
+    def _check_items(self, items):
+        if not all(isinstance(i, dict) for i in items):
+            raise ValueError("Items must be dicts")
+        if not all(len(i) > 0 for i in items):
+            raise ValueError("Dicts cannot be empty")
+        for item in items:
+            if any(isinstance(v, dict) for v in item.values()):
+                raise ValueError("Cannot have nested dictionaries")
+
+    def max_size_block(self):
+        """ Block the main thread until the count in the table
+        decreases.
+        """
+        if self.max_size:
+            i = 0
+            while self.count() > self.max_size:
+                i += 1
+                time.sleep(1)
+                if int(math.log2(i)) == math.log2(i):
+                    logger.info(f"Waited {i} sec so far for queue to deplete")
+
+    def updates(self, keys, status=AckStatus.unack):
+        with _LOCK:
+            self._updates(keys, status)
+
+    def _updates(self, keys, status=AckStatus.unack):
+        if not all(key in self.store.rows for key in keys):
+            raise KeyError("Could not update all keys")
+        for key in keys:
+            self.store.move(key, status)
+
+    def _heartbeat(self, key):
+        self.store.rows[key][0] = time.time()
+
+    def register_consumer(self, consumer_id=None, refresh=5.0):
+        """ Claims are made under one process-wide lock, so consumers
+        never contend and need no partitioning here.
+        """
+        self.consumer_id = consumer_id or uuid4().hex
+        return self.consumer_id
+
+    def unregister_consumer(self):
+        self.consumer_id = None
+
+    def statuses(self, keys):
+        with _LOCK:
+            return {key: self.store.rows[key][1] for key in keys if key in self.store.rows}
+
+    def active_keys(self, n):
+        """ Keys of up to `n` rows that are waiting or checked out but
+        not yet finished, newest first.
+        """
+        with _LOCK:
+            keys = [key for (key, row) in reversed(self.store.rows.items())
+                    if int(row[1]) < int(AckStatus.ack_failed)]
+        return keys[:n]
+
+    def set(self, row_key_dict, **field_dict):
+        return self.sets([row_key_dict], [field_dict])
+
+    def sets(self, row_key_dicts, field_dicts):
+        with _LOCK:
+            self._check_items(field_dicts)
+            store = self.store
+            for row_key_dict, field_dict in zip(row_key_dicts, field_dicts):
+                (row_id_col, row_id_val), = list(row_key_dict.items())
+                if row_id_col == self._KEY_COLUMN:
+                    keys = [row_id_val] if row_id_val in store.rows else []
+                else:
+                    keys = [key for (key, row) in store.rows.items()
+                            if row[2].get(row_id_col) == row_id_val]
+                assert len(keys) == 1, f"Did not find row for {row_id_col}={row_id_val}"
+                store.update(keys[0], field_dict)
+                self._add_columns(field_dict)
+
+    def delete(self, keys):
+        with _LOCK:
+            self._delete(keys)
+
+    def _delete(self, keys):
+        store = self.store
+        for key in keys:
+            row = store.remove(key)
+            if row is None:
+                continue
+            value = row[2].get(self.unique_column) if self.unique_column else None
+            if value is not None:
+                store.unique.pop(value, None)
+
+    def acks(self, keys, status=AckStatus.acked):
+        with _LOCK:
+            self._acks(keys, status)
+
+    def _acks(self, keys, status=AckStatus.acked):
+        self._updates(keys, status)
+        if self.delete_on_ack:
+            self._delete(keys)
+
+    def _commit(self, n_rows=1):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.snapshot_path:
+            self.snapshot()
+
+    def apply_timeout(self):
+        # Make sure we do not apply the timeout logic too frequently
+        dt = time.time() - self.last_timeout_application
+        if dt < self.timeout:
+            return
+        time_cutoff = time.time() - self.timeout
+        with _LOCK:
+            store = self.store
+            for key in list(store.buckets.get(AckStatus.unack, {})):
+                if store.rows[key][0] < time_cutoff:
+                    store.move(key, AckStatus.ready)
+        self.last_timeout_application = time.time()
+
+    def _count_status(self, lo, hi):
+        self.apply_timeout()
+        with _LOCK:
+            return sum(len(bucket) for (status, bucket) in self.store.buckets.items()
+                       if lo <= int(status) < hi)
+
+    def free(self):
+        return self._count_status(0, int(AckStatus.unack))
+
+    def done(self):
+        return self._count_status(int(AckStatus.unack) + 1, math.inf)
+
+    def active(self):
+        return self._count_status(int(AckStatus.unack), int(AckStatus.ack_failed))
+
+    def count(self):
+        return len(self.store.rows)
+
+    def approx_count(self):
+        return self.count()
+
+    def snapshot(self, path=None):
+        """ Write every row, with its key, timestamp and status, to a
+        table of the same name in the SQLite file at `path`.
+        """
+        path = path or self.snapshot_path
+        q = SQLiteAckQueue(path, unique_column=self.unique_column, table_name=self._TABLE_NAME)
+        with _LOCK:
+            rows = [(key, ts, status, item) for (key, (ts, status, item))
+                    in self.store.rows.items()]
+        items = q.flatten_array_columns([row[3] for row in rows])
+        for item in items:
+            q.update_table_schema(item)
+        columns = ", ".join(q.columns)
+        values = ", ".join("?" for _ in q.columns)
+        insert = (f"INSERT OR REPLACE INTO {q._TABLE_NAME} "
+                  f"({q._KEY_COLUMN}, timestamp, status, {columns}) "
+                  f"VALUES (?, ?, ?, {values})")
+        q.con.executemany(insert, ([key, ts, int(status)] + [item.get(c) for c in q.columns]
+                                   for ((key, ts, status, _), item) in zip(rows, items)))
+        q.con.commit()
+        logger.info(f"Snapshot {len(rows)} rows of {self._TABLE_NAME} to {path}")
+
+
+class MemoryIOQueues(IOQueues):
+    queue_class = MemoryAckQueue
+
+    def _id_value(self, key, item, column):
+        return key if column == "_id" else item.get(column)
+
+    def _ready_keys(self, skipped_keys=None):
+        """ Free input keys whose id is not yet in the output queue. The
+        skipped ones passed over are collected in `skipped_keys`.
+        """
+        self.input_q.apply_timeout()
+        present = {}
+        if self.output_q is not None:
+            store = self.output_q.store
+            column = self.output_q_id_column
+            present = store.rows if column == "_id" else store.index(column)
+        skipped = {}
+        if self.skip_q is not None:
+            skipped = self._values(self.skip_q, self.skip_column)
+        rows = self.input_q.store.rows
+        for key in self.input_q._free_keys():
+            if self._id_value(key, rows[key][2], self.input_q_id_column) in present:
+                if self.skip_key_column and skipped_keys is not None:
+                    skipped_keys.append(key)
+                continue
+            if skipped and rows[key][2].get(self.skip_column) in skipped:
+                if skipped_keys is not None:
+                    skipped_keys.append(key)
+                continue
+            yield key
+
+    def _values(self, q, column):
+        return q.store.index(column)
+
+    def _present(self, q, table, column, values):
+        with _LOCK:
+            index = self._values(q, column)
+            return {v for v in values if v is not None and v in index}
+
+    def _has_column(self, q, column):
+        return column in q.columns
+
+    def _index(self, q, column):
+        pass
+
+    def size_ready(self):
+        if self.input_q is None:
+            return 0
+        with _LOCK:
+            return sum(1 for _ in self._ready_keys())
+
+    def gets(self, batch_size=None, return_keys=False):
+        if batch_size is None:
+            batch_size = self.batch_size
+        if self.input_q is None:
+            return None
+        with _LOCK:
+            skipped = []
+            keys = self.input_q._take_group(self._ready_keys(skipped), batch_size)
+            items = [self.input_q._item(key) for key in keys]
+            self.input_q._updates(keys, AckStatus.unack)
+            self.input_q._updates(skipped, AckStatus.ack_done)
+        if return_keys:
+            return keys, items
+        return items
+
+    def complete(self, input_keys, output_rows, tasks=None, task_key=None):
+        if self.input_q is None:
+            output_rows = self._todo(output_rows)
+        with _LOCK:
+            if self.input_q is not None and len(input_keys) > 0:
+                rows = self.input_q.store.rows
+                if not all(key in rows and int(rows[key][1]) < int(AckStatus.acked)
+                           for key in input_keys):
+                    return False
+            if self.output_q is not None and len(output_rows) > 0:
+                self.output_q._puts(output_rows)
+            if self.input_q is not None:
+                self.input_q._updates(list(set(input_keys)), AckStatus.ack_done)
+            if tasks is not None and task_key is not None:
+                tasks._heartbeat(task_key)
+                tasks._commit()
+        return True
+
+
+def _take(iterable, n):
+    for i, x in enumerate(iterable):
+        if i >= n:
+            return
+        yield x
+
+
+def _copy(value):
+    return list(value) if isinstance(value, list) else value
+
+
+def test_memory_queue():
+    drop_stores("mem")
+    q = MemoryAckQueue("mem", unique_column="id")
+    assert q.count() == 0
+    assert q.gets(1) == []
+
+    # Unknown keys cannot be acked
+    try:
+        q.acks([7])
+        raise RuntimeError("Expected to raise KeyError")
+    except KeyError:
+        pass
+
+    # Cannot put in empty dicts
+    try:
+        q.puts([{} for _ in range(10)])
+        raise RuntimeError("Expected to raise ValueError")
+    except ValueError:
+        pass
+
+    # Unique column deduplicates, new keys become columns
+    q.puts([{'id': i} for i in range(10)])
+    q.puts([{'id': i} for i in range(10)])
+    q.puts([{'id': i, 'color': str(i + 100), 'vec': [i, i]} for i in range(10, 21)])
+    assert q.count() == 21
+    assert q.free() == 21
+
+    keys, items = q.gets(7, return_keys=True)
+    assert len(keys) == len(items) == 7
+    assert q.free() == 14
+    assert q.active() == 7
+    assert items[0]['color'] is None
+    q.acks(keys)
+    q.acks(keys)
+    assert q.done() == 7
+
+    items = q.gets(50)
+    assert len(items) == 14
+    assert sum(i['vec'][0] for i in items if i['vec']) == sum(range(10, 21))
+
+    # Update fields in place
+    q.sets([{'id': i} for i in range(8)], [{"id2": i + 500} for i in range(8)])
+    items = q.gets(50, read_all=True)
+    assert len([i for i in items if i['id2'] is not None]) == 8
+
+    # Another queue on the same path and table shares the store
+    assert MemoryAckQueue("mem", unique_column="id").count() == 21
+    drop_stores("mem")
+    assert MemoryAckQueue("mem").count() == 0
+
+
+def test_memory_max_size():
+    drop_stores("mem")
+    q = MemoryAckQueue("mem", max_size=2, delete_on_ack=True)
+    q.puts([{'idx': i} for i in range(3)])
+    producer = threading.Thread(target=q.puts, args=([{'idx': 3}],))
+    producer.start()
+    # A producer waiting for room does not stop consumers from draining
+    keys = q.gets(3, return_keys=True)[0]
+    assert len(keys) == 3
+    q.acks(keys)
+    producer.join(timeout=5)
+    assert not producer.is_alive() and q.count() == 1
+    drop_stores("mem")
+
+
+def test_memory_timeout():
+    drop_stores("mem")
+    q = MemoryAckQueue("mem", timeout=0.1)
+    q.puts([{'idx': i} for i in range(5)])
+    assert len(q.gets(5)) == 5
+    assert q.free() == 0
+    time.sleep(0.2)
+    # Unack rows return to the queue after the timeout
+    assert q.free() == 5
+    drop_stores("mem")
+
+
+def test_memory_priorities():
+    drop_stores("mem")
+    q = MemoryAckQueue("mem", priorities=True)
+    q.puts([{'idx': i} for i in range(5)])
+    q.puts([{'idx': "urgent"}], priority=10)
+    assert [i['idx'] for i in q.gets(2)] == ["urgent", 0]
+    drop_stores("mem")
+
+
+def test_memory_claim_order():
+    drop_stores("mem")
+    for q in (MemoryAckQueue("mem"), SQLiteAckQueue(":memory:")):
+        keys = q.puts([{'idx': i} for i in range(10)])
+        claimed = q.gets(5, return_keys=True)[0]
+        # Recycled rows are claimed in key order among the waiting ones
+        q.updates(claimed[3:0:-2], AckStatus.ready)
+        assert q.gets(4, return_keys=True)[0] == [keys[1], keys[3], keys[5], keys[6]]
+        # Missing array values read back as empty lists on both backends
+        q.puts([{'idx': 10, 'vec': [1, 2]}, {'idx': 11}])
+        assert [item['vec'] for item in q.gets(10)][-2:] == [[1, 2], []]
+    drop_stores("mem")
+
+    # Outputs are looked up through an index kept up to date
+    ioq = MemoryIOQueues("mem", input_q_name="inq", output_q_name="outq",
+                         input_q_id_column="idx", output_q_id_column="idx")
+    ioq.load([dict(idx=idx) for idx in range(5)])
+    ioq.output_q.puts([dict(idx=0), dict(idx=1)])
+    assert ioq.size_ready() == 3
+    # Inputs 0 and 1 become ready again, 3 now has an output
+    ioq.output_q.delete([1])
+    ioq.output_q.set({'_id': 2}, idx=3)
+    assert [item['idx'] for item in ioq.gets(5)] == [0, 1, 2, 4]
+    drop_stores("mem")
+
+
+def test_memory_ioqueues_snapshot(n=25, fn="test_snapshot.db"):
+    drop_stores("mem")
+    if os.path.exists(fn):
+        os.remove(fn)
+    ioq = MemoryIOQueues("mem", input_q_name="inq", output_q_name="outq",
+                         input_q_id_column="idx", output_q_id_column="idx")
+    ioq.load([dict(idx=idx, vec=[idx, 1]) for idx in range(n)])
+    assert ioq.size_ready() == n
+
+    keys, batch = ioq.gets(10, return_keys=True)
+    assert ioq.size_ready() == n - 10
+    assert ioq.complete(keys, [{'idx': i['idx'], 'out': i['vec'][0] + 1} for i in batch])
+    # Already completed inputs are rejected
+    assert not ioq.complete(keys, [{'idx': -1}])
+    assert ioq.output_q.count() == 10
+    assert ioq.input_q.done() == 10
+
+    # Snapshot to SQLite keeps keys, statuses and array columns
+    ioq.input_q.snapshot(fn)
+    q = SQLiteAckQueue(fn, table_name="inq")
+    assert q.count() == n
+    assert q.done() == 10
+    items = q.gets(n)
+    assert len(items) == n - 10
+    assert all(len(i['vec']) == 2 for i in items)
+    os.remove(fn)
+    drop_stores("mem")
+
+
+if __name__ == '__main__':
+    test_memory_queue()
+    test_memory_max_size()
+    test_memory_timeout()
+    test_memory_priorities()
+    test_memory_claim_order()
+    test_memory_ioqueues_snapshot()
@@ -0,0 +1,269 @@
+"""
+A small in-process metrics registry with counters, gauges and histograms,
+plus the Prometheus text exposition format. Queues and the Linker record
+into the default REGISTRY; the current values can be rendered with
+`exposition()`, written to a file for a node exporter textfile collector
+with `write_textfile()`, or served over HTTP on a local port with `serve()`.
+
+Recording is a dict-free attribute update on a pre-resolved metric, so it
+is cheap enough to leave on in production. Updates are not locked; under
+heavy threading a rare lost increment is accepted in exchange for speed.
+"""
+import bisect
+import math
+import os
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def samples(self, name, labels):
+        yield name + "_total" if not name.endswith("_total") else name, labels, self.value
+
+
+class Gauge:
+    type = "gauge"
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, value=1):
+        self.value += value
+
+    def dec(self, value=1):
+        self.value -= value
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for le, n in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += n
+            yield name + "_bucket", labels + (("le", _format_value(le)),), cumulative
+        yield name + "_sum", labels, self.sum
+        yield name + "_count", labels, self.count
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (type, help, {labels: metric})
+        self._families = {}
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        key = tuple(sorted(labels.items()))
+        family = self._families.get(name)
+        if family is None or key not in family[2]:
+            with self._lock:
+                family = self._families.setdefault(name, (cls, help, {}))
+                if family[0] is not cls:
+                    raise ValueError(f"Metric {name} already registered as {family[0].type}")
+                family[2].setdefault(key, cls(**kwargs))
+        return family[2][key]
+
+    def counter(self, name, help="", **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help="", **labels):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def collect(self):
+        with self._lock:
+            families = [(name, cls, help, list(metrics.items()))
+                        for (name, (cls, help, metrics)) in sorted(self._families.items())]
+        return families
+
+    def clear(self):
+        with self._lock:
+            self._families.clear()
+
+
+REGISTRY = Registry()
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) + ".0"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join('{}="{}"'.format(k, str(v).replace("\\", r"\\").replace('"', r'\"'))
+                     for (k, v) in labels)
+    return "{" + pairs + "}"
+
+
+def exposition(registry=REGISTRY):
+    """ Render every metric in the Prometheus text format.
+    """
+    lines = []
+    for name, cls, help, metrics in registry.collect():
+        if help:
+            lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {cls.type}")
+        for labels, metric in metrics:
+            for sample_name, sample_labels, value in metric.samples(name, labels):
+                lines.append(f"{sample_name}{_format_labels(sample_labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path, registry=REGISTRY):
+    """ Atomically write the exposition to `path`.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fh:
+        fh.write(exposition(registry))
+    os.replace(tmp, path)
+
+
+def serve(port=9464, addr="127.0.0.1", registry=REGISTRY):
+    """ Serve the exposition over HTTP from a daemon thread and return
+    the server; `server.server_address` holds the bound port.
+    """
+    from http.server import BaseHTTPRequestHandler
+    from http.server import ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = exposition(registry).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+class Timer:
+    """ Context manager that observes its duration on a histogram.
+    """
+    __slots__ = ("histogram", "t0")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.t0)
+
+
+def test_metrics_exposition(fn="test_metrics.prom"):
+    registry = Registry()
+    puts = registry.counter("io_queue_puts", "Rows put", table="inq")
+    puts.inc(3)
+    assert registry.counter("io_queue_puts", table="inq") is puts
+    registry.gauge("io_queue_backlog", "Rows waiting", link="a").set(7)
+    hist = registry.histogram("io_queue_claim_seconds", buckets=(0.1, 1.0), table="inq")
+    with Timer(hist):
+        pass
+    hist.observe(0.5)
+    hist.observe(5)
+
+    text = exposition(registry)
+    assert "# TYPE io_queue_puts counter" in text
+    assert 'io_queue_puts_total{table="inq"} 3' in text
+    assert 'io_queue_backlog{link="a"} 7' in text
+    assert 'io_queue_claim_seconds_bucket{table="inq",le="0.1"} 1' in text
+    assert 'io_queue_claim_seconds_bucket{table="inq",le="1.0"} 2' in text
+    assert 'io_queue_claim_seconds_bucket{table="inq",le="+Inf"} 3' in text
+    assert 'io_queue_claim_seconds_count{table="inq"} 3' in text
+
+    # A name can only have one type
+    try:
+        registry.gauge("io_queue_puts")
+        raise RuntimeError("Expected to raise ValueError")
+    except ValueError:
+        pass
+
+    write_textfile(fn, registry)
+    with open(fn) as fh:
+        assert fh.read() == text
+    os.remove(fn)
+
+
+def test_metrics_serve():
+    from urllib.request import urlopen
+    registry = Registry()
+    registry.counter("io_queue_acks", table="inq").inc()
+    server = serve(port=0, registry=registry)
+    port = server.server_address[1]
+    body = urlopen(f"http://127.0.0.1:{port}/metrics").read().decode()
+    assert 'io_queue_acks_total{table="inq"} 1' in body
+    server.shutdown()
+
+
+def test_queue_metrics(fn="test_metrics.db"):
+    from sqliteack_queue import SQLiteAckQueue
+    if os.path.exists(fn):
+        os.remove(fn)
+    registry = Registry()
+    q = SQLiteAckQueue(fn, table_name="metq", registry=registry, timeout=0.01)
+    q.puts([{'idx': i} for i in range(10)])
+    keys = q.gets(4, return_keys=True)[0]
+    q.acks(keys[:2])
+    time.sleep(0.05)
+    # Two unacked rows are recycled by the timeout
+    assert q.free() == 8
+
+    text = exposition(registry)
+    assert 'io_queue_puts_total{table="metq"} 10' in text
+    assert 'io_queue_claims_total{table="metq"} 4' in text
+    assert 'io_queue_acks_total{table="metq"} 2' in text
+    assert 'io_queue_timeout_recycled_total{table="metq"} 2' in text
+    assert 'io_queue_claim_seconds_count{table="metq"} 1' in text
+    assert 'io_queue_commit_seconds_count{table="metq"}' in text
+    assert 'io_queue_lock_wait_seconds_count{table="metq"}' in text
+    os.remove(fn)
+
+
+if __name__ == '__main__':
+    test_metrics_exposition()
+    test_metrics_serve()
+    test_queue_metrics()
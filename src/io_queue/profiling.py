@@ -0,0 +1,229 @@
+"""
+Opt-in profiling for the SQL that queues run. A QueryProfiler wraps a
+connection so every statement is timed, including fetching its rows,
+and aggregated per statement template (the statement with literals, key
+lists and bound values stripped). Statements slower than
+`slow_threshold` seconds are logged with the number and size of their
+bound parameters. With `trace=True` the sqlite3 trace callback also
+counts statements the driver issues implicitly, such as BEGIN.
+
+`check_query_plans` runs EXPLAIN QUERY PLAN on the core claim, timeout
+and join queries and warns about full table scans and automatic indices.
+"""
+import os
+import re
+import time
+
+from log import logger
+
+
+_RE_IN_LIST = re.compile(r"\bIN\s*\([^)]*\)", re.IGNORECASE)
+_RE_STRING = re.compile(r"'(?:[^']|'')*'")
+_RE_NUMBER = re.compile(r"\b\d+(?:\.\d+)?(?:e[+-]?\d+)?\b", re.IGNORECASE)
+_RE_SPACE = re.compile(r"\s+")
+
+
+def template(sql):
+    """ Reduce a statement to its shape so timings of statements that
+    only differ in literals are aggregated together.
+    """
+    sql = _RE_IN_LIST.sub("IN (...)", sql)
+    sql = _RE_STRING.sub("?", sql)
+    sql = _RE_NUMBER.sub("?", sql)
+    return _RE_SPACE.sub(" ", sql).strip()
+
+
+def _bound_size(params):
+    n_bytes = sum(len(p) for p in params if isinstance(p, (str, bytes)))
+    return len(params), n_bytes
+
+
+class QueryProfiler:
+    def __init__(self, slow_threshold=0.1, trace=False):
+        self.slow_threshold = slow_threshold
+        self.trace = trace
+        # template -> [count, total seconds, max seconds]
+        self.stats = {}
+        # template -> count, as seen by the sqlite3 trace callback
+        self.traced = {}
+
+    def wrap(self, con):
+        if isinstance(con, ProfiledConnection):
+            con = con._con
+        if self.trace:
+            con.set_trace_callback(self._trace)
+        return ProfiledConnection(con, self)
+
+    def _trace(self, sql):
+        key = template(sql)
+        self.traced[key] = self.traced.get(key, 0) + 1
+
+    def record(self, sql, duration, params=(), count=1):
+        key = template(sql)
+        stat = self.stats.get(key)
+        if stat is None:
+            stat = self.stats[key] = [0, 0.0, 0.0]
+        stat[0] += count
+        stat[1] += duration
+        stat[2] = max(stat[2], duration)
+        if duration >= self.slow_threshold:
+            n_params, n_bytes = _bound_size(params)
+            logger.warning(f"Slow query {duration * 1000:.1f} ms ({n_params} params, "
+                           f"{n_bytes} bytes bound): {key[:200]}")
+
+    def report(self, top=20):
+        """ The `top` templates by total time as
+        (template, count, total seconds, max seconds).
+        """
+        rows = [(key, n, total, worst) for (key, (n, total, worst)) in self.stats.items()]
+        rows.sort(key=lambda r: r[2], reverse=True)
+        return rows[:top]
+
+    def reset(self):
+        self.stats.clear()
+        self.traced.clear()
+
+
+class ProfiledCursor:
+    def __init__(self, cursor, profiler, sql, params):
+        self._cursor = cursor
+        self._profiler = profiler
+        self._sql = sql
+        self._params = params
+
+    def _fetch(self, method, *args):
+        t0 = time.perf_counter()
+        ret = method(*args)
+        self._profiler.record(self._sql, time.perf_counter() - t0, self._params, count=0)
+        return ret
+
+    def fetchone(self):
+        return self._fetch(self._cursor.fetchone)
+
+    def fetchall(self):
+        return self._fetch(self._cursor.fetchall)
+
+    def fetchmany(self, *args):
+        return self._fetch(self._cursor.fetchmany, *args)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class ProfiledConnection:
+    """ Times statements run on a sqlite3 connection and forwards
+    everything else to it.
+    """
+    def __init__(self, con, profiler):
+        self._con = con
+        self._profiler = profiler
+
+    def execute(self, sql, params=()):
+        t0 = time.perf_counter()
+        cursor = self._con.execute(sql, params)
+        self._profiler.record(sql, time.perf_counter() - t0, params)
+        return ProfiledCursor(cursor, self._profiler, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        t0 = time.perf_counter()
+        cursor = self._con.executemany(sql, seq_of_params)
+        self._profiler.record(sql, time.perf_counter() - t0)
+        return cursor
+
+    def commit(self):
+        t0 = time.perf_counter()
+        self._con.commit()
+        self._profiler.record("COMMIT", time.perf_counter() - t0)
+
+    def rollback(self):
+        t0 = time.perf_counter()
+        self._con.rollback()
+        self._profiler.record("ROLLBACK", time.perf_counter() - t0)
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+
+def explain(con, sql):
+    """ EXPLAIN QUERY PLAN details of `sql`, one string per plan step.
+    """
+    cursor = con.execute(f"EXPLAIN QUERY PLAN {sql}")
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def _is_full_scan(detail):
+    if "AUTOMATIC" in detail:
+        return True
+    return detail.startswith("SCAN") and "USING" not in detail
+
+
+def check_query_plans(q=None, ioqueues=None):
+    """ Explain the core queries of a queue and/or an IOQueues and warn
+    about steps that scan a whole table. Returns {query name: plan}.
+    """
+    queries = {}
+    if q is not None:
+        queries["_SQL_SELECT"] = (q, q._format_select(1))
+        queries["_SQL_TIMEOUT"] = (q, q._SQL_TIMEOUT.format(table_name=q._TABLE_NAME, timeout=0))
+    if ioqueues is not None and ioqueues.input_q is not None:
+        queries["_SQL_GETS"] = (ioqueues.input_q, ioqueues._format_gets(1))
+    plans = {}
+    for name, (queue, sql) in queries.items():
+        plans[name] = explain(queue.con, sql)
+        for detail in plans[name]:
+            if _is_full_scan(detail):
+                logger.warning(f"{name} on {queue._TABLE_NAME} falls back to a full scan: {detail}")
+    return plans
+
+
+def test_profiler(fn="test_profile.db"):
+    from sqliteack_queue import SQLiteAckQueue
+    if os.path.exists(fn):
+        os.remove(fn)
+    profiler = QueryProfiler(slow_threshold=0, trace=True)
+    q = SQLiteAckQueue(fn, table_name="profq", profiler=profiler)
+    q.puts([{'idx': i, 'name': f"n{i}"} for i in range(10)])
+    keys, _ = q.gets(3, return_keys=True)
+    q.acks(keys)
+    q.acks(keys[:1])
+
+    # Statements differing only in literals share one template
+    templates = [row[0] for row in profiler.report(top=100)]
+    ack = [t for t in templates if t.startswith("UPDATE profq SET status = ? WHERE _id IN")
+           and t.endswith("RETURNING *")]
+    assert len(ack) == 1
+    assert profiler.stats[ack[0]][0] == 2
+    assert "COMMIT" in profiler.stats
+    assert any(t.startswith("INSERT OR IGNORE INTO profq") for t in profiler.traced)
+    assert template("SELECT * FROM t WHERE _id IN (1, 2, 3) AND name = 'a'") == \
+        "SELECT * FROM t WHERE _id IN (...) AND name = ?"
+
+    # Profiling can also be switched on for an open queue
+    q2 = SQLiteAckQueue(fn, table_name="profq2")
+    p2 = q2.enable_profiling()
+    q2.count()
+    assert any("COUNT" in t for t in p2.stats)
+    os.remove(fn)
+
+
+def test_check_query_plans(fn="test_profile.db"):
+    from io_queues import IOQueues
+    if os.path.exists(fn):
+        os.remove(fn)
+    ioq = IOQueues(fn, input_q_name="inq", output_q_name="outq")
+    ioq.load([{'idx': 1}])
+    ioq.puts([{'idx': 1}])
+    plans = check_query_plans(ioq.input_q, ioq)
+    assert set(plans) == {"_SQL_SELECT", "_SQL_TIMEOUT", "_SQL_GETS"}
+    assert all(len(plan) > 0 for plan in plans.values())
+    # Nothing indexes status or timestamp, so the timeout scans the table
+    assert any(_is_full_scan(d) for d in plans["_SQL_TIMEOUT"])
+    os.remove(fn)
+
+
+if __name__ == '__main__':
+    test_profiler()
+    test_check_query_plans()
@@ -0,0 +1,100 @@
+"""
+Codecs for the payload mode of SQLiteAckQueue, which stores each item as
+one serialized BLOB instead of one SQL column per key. A codec is any
+object with `dumps(item) -> bytes | str` and `loads(data) -> item`, so
+modules such as `json` or `pickle` work as they are; `get_serializer`
+also resolves the names below, importing optional libraries lazily.
+
+    json     stdlib, always available
+    orjson   fastest JSON, needs `orjson`
+    msgpack  compact binary, needs `msgpack`
+    pickle   any Python object, protocol 5
+"""
+import json
+import pickle
+
+
+class JsonSerializer:
+    name = "json"
+
+    def dumps(self, item):
+        return json.dumps(item, separators=(",", ":"))
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonSerializer:
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self.dumps = orjson.dumps
+        self.loads = orjson.loads
+
+
+class MsgpackSerializer:
+    name = "msgpack"
+
+    def __init__(self):
+        import msgpack
+        self._packer = msgpack.Packer(use_bin_type=True)
+        self._msgpack = msgpack
+
+    def dumps(self, item):
+        return self._packer.pack(item)
+
+    def loads(self, data):
+        return self._msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+class PickleSerializer:
+    name = "pickle"
+
+    def dumps(self, item):
+        return pickle.dumps(item, protocol=5)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+SERIALIZERS = {
+    'json': JsonSerializer,
+    'orjson': OrjsonSerializer,
+    'msgpack': MsgpackSerializer,
+    'pickle': PickleSerializer,
+}
+
+
+def get_serializer(serializer):
+    """ Resolve a codec name to a codec instance; objects that already
+    have `dumps` and `loads` are returned unchanged.
+    """
+    if isinstance(serializer, str):
+        if serializer not in SERIALIZERS:
+            raise ValueError(f"Unknown serializer {serializer}, expected one of {sorted(SERIALIZERS)}")
+        return SERIALIZERS[serializer]()
+    if not (hasattr(serializer, "dumps") and hasattr(serializer, "loads")):
+        raise ValueError(f"Serializer {serializer} must have dumps and loads")
+    return serializer
+
+
+def test_serializers():
+    item = {'idx': 1, 'nested': {'a': [1, 2.5, "x"]}, 'text': "é"}
+    for name in SERIALIZERS:
+        try:
+            codec = get_serializer(name)
+        except ImportError:
+            # Optional library not installed
+            continue
+        assert codec.loads(codec.dumps(item)) == item
+    assert get_serializer(json) is json
+    try:
+        get_serializer("yaml")
+        raise RuntimeError("Expected to raise ValueError")
+    except ValueError:
+        pass
+
+
+if __name__ == '__main__':
+    test_serializers()
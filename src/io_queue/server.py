@@ -0,0 +1,582 @@
+"""
+A queue server that owns the connection to one database file, so that
+many worker processes no longer contend for its write lock or each
+rediscover the table schemas. Workers use `QueueClient`, which has the
+methods of SQLiteAckQueue, over a Unix domain socket or localhost TCP.
+Link workers use `IOQueuesClient`, which has the methods of IOQueues
+they need, so that the ready anti-join and completions run in the
+server too.
+
+Every message is a frame: a 4 byte big-endian length, one byte naming
+the codec (`m` msgpack, `j` JSON) and the encoded body. Requests are
+`[op, table_name, args, kwargs]`, where the table name of IOQueues
+operations is `[input_q_name, output_q_name, input_q_id_column,
+output_q_id_column]`, and replies are `[True, result]` or
+`[False, error_type, message]`. The server answers in the codec it was
+asked in; clients use msgpack when it is installed.
+
+Requests are applied by a single writer thread. Whatever has queued up
+while it was busy is applied in one transaction, each request inside
+its own savepoint so that a failing request does not undo the others,
+and replies are sent once that transaction has committed. Reads of
+counts and statuses are answered directly from the reader connection.
+"""
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+from types import SimpleNamespace
+
+from log import logger
+
+from io_queues import IOQueues
+
+from serializers import JsonSerializer
+from serializers import MsgpackSerializer
+from sqliteack_queue import AckStatus
+from sqliteack_queue import SQLiteAckQueue
+
+_FRAME = struct.Struct(">Ic")
+
+# Operations that write, and the non-committing queue method of each
+_WRITE_OPS = {
+    'puts': "_puts",
+    'gets': "_gets",
+    'acks': "_acks",
+    'updates': "_updates",
+    'sets': "_sets",
+    'delete': "_delete",
+    'set_priority': "_set_priority",
+}
+_READ_OPS = {"count", "free", "done", "active", "statuses", "active_keys", "stats"}
+# The same for the IOQueues of a link
+_IOQ_WRITE_OPS = {
+    'ioq_gets': "_gets",
+    'ioq_complete': "_complete",
+}
+_IOQ_READ_OPS = {'ioq_size_ready': "size_ready"}
+# Errors re-raised as themselves by the client, anything else is a RuntimeError
+_ERRORS = {e.__name__: e for e in (KeyError, ValueError, TypeError, AssertionError)}
+
+
+def _codecs():
+    codecs = {b"j": JsonSerializer()}
+    try:
+        codecs[b"m"] = MsgpackSerializer()
+    except ImportError:
+        pass
+    return codecs
+
+
+def _encode(codec, obj):
+    data = codec.dumps(obj)
+    return data.encode() if isinstance(data, str) else data
+
+
+def _recv_exactly(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        buf += chunk
+    return bytes(buf)
+
+
+def read_frame(sock):
+    """ Read one frame, returning (codec tag, body bytes). """
+    length, tag = _FRAME.unpack(_recv_exactly(sock, _FRAME.size))
+    return tag, _recv_exactly(sock, length)
+
+
+def write_frame(sock, tag, body):
+    sock.sendall(_FRAME.pack(len(body), tag) + body)
+
+
+def parse_address(address):
+    """ A Unix socket path, or a (host, port) pair for `host:port`. """
+    if isinstance(address, tuple):
+        return address
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return (host or "127.0.0.1", int(port))
+    return address
+
+
+class _Request:
+    __slots__ = ("op", "table_name", "args", "kwargs", "reply", "done")
+
+    def __init__(self, op, table_name, args, kwargs):
+        self.op = op
+        self.table_name = table_name
+        self.args = args
+        self.kwargs = kwargs
+        self.reply = None
+        self.done = threading.Event()
+
+
+class _ServerIOQueues(IOQueues):
+    """ IOQueues over the queues of `server`, so that its joins and
+    completions run on the server's connection.
+    """
+    def __init__(self, server, input_q_name, output_q_name, input_q_id_column=None,
+                 output_q_id_column=None):
+        self.server = server
+        super().__init__(server.path, input_q_name=input_q_name, output_q_name=output_q_name,
+                         input_q_id_column=input_q_id_column,
+                         output_q_id_column=output_q_id_column)
+
+    def queue_class(self, path, table_name=None, **kwargs):
+        return self.server.queue(table_name)
+
+
+class QueueServer:
+    def __init__(self, path, address, queue_kwargs={}, max_batch=1000):
+        if queue_kwargs.get("write_behind"):
+            # Replies must only go out once their batch has committed
+            raise ValueError("QueueServer commits every batch itself; "
+                             "write_behind would reply before the commit")
+        self.path = path
+        self.address = parse_address(address)
+        self.queue_kwargs = queue_kwargs
+        self.max_batch = max_batch
+        self.queues = {}
+        self.ioqueues = {}
+        self.codecs = _codecs()
+        self._requests = queue.Queue()
+        self._queues_lock = threading.Lock()
+        self._ioqueues_lock = threading.Lock()
+        self._writer = None
+        self._server = None
+
+    def queue(self, table_name):
+        """ The queue of `table_name`, opened on first use. All queues
+        share one connection, so a batch commits them together.
+        """
+        q = self.queues.get(table_name)
+        if q is None:
+            with self._queues_lock:
+                q = self.queues.get(table_name)
+                if q is None:
+                    first = next(iter(self.queues.values()), None)
+                    q = SQLiteAckQueue(self.path, table_name=table_name, share_with=first,
+                                       **self.queue_kwargs)
+                    self.queues[table_name] = q
+        return q
+
+    def ioqueue(self, spec):
+        """ The IOQueues of the link `spec`, a list of its input and
+        output queue names and id columns.
+        """
+        spec = tuple(spec)
+        ioq = self.ioqueues.get(spec)
+        if ioq is None:
+            with self._ioqueues_lock:
+                ioq = self.ioqueues.get(spec)
+                if ioq is None:
+                    ioq = _ServerIOQueues(self, *spec)
+                    self.ioqueues[spec] = ioq
+        return ioq
+
+    def _queues_of(self, request):
+        if request.op in _IOQ_WRITE_OPS:
+            ioq = self.ioqueue(request.table_name)
+            return [q for q in (ioq.input_q, ioq.output_q) if q is not None]
+        return [self.queue(request.table_name)]
+
+    def _run_writer(self):
+        while True:
+            batch = [self._requests.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._requests.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            batch = [r for r in batch if r is not None]
+            if batch:
+                self._apply(batch)
+            if stop:
+                return
+
+    def _apply(self, batch):
+        """ Apply `batch` in one transaction and wake up its callers. """
+        queues = [self._queues_of(r) for r in batch]
+        q0 = queues[0][0]
+        with q0._locked():
+            con = q0.con
+            try:
+                if not con.in_transaction:
+                    con.execute("BEGIN")
+                for request, qs in zip(batch, queues):
+                    con.execute("SAVEPOINT request")
+                    try:
+                        result = self._call(request)
+                    except Exception as e:
+                        con.execute("ROLLBACK TO request")
+                        con.execute("RELEASE request")
+                        # Columns added by the failed request are gone too
+                        for q in qs:
+                            q.columns = q.read_columns()
+                            q._codecs.clear()
+                        request.reply = [False, type(e).__name__, str(e)]
+                    else:
+                        con.execute("RELEASE request")
+                        request.reply = [True, result]
+                q0._commit(len(batch))
+            except Exception as e:
+                logger.exception("Failed to commit a batch of requests")
+                if con.in_transaction:
+                    con.rollback()
+                for request in batch:
+                    request.reply = [False, type(e).__name__, str(e)]
+        for request in batch:
+            request.done.set()
+
+    def _call(self, request):
+        if request.op in _IOQ_WRITE_OPS:
+            ioq = self.ioqueue(request.table_name)
+            kwargs = dict(request.kwargs)
+            if kwargs.get("tasks"):
+                kwargs["tasks"] = _task_ref(kwargs["tasks"])
+            result = getattr(ioq, _IOQ_WRITE_OPS[request.op])(*request.args, **kwargs)
+            return list(result) if request.op == "ioq_gets" else result
+        q = self.queue(request.table_name)
+        result = getattr(q, _WRITE_OPS[request.op])(*request.args, **request.kwargs)
+        if request.op == "gets" and request.kwargs.get("return_keys"):
+            return list(result)
+        return result
+
+    def _prepare(self, request):
+        """ Do what must not happen inside a batch, since it may commit:
+        create the output table of a link and attach its tasks file.
+        Returns a reply if there is nothing left to do.
+        """
+        ioq = self.ioqueue(request.table_name)
+        q = ioq.input_q or ioq.output_q
+        with q._locked():
+            if request.op == "ioq_gets" and not ioq._prepare_output():
+                return [True, [[], []]]
+            tasks = request.kwargs.get("tasks")
+            if request.op == "ioq_complete" and tasks:
+                ioq._task_table(q, _task_ref(tasks))
+        return None
+
+    def _read(self, q, op, args, kwargs):
+        if op == "stats":
+            with q.read_snapshot():
+                return {'count': q.count(), 'free': q.free(), 'active': q.active(),
+                        'done': q.done()}
+        return getattr(q, op)(*args, **kwargs)
+
+    def handle(self, op, table_name, args, kwargs):
+        """ Run one request and return its reply. """
+        if op in _READ_OPS or op in _IOQ_READ_OPS:
+            try:
+                if op in _IOQ_READ_OPS:
+                    return [True, getattr(self.ioqueue(table_name), _IOQ_READ_OPS[op])(*args, **kwargs)]
+                return [True, self._read(self.queue(table_name), op, args, kwargs)]
+            except Exception as e:
+                return [False, type(e).__name__, str(e)]
+        if op not in _WRITE_OPS and op not in _IOQ_WRITE_OPS:
+            return [False, "ValueError", f"Unknown operation {op}"]
+        request = _Request(op, table_name, args, kwargs)
+        if op in _IOQ_WRITE_OPS:
+            try:
+                reply = self._prepare(request)
+            except Exception as e:
+                return [False, type(e).__name__, str(e)]
+            if reply is not None:
+                return reply
+        self._requests.put(request)
+        request.done.wait()
+        return request.reply
+
+    def start(self):
+        """ Start serving in background threads and return self. """
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        tag, body = read_frame(self.request)
+                    except ConnectionError:
+                        return
+                    codec = server.codecs.get(tag)
+                    if codec is None:
+                        logger.warning(f"Closing connection with unknown codec {tag}")
+                        return
+                    op, table_name, args, kwargs = codec.loads(body)
+                    reply = server.handle(op, table_name, args, kwargs)
+                    write_frame(self.request, tag, _encode(codec, reply))
+
+        if isinstance(self.address, tuple):
+            server_class = socketserver.ThreadingTCPServer
+        else:
+            server_class = socketserver.ThreadingUnixStreamServer
+            if os.path.exists(self.address):
+                os.remove(self.address)
+        server_class.daemon_threads = True
+        server_class.allow_reuse_address = True
+        self._server = server_class(self.address, Handler)
+        self._writer = threading.Thread(target=self._run_writer, daemon=True)
+        self._writer.start()
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logger.info(f"Serving {self.path} on {self.address}")
+        return self
+
+    def serve_forever(self):
+        self.start()
+        try:
+            self._writer.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            if not isinstance(self.address, tuple) and os.path.exists(self.address):
+                os.remove(self.address)
+            self._server = None
+        if self._writer is not None:
+            self._requests.put(None)
+            self._writer.join()
+            self._writer = None
+        for q in self.queues.values():
+            q.flush()
+
+
+class QueueClient:
+    """ Talks to a `QueueServer` with the methods of SQLiteAckQueue, so
+    workers can switch by replacing the constructor call.
+    """
+    def __init__(self, address, table_name=None, serializer=None):
+        self.address = parse_address(address)
+        self.table_name = table_name
+        codecs = _codecs()
+        self._tag = serializer.encode()[:1] if serializer else ("m" if b"m" in codecs else "j").encode()
+        self.codec = codecs[self._tag]
+        family = socket.AF_INET if isinstance(self.address, tuple) else socket.AF_UNIX
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.connect(self.address)
+        self._lock = threading.Lock()
+
+    def _call(self, op, *args, **kwargs):
+        body = _encode(self.codec, [op, self.table_name, list(args), kwargs])
+        with self._lock:
+            write_frame(self._sock, self._tag, body)
+            _, reply = read_frame(self._sock)
+        reply = self.codec.loads(reply)
+        if reply[0]:
+            return reply[1]
+        _, error_type, message = reply
+        raise _ERRORS.get(error_type, RuntimeError)(message)
+
+    def put(self, item):
+        key, = self.puts([item])
+        return key
+
+    def puts(self, items, return_keys=True, priority=0):
+        return self._call("puts", items, return_keys=return_keys, priority=priority)
+
+    def get(self):
+        return self.gets(1)
+
+    def gets(self, n, random_offset=False, ack=True, return_keys=False, read_all=False):
+        result = self._call("gets", n, ack=ack, return_keys=return_keys, read_all=read_all)
+        return tuple(result) if return_keys else result
+
+    def acks(self, keys, status=AckStatus.acked):
+        return self._call("acks", keys, status)
+
+    def updates(self, keys, status=AckStatus.unack):
+        return self._call("updates", keys, status)
+
+    def set(self, row_key_dict, **field_dict):
+        return self.sets([row_key_dict], [field_dict])
+
+    def sets(self, row_key_dicts, field_dicts):
+        return self._call("sets", row_key_dicts, field_dicts)
+
+    def delete(self, keys):
+        return self._call("delete", keys)
+
+    def set_priority(self, keys, priority):
+        return self._call("set_priority", keys, priority)
+
+    def statuses(self, keys):
+        return {int(k): v for (k, v) in self._call("statuses", keys).items()}
+
+    def active_keys(self, n):
+        return self._call("active_keys", n)
+
+    def count(self):
+        return self._call("count")
+
+    def free(self):
+        return self._call("free")
+
+    def done(self):
+        return self._call("done")
+
+    def active(self):
+        return self._call("active")
+
+    def stats(self):
+        return self._call("stats")
+
+    def close(self):
+        self._sock.close()
+
+
+def _task_ref(tasks):
+    """ Stands in for the task queue `[path, table_name]` of a client. """
+    path, table_name = tasks
+    return SimpleNamespace(path=path, _TABLE_NAME=table_name)
+
+
+class IOQueuesClient:
+    """ Talks to a `QueueServer` with the methods of IOQueues that link
+    workers use, so they can switch by replacing the constructor call.
+    """
+    def __init__(self, address, input_q_name=None, output_q_name=None,
+                 input_q_id_column=None, output_q_id_column=None, batch_size=1,
+                 serializer=None):
+        self.input_q_name = input_q_name
+        self.output_q_name = output_q_name
+        self.batch_size = batch_size
+        spec = [input_q_name, output_q_name, input_q_id_column, output_q_id_column]
+        self._client = QueueClient(address, table_name=spec, serializer=serializer)
+        self.input_q = QueueClient(address, input_q_name, serializer) if input_q_name else None
+        self.output_q = QueueClient(address, output_q_name, serializer) if output_q_name else None
+
+    def gets(self, batch_size=None, return_keys=False):
+        if self.input_q is None:
+            return None
+        keys, items = self._client._call("ioq_gets", batch_size or self.batch_size)
+        return (keys, items) if return_keys else items
+
+    def complete(self, input_keys, output_rows, tasks=None, task_key=None):
+        kwargs = {}
+        if tasks is not None and task_key is not None:
+            # The server attaches the tasks file itself
+            kwargs = dict(tasks=[os.path.abspath(tasks.path), tasks._TABLE_NAME],
+                          task_key=task_key)
+        return self._client._call("ioq_complete", list(input_keys), output_rows, **kwargs)
+
+    def size_ready(self):
+        if self.input_q is None:
+            return 0
+        return self._client._call("ioq_size_ready")
+
+    def acks(self, keys):
+        self.input_q.acks(keys)
+
+    def load(self, rows):
+        return self.input_q.puts(rows)
+
+    def puts(self, rows):
+        self.output_q.puts(rows)
+
+    def close(self):
+        for client in (self._client, self.input_q, self.output_q):
+            if client is not None:
+                client.close()
+
+
+def test_server(n_clients=8, n=50):
+    fn, address = "test_server.db", "test_server.sock"
+    if os.path.exists(fn):
+        os.remove(fn)
+    server = QueueServer(fn, address).start()
+
+    def work(i):
+        client = QueueClient(address, table_name="jobs")
+        client.puts([{'worker': i, 'n': j} for j in range(n)])
+        keys, items = client.gets(n // 2, return_keys=True)
+        client.acks(keys)
+        client.close()
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(n_clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    client = QueueClient(address, table_name="jobs", serializer="json")
+    assert client.stats() == {'count': n_clients * n, 'free': n_clients * n // 2,
+                              'active': n_clients * n // 2, 'done': n_clients * n // 2}
+    key = client.put({'worker': -1, 'n': 0})
+    assert client.statuses([key]) == {key: AckStatus.inited}
+    # A failing request is reported to its caller only
+    try:
+        client.acks([10 ** 9])
+        assert False, "acks of a missing key should fail"
+    except KeyError:
+        pass
+    assert client.count() == n_clients * n + 1
+    client.close()
+
+    # Opening a queue waits for the writer's batch and never commits it
+    jobs = server.queue("jobs")
+    with jobs._locked():
+        jobs._puts([{'worker': -2, 'n': 0}])
+        server.queue("in_batch")
+        opener = threading.Thread(target=server.queue, args=("late",))
+        opener.start()
+        opener.join(0.2)
+        assert opener.is_alive() and jobs.con.in_transaction
+        jobs.con.rollback()
+    opener.join()
+    assert "late" in server.queues
+    server.close()
+    assert not os.path.exists(address)
+    try:
+        QueueServer(fn, address, queue_kwargs=dict(write_behind=True))
+        assert False, "write_behind should be rejected"
+    except ValueError:
+        pass
+    os.remove(fn)
+
+
+def test_ioqueues_server(n=30):
+    fn, fn_tasks, address = "test_server.db", "test_server_tasks.db", "test_server.sock"
+    for f in (fn, fn_tasks):
+        if os.path.exists(f):
+            os.remove(f)
+    server = QueueServer(fn, address).start()
+    link = IOQueuesClient(address, input_q_name="urls", output_q_name="pages", batch_size=10)
+    link.load([{'url': f"{i}.com"} for i in range(n)])
+    assert link.size_ready() == n
+
+    tasks = SQLiteAckQueue(fn_tasks, table_name="tasks_crawl")
+    task_key = tasks.put({'task_index': 0})
+    tasks.con.execute("UPDATE tasks_crawl SET timestamp = 0")
+    tasks.con.commit()
+    # Claims skip inputs already in the output queue and checked out ones
+    keys, batch = link.gets(return_keys=True)
+    assert len(batch) == 10 and link.size_ready() == n - 10
+    assert link.complete(keys, [{'page': item['url']} for item in batch],
+                         tasks=tasks, task_key=task_key)
+    assert link.output_q.count() == 10 and link.input_q.done() == 10
+    # A batch completed twice is rejected and writes nothing
+    assert not link.complete(keys, [{'page': "again"}])
+    assert link.output_q.count() == 10
+    # The task heartbeat was written in the server through the attached file
+    (ts,) = tasks.con.execute("SELECT timestamp FROM tasks_crawl").fetchone()
+    assert ts > 0
+    link.close()
+    server.close()
+    os.remove(fn)
+    os.remove(fn_tasks)
+
+
+if __name__ == '__main__':
+    test_server()
+    test_ioqueues_server()
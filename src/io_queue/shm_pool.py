@@ -0,0 +1,315 @@
+"""
+Hand batches to worker processes through shared memory instead of
+pickling them. Numeric columns and vector columns of equal length are
+stacked into NumPy arrays and copied into one `SharedMemory` block per
+batch; only a small descriptor naming the block, the offsets of the
+arrays and the remaining columns is pickled. Workers get scalar
+columns back as Python numbers, like the thread runtime passes them.
+Vector columns arrive without a copy, as one NumPy row view per item
+instead of a list, so link functions meant for both runtimes should
+treat vectors as sequences (iterate, index, `len`) or call
+`numpy.asarray` on them. Results go back the same way.
+
+Blocks come from a `BlockPool` owned by the coordinator and are reused
+for later batches, including the output blocks workers write into, so
+steady state runs allocate nothing.
+
+`ProcessPoolRunner` drives the links of a `Linker` this way: it claims
+batches in the coordinator, runs the link functions in a process pool
+and completes the batches as results come back. Needs `numpy`.
+"""
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from multiprocessing.shared_memory import SharedMemory
+
+from log import logger
+
+_ALIGN = 64
+_MIN_BLOCK = 1 << 16
+
+# Link functions by name, inherited by forked workers
+_FUNCTIONS = {}
+
+
+def _aligned(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+class BlockPool:
+    """ Shared memory blocks owned by this process, recycled by size. """
+    def __init__(self, max_free_bytes=1 << 30):
+        self.max_free_bytes = max_free_bytes
+        self._free = []
+        self._owned = {}
+
+    def acquire(self, nbytes):
+        """ A free block of at least `nbytes`, created if none fits. """
+        fits = [b for b in self._free if b.size >= nbytes]
+        if fits:
+            block = min(fits, key=lambda b: b.size)
+            self._free.remove(block)
+            return block
+        # Round up to a power of two so blocks fit later batches too
+        size = max(_MIN_BLOCK, 1 << (max(nbytes, 1) - 1).bit_length())
+        block = SharedMemory(create=True, size=size)
+        self._owned[block.name] = block
+        return block
+
+    def adopt(self, name):
+        """ Take ownership of a block created by another process. """
+        if name in self._owned:
+            return self._owned[name]
+        block = SharedMemory(name=name)
+        self._owned[name] = block
+        return block
+
+    def release(self, block):
+        self._free.append(block)
+        free_bytes = sum(b.size for b in self._free)
+        while free_bytes > self.max_free_bytes and self._free:
+            largest = max(self._free, key=lambda b: b.size)
+            self._free.remove(largest)
+            free_bytes -= largest.size
+            self._unlink(largest)
+
+    def _unlink(self, block):
+        del self._owned[block.name]
+        block.close()
+        block.unlink()
+
+    def close(self):
+        for block in list(self._owned.values()):
+            self._unlink(block)
+        self._free = []
+
+
+def _stack(values):
+    """ `values` as one numeric array, or None if they are not numbers
+    or vectors of one length.
+    """
+    import numpy as np
+    first = values[0]
+    if isinstance(first, (bool, str, bytes, dict)) or first is None:
+        return None
+    try:
+        arr = np.asarray(values)
+    except (ValueError, TypeError):
+        return None
+    if arr.dtype.kind not in "iuf" or arr.ndim > 2:
+        return None
+    return arr
+
+
+def pack(items, pool=None, block=None):
+    """ Copy the array columns of `items` into shared memory. Uses
+    `block` if it is large enough, else one from `pool`, else a new
+    block. Returns (descriptor, block used or None).
+    """
+    arrays, offset = [], 0
+    if items:
+        for key in items[0]:
+            if not all(key in item for item in items):
+                continue
+            arr = _stack([item[key] for item in items])
+            if arr is not None:
+                arrays.append((key, offset, arr))
+                offset = _aligned(offset + arr.nbytes)
+    keys = {key for (key, _, _) in arrays}
+    rows = [{k: v for (k, v) in item.items() if k not in keys} for item in items]
+    if not arrays:
+        return {'n': len(items), 'block': None, 'arrays': [], 'rows': rows}, None
+    if block is None or block.size < offset:
+        block = pool.acquire(offset) if pool is not None else SharedMemory(create=True, size=offset)
+    import numpy as np
+    for key, off, arr in arrays:
+        np.ndarray(arr.shape, arr.dtype, buffer=block.buf, offset=off)[...] = arr
+    descriptor = {
+        'n': len(items),
+        'block': block.name,
+        'arrays': [(key, off, arr.dtype.str, arr.shape) for (key, off, arr) in arrays],
+        'rows': rows,
+    }
+    return descriptor, block
+
+
+def unpack(descriptor, block=None, copy=False):
+    """ Items of `descriptor`. Scalar columns are Python numbers; vector
+    values are NumPy views into the shared block, or plain lists with
+    `copy=True`. Returns (items, block); views must be dropped before the
+    block is closed.
+    """
+    import numpy as np
+    items = [dict(row) for row in descriptor['rows']]
+    if descriptor['block'] is None:
+        return items, None
+    if block is None:
+        block = SharedMemory(name=descriptor['block'])
+    for key, off, dtype, shape in descriptor['arrays']:
+        arr = np.ndarray(tuple(shape), np.dtype(dtype), buffer=block.buf, offset=off)
+        values = arr.tolist() if copy or arr.ndim == 1 else arr
+        for item, value in zip(items, values):
+            item[key] = value
+    return items, block
+
+
+def _close(block):
+    try:
+        block.close()
+    except BufferError:
+        # The function kept views of the block; it goes with the process
+        pass
+
+
+def _run_batch(function, descriptor, out_name, kwargs):
+    """ Worker side: run `function` on a shared batch and write its
+    results into the block `out_name` or a new one.
+    """
+    if isinstance(function, str):
+        function = _FUNCTIONS[function]
+    items, block = unpack(descriptor)
+    out_block = SharedMemory(name=out_name) if out_name else None
+    try:
+        out_descriptor, used = pack(function(items, **kwargs) or [], block=out_block)
+    finally:
+        del items
+        if block is not None:
+            _close(block)
+    if out_block is not None:
+        _close(out_block)
+    if used is not None and used is not out_block:
+        _close(used)
+    return out_descriptor
+
+
+class ProcessPoolRunner:
+    """ Runs the links of `linker` that have an input queue in a pool of
+    `max_workers` processes, passing batches through shared memory.
+    """
+    def __init__(self, linker, max_workers=None, max_free_bytes=1 << 30):
+        self.linker = linker
+        self.max_workers = max_workers or os.cpu_count()
+        self.pool = BlockPool(max_free_bytes)
+
+    def _executor(self):
+        if "fork" in multiprocessing.get_all_start_methods():
+            # Forked workers find the link functions in _FUNCTIONS, so
+            # they need not be importable
+            for name, link in self.linker.links.items():
+                _FUNCTIONS[name] = link.inner_function
+            return ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("fork"))
+        return ProcessPoolExecutor(self.max_workers)
+
+    def _submit(self, executor, name, link, keys, batch):
+        descriptor, in_block = pack(batch, pool=self.pool)
+        # Offer a block of the same size for the results
+        out_block = self.pool.acquire(in_block.size) if in_block is not None else None
+        function = name if name in _FUNCTIONS else link.inner_function
+        future = executor.submit(_run_batch, function, descriptor,
+                                 out_block.name if out_block else None, {})
+        return future, (name, link, keys, in_block, out_block)
+
+    def _finish(self, future, name, link, keys, in_block, out_block):
+        try:
+            descriptor = future.result()
+            block = self.pool.adopt(descriptor['block']) if descriptor['block'] else None
+            outputs, _ = unpack(descriptor, block, copy=True)
+            if block is not None and block is not out_block:
+                self.pool.release(block)
+        finally:
+            for b in (in_block, out_block):
+                if b is not None:
+                    self.pool.release(b)
+        if not link.ioqueues.complete(keys, outputs if link.ioqueues.output_q_name else []):
+            logger.warning(f"Discarding batch for {name}: inputs were "
+                           "already completed by another task")
+
+    def run_until_complete(self):
+        """ Process batches until no link has input left. """
+        links = {name: link for (name, link) in self.linker.links.items()
+                 if link.inner_function is not None and link.ioqueues.input_q is not None}
+        pending = {}
+        try:
+            with self._executor() as executor:
+                while True:
+                    for name, link in links.items():
+                        while len(pending) < 2 * self.max_workers:
+                            keys, batch = link.ioqueues.gets(link.batch_size, return_keys=True)
+                            if len(batch) == 0:
+                                break
+                            future, state = self._submit(executor, name, link, keys, batch)
+                            pending[future] = state
+                    if not pending:
+                        break
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._finish(future, *pending.pop(future))
+        finally:
+            for name in links:
+                _FUNCTIONS.pop(name, None)
+
+    def close(self):
+        self.pool.close()
+
+
+def test_pack_roundtrip():
+    import numpy as np
+    pool = BlockPool()
+    items = [{'id': f"r{i}", 'score': i * 0.5, 'n': i, 'vec': [i, i + 1, i + 2]}
+             for i in range(100)]
+    descriptor, block = pack(items, pool=pool)
+    assert [key for (key, *_) in descriptor['arrays']] == ['score', 'n', 'vec']
+    assert descriptor['rows'][0] == {'id': "r0"}
+    views, _ = unpack(descriptor)
+    assert isinstance(views[5]['vec'], np.ndarray) and views[5]['vec'].tolist() == [5, 6, 7]
+    assert type(views[5]['n']) is int and type(views[5]['score']) is float
+    del views
+    copies, _ = unpack(descriptor, block, copy=True)
+    assert copies == items
+    # Released blocks are handed out again
+    pool.release(block)
+    assert pool.acquire(100) is block
+    # Ragged or non-numeric columns travel with the rows
+    descriptor, none = pack([{'v': [1]}, {'v': [1, 2]}, {'v': [3]}])
+    assert none is None and descriptor['rows'][1] == {'v': [1, 2]}
+    pool.close()
+
+
+def test_process_pool_runner(n=140):
+    from linker import Linker
+    for fn in ['test_shm_q.db', 'test_shm_tasks.db']:
+        if os.path.exists(fn):
+            os.remove(fn)
+    l = Linker('test_shm_q.db', 'test_shm_tasks.db')
+
+    @l.link(input_q_name="vec_in", output_q_name="vec_out", batch_size=7)
+    def scale(items, **cfg):
+        # Written for lists and row views alike
+        return [{'idx': item['idx'], 'vector': [2 * v for v in item['vector']],
+                 'pid': os.getpid(), 'int_idx': type(item['idx']) is int}
+                for item in items]
+
+    @l.link(input_q_name="vec_out", output_q_name="vec_sum", batch_size=100)
+    def total(items, **cfg):
+        return [{'idx': item['idx'], 'sum': float(sum(item['vector']))} for item in items]
+
+    l.links['scale'].set_inputs([{'idx': i, 'vector': [1.0, 2.0, float(i)]} for i in range(n)])
+    runner = ProcessPoolRunner(l, max_workers=2)
+    runner.run_until_complete()
+    out = l.links['total'].get_outputs(1000)
+    assert sorted(item['sum'] for item in out) == sorted(2 * (3.0 + i) for i in range(n))
+    scaled = l.links['scale'].get_outputs(1000)
+    assert all(item['pid'] != os.getpid() and item['int_idx'] for item in scaled)
+    # Blocks were recycled: at most an input and an output block per
+    # batch in flight, not one per batch
+    assert len(runner.pool._owned) <= 4 * runner.max_workers < n // 7
+    runner.close()
+    os.remove('test_shm_q.db')
+    os.remove('test_shm_tasks.db')
+
+
+if __name__ == '__main__':
+    test_pack_roundtrip()
+    test_process_pool_runner()
@@ -5,9 +5,20 @@ import math
 import time
 import pickle
 import sqlite3
-import random
-from loguru import logger
-import cachetools.func
+import atexit
+import threading
+import warnings
+import weakref
+from functools import partial
+from contextlib import contextmanager
+from queue import Full
+from queue import Queue
+from log import logger
+
+from metrics import REGISTRY
+from compression import get_compressor
+from dedup import DedupFilter
+from serializers import get_serializer
 
 # Modeled after persist-queue
 # https://github.com/peter-wangxu/persist-queue
@@ -19,9 +30,17 @@ class AckStatus(object):
     unack = "2"  # Message is popped off by receiever has not ack'd
     acked = "5"  # Message is popped and receiver has ack'd; assumed done
     ack_failed = "9" # Reciever has marked message as failed
+    ack_retired = "13" # Message (a task) was asked to stop early
     ack_done = "17" # Reciever has marked explicitly message as done
 
 
+# Statuses of rows whose work is over and which retention may delete
+FINISHED_STATUSES = (AckStatus.acked, AckStatus.ack_done, AckStatus.ack_retired)
+
+# Database path -> (schema_version, {table: columns}) read by this process
+_SCHEMAS = {}
+
+
 class DummySerializer:
     def loads(self, x):
         return x
@@ -55,10 +74,190 @@ class DynamicList(list):
 dummy_serializer = DummySerializer()
 
 
+def _array_column(name):
+    """ Split a flattened array column `vec_dim_0003` into ('vec', 3),
+    or return None for a scalar column.
+    """
+    base, sep, idim = name.rpartition('_dim_')
+    if sep and idim.isdigit():
+        return base, int(idim)
+    return None
+
+
+class RowCodec:
+    """ Converts between item dicts and table rows for one list of
+    column names. The column-index plan is worked out once, so encoding
+    and decoding a row is a handful of list operations instead of string
+    parsing per cell.
+    """
+    __slots__ = ("columns", "scalars", "arrays", "known")
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        # (key, index) of scalar columns and (key, [index per dim]) of
+        # array columns flattened into one column per dimension
+        self.scalars = []
+        dims = {}
+        for i, name in enumerate(self.columns):
+            array = _array_column(name)
+            if array is None:
+                self.scalars.append((name, i))
+            else:
+                dims.setdefault(array[0], []).append((array[1], i))
+        self.arrays = [(key, [i for (_, i) in sorted(d)]) for (key, d) in dims.items()]
+        self.known = frozenset(k for (k, _) in self.scalars) | frozenset(dims)
+
+    def decode(self, rows, skip=()):
+        """ Items of `rows`, leaving out columns named in `skip`. """
+        scalars = [(k, i) for (k, i) in self.scalars if k not in skip]
+        arrays = self.arrays
+        items = []
+        for row in rows:
+            item = {k: row[i] for (k, i) in scalars}
+            for key, indices in arrays:
+                values = [row[i] for i in indices]
+                # Shorter arrays leave the trailing dimensions empty
+                while values and values[-1] is None:
+                    values.pop()
+                item[key] = values
+            items.append(item)
+        return items
+
+    def encode(self, items, timestamp):
+        """ Rows of `timestamp` followed by one value per column. """
+        scalars = self.scalars
+        arrays = self.arrays
+        width = len(self.columns)
+        known = self.known
+        rows = []
+        for n, item in enumerate(items):
+            if not known.issuperset(item):
+                raise AssertionError(f"Extra columns not present in table found in {n}th row")
+            row = [None] * width
+            for key, i in scalars:
+                row[i] = item.get(key)
+            for key, indices in arrays:
+                values = item.get(key)
+                if values is None:
+                    continue
+                if len(values) > len(indices):
+                    raise AssertionError(f"Extra columns not present in table found in {n}th row")
+                for i, value in zip(indices, values):
+                    row[i] = value
+            rows.append([timestamp] + row)
+        return rows
+
+
+class GroupCommitter:
+    """ Defers commits on a connection so that many small writes share
+    one transaction. Pending writes are committed once `flush_size`
+    rows have accumulated or the oldest pending write is
+    `flush_interval` seconds old, whichever comes first.
+    """
+    def __init__(self, con, flush_size=1000, flush_interval=0.05, commit_seconds=None):
+        self.con = con
+        self.commit_seconds = commit_seconds
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.pending = 0
+        self.pending_since = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add(self, n_rows=1):
+        with self.lock:
+            if self.pending_since is None:
+                self.pending_since = time.time()
+            self.pending += n_rows
+            if self.pending >= self.flush_size:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.con.in_transaction:
+                t0 = time.perf_counter()
+                self.con.commit()
+                if self.commit_seconds is not None:
+                    self.commit_seconds.observe(time.perf_counter() - t0)
+            self.pending = 0
+            self.pending_since = None
+
+    def _run(self):
+        # Bound the durability window even when no more writes arrive
+        while not self._stopped.wait(self.flush_interval):
+            since = self.pending_since
+            if since is not None and time.time() - since >= self.flush_interval:
+                self.flush()
+
+    def close(self):
+        self._stopped.set()
+        self.flush()
+        atexit.unregister(self.close)
+
+
+def prefetched(pages, depth=1):
+    """ Run the generator `pages` on a background thread, keeping up to
+    `depth` pages ready ahead of the consumer. Closing the returned
+    generator early stops the thread.
+    """
+    buffer = Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(value):
+        while not stop.is_set():
+            try:
+                buffer.put(value, timeout=0.05)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put(page):
+                    break
+            else:
+                put(end)
+        except BaseException as e:
+            put(e)
+        finally:
+            pages.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            page = buffer.get()
+            if page is end:
+                return
+            if isinstance(page, BaseException):
+                raise page
+            yield page
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _save_dedup_at_exit(ref):
+    q = ref()
+    if q is not None:
+        q.save_dedup()
+
+
 class SQLiteAckQueue:
     columns = []
     _TABLE_NAME = "ack_unique_queue_default"
     _KEY_COLUMN = "_id"
+    _PAYLOAD_COLUMN = "_payload"
+    _INTERNAL_COLUMNS = ("_id", "timestamp", "status")
+    _PRIORITY_COLUMNS = ("_priority", "_rank")
+    # Columns that are never part of an item
+    _HIDDEN_COLUMNS = _INTERNAL_COLUMNS + _PRIORITY_COLUMNS
     _SQL_CREATE_UNIQUE = (
         "CREATE TABLE IF NOT EXISTS {table_name} ("
         "{key_column} INTEGER PRIMARY KEY AUTOINCREMENT, "
@@ -74,10 +273,94 @@ class SQLiteAckQueue:
         "WHERE status < %s "
         "ORDER BY {key_column} ASC LIMIT {limit} OFFSET {offset}" % AckStatus.unack
     )
+    # Matches the partial index on _rank, so claiming reads the index
+    # instead of sorting the table
+    _SQL_SELECT_PRIORITY = (
+        "SELECT {key_column}, timestamp, status {table_columns} FROM {table_name} "
+        "WHERE status < %s "
+        "ORDER BY _rank DESC, {key_column} ASC LIMIT {limit} OFFSET {offset}" % AckStatus.unack
+    )
+    _SQL_CREATE_PRIORITY_INDEX = (
+        "CREATE INDEX IF NOT EXISTS {table_name}_rank "
+        "ON {table_name} (_rank DESC, {key_column}) WHERE status < %s" % AckStatus.unack
+    )
+    _SQL_RANK_BACKFILL = (
+        "UPDATE {table_name} SET _priority = 0, _rank = {rank} WHERE _rank IS NULL"
+    )
+    _SQL_SET_PRIORITY = (
+        "UPDATE {table_name} SET _priority = ?, _rank = {rank} "
+        "WHERE {key_column} IN ({indices})"
+    )
+    # Partial indexes over the waiting and the checked out rows, so the
+    # rows of one group and the number in flight are index lookups
+    _SQL_CREATE_GROUP_INDEX = (
+        "CREATE INDEX IF NOT EXISTS {table_name}_group "
+        "ON {table_name} ({group_column}, {key_column}) WHERE status < %s" % AckStatus.unack
+    )
+    _SQL_CREATE_GROUP_ACTIVE_INDEX = (
+        "CREATE INDEX IF NOT EXISTS {table_name}_group_active "
+        "ON {table_name} ({group_column}) WHERE status = %s" % AckStatus.unack
+    )
+    _SQL_GROUP_ACTIVE = (
+        "SELECT COUNT(*) FROM {table_name} WHERE status = %s AND {group_column} IS ?" % AckStatus.unack
+    )
+    _SQL_GROUP_ACTIVE_COUNTS = (
+        "SELECT {group_column}, COUNT(*) AS n FROM {table_name} "
+        "WHERE status = %s GROUP BY {group_column}" % AckStatus.unack
+    )
+    _SQL_NEXT_GROUP = (
+        "SELECT {group_column} FROM {table_name} WHERE status < %s "
+        "ORDER BY {order_by} LIMIT 1" % AckStatus.unack
+    )
+    # Each group's first waiting row in claim order, from one pass over
+    # the group index, joined with the per group counts of checked out
+    # rows; groups at their cap cost one entry, not a scan of their rows
+    _SQL_NEXT_GROUP_UNDER_CAP = (
+        "SELECT waiting.{group_column} FROM "
+        "(SELECT {group_column}, {first} FROM {table_name} WHERE status < %s "
+        "GROUP BY {group_column}) AS waiting "
+        "LEFT JOIN ({active}) AS active ON active.{group_column} IS waiting.{group_column} "
+        "WHERE IFNULL(active.n, 0) < {group_limit} "
+        "ORDER BY {first_order} LIMIT 1" % AckStatus.unack
+    )
+    _SQL_SELECT_GROUP = (
+        "SELECT {key_column}, timestamp, status {table_columns} FROM {table_name} "
+        "WHERE status < %s AND {group_column} IS ? "
+        "ORDER BY {order_by} LIMIT {limit}" % AckStatus.unack
+    )
     _SQL_SELECT_ALL = (
         "SELECT {key_column}, timestamp, status {table_columns} FROM {table_name} "
         "ORDER BY {key_column} ASC LIMIT {limit} OFFSET {offset}"
     )
+    _SQL_SELECT_RANGE = (
+        "SELECT {key_column}, timestamp, status {table_columns} FROM {table_name} "
+        "WHERE status < %s AND {key_column} >= ? AND {key_column} < ? "
+        "ORDER BY {key_column} ASC LIMIT {limit}" % AckStatus.unack
+    )
+    _SQL_KEY_RANGE = "SELECT MIN({key_column}), MAX({key_column}) FROM {table_name}"
+    # Only rows still waiting are claimed, so two consumers that selected
+    # the same row cannot both check it out
+    _SQL_CLAIM = (
+        "UPDATE {table_name} SET status = %s "
+        "WHERE {key_column} IN ({indices}) AND status < %s "
+        "RETURNING {key_column}" % (AckStatus.unack, AckStatus.unack)
+    )
+    _SQL_CREATE_CONSUMERS = (
+        "CREATE TABLE IF NOT EXISTS {table_name}_consumers ("
+        "consumer_id TEXT PRIMARY KEY, timestamp FLOAT)"
+    )
+    _SQL_CONSUMER_HEARTBEAT = (
+        "INSERT OR REPLACE INTO {table_name}_consumers (consumer_id, timestamp) VALUES (?, ?)"
+    )
+    _SQL_CONSUMERS = (
+        "SELECT consumer_id FROM {table_name}_consumers WHERE timestamp > ? ORDER BY consumer_id"
+    )
+    _SQL_UNREGISTER_CONSUMER = "DELETE FROM {table_name}_consumers WHERE consumer_id = ?"
+    _SQL_ITER = (
+        "SELECT {key_column}, timestamp, status {table_columns} FROM {table_name} "
+        "WHERE {key_column} > ? {where} "
+        "ORDER BY {key_column} ASC LIMIT {limit}"
+    )
     _SQL_MARK_ACK_SELECT = """
         SELECT _id, data FROM {table_name}
         WHERE {key_column} IN ({indices})
@@ -101,6 +384,20 @@ class SQLiteAckQueue:
         " VALUES (?, %s, {table_values}) " 
         " RETURNING {key_column} " % AckStatus.inited
     )
+    _SQL_INSERT_MANY = (
+        "INSERT OR IGNORE INTO {table_name} (timestamp, status, {table_columns})"
+        " VALUES (?, %s, {table_values}) " % AckStatus.inited
+    )
+    _SQL_STATUSES = """
+        SELECT {key_column}, status FROM {table_name}
+        WHERE {key_column} IN ({indices})
+    """
+    _SQL_ACTIVE_KEYS = (
+        "SELECT {key_column} FROM {table_name} "
+        "WHERE status < %s "
+        "ORDER BY {key_column} DESC LIMIT {limit}" % AckStatus.ack_failed
+    )
+    _SQL_HEARTBEAT = "UPDATE {table_name} SET timestamp = ? WHERE {key_column} = ?"
     _SQL_COUNT = "SELECT COUNT(*) FROM {table_name}"
     _SQL_FREE = "SELECT COUNT(*) FROM {table_name} WHERE status < %s" % AckStatus.unack
     _SQL_DONE = "SELECT COUNT(*) FROM {table_name} WHERE status > %s" % AckStatus.unack
@@ -114,12 +411,53 @@ class SQLiteAckQueue:
         AckStatus.ready,
         AckStatus.unack,
     )
+    _SQL_CLEAR_ACKED = """
+        DELETE FROM {table_name}
+        WHERE status IN ({statuses}) AND timestamp < ?
+    """
+    _SQL_SELECT_PAYLOAD = (
+        "SELECT {key_column}, {payload_column} FROM {table_name} WHERE {row_id_col} = ?"
+    )
+    _SQL_UPDATE_PAYLOAD = "UPDATE {table_name} SET {assignments} WHERE {key_column} = ?"
+    _SQL_DEDUP_WARM = (
+        "SELECT {key_column}, {unique_column} FROM {table_name} WHERE {key_column} > ?"
+    )
+    _SQL_DEDUP_CHECK = (
+        "SELECT {unique_column} FROM {table_name} WHERE {unique_column} IN ({values})"
+    )
+    _SQL_MAX_KEY = "SELECT MAX({key_column}) FROM {table_name}"
+    _SQL_ATTACH = "ATTACH DATABASE ? AS {schema}"
     _SQL_CREATE_COLUMN = "ALTER TABLE {table_name} ADD {column_name} {column_type}"
+    _SQL_CREATE_INDEX = (
+        "CREATE INDEX IF NOT EXISTS {table_name}_{column_name} ON {table_name} ({column_name})"
+    )
     _SQL_READ_COLUMNS = "PRAGMA table_info({table_name})"
+    # Columns of every queue table, valid while the schema_version they
+    # were recorded at is current; saves the DDL and table_info queries
+    # when opening a queue
+    _SQL_CREATE_CATALOG = (
+        "CREATE TABLE IF NOT EXISTS _io_queue_catalog ("
+        "table_name TEXT PRIMARY KEY, columns TEXT, schema_version INTEGER)"
+    )
+    _SQL_CATALOG_SELECT = "SELECT columns, schema_version FROM _io_queue_catalog WHERE table_name = ?"
+    _SQL_CATALOG_SELECT_ALL = "SELECT table_name, columns, schema_version FROM _io_queue_catalog"
+    _SQL_CATALOG_UPSERT = (
+        "INSERT OR REPLACE INTO _io_queue_catalog (table_name, columns, schema_version) "
+        "VALUES (?, ?, ?)"
+    )
+    _SQL_SCHEMA_VERSION = "PRAGMA schema_version"
+    _SQL_TABLE_EXISTS = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
 
     _con = None
+    _reader = None
+    _approx_count = None
+    _created = True
+    group_column = None
+    group_limit = None
+    _pinned = False
     _last_count_update = -1
     last_timeout_application = 0
+    consumer_id = None
     serializer = json
 
     def __init__(
@@ -131,103 +469,799 @@ class SQLiteAckQueue:
         delete_on_ack=False,
         serializer=json,
         table_name=None,
+        share_with=None,
+        write_behind=False,
+        flush_size=1000,
+        flush_interval=0.05,
+        registry=None,
+        profiler=None,
+        payload=False,
+        promoted_columns=(),
+        compress=None,
+        compress_columns=None,
+        priorities=False,
+        aging_interval=None,
+        dedup=False,
+        wal=False,
+        mmap_size=0,
+        group_column=None,
+        group_limit=None,
     ):
         self.timeout = timeout
+        self.profiler = profiler
         self.path = path
         self.max_size = max_size
         self.delete_on_ack = delete_on_ack
         self.serializer = serializer
+        self.unique_column = unique_column
+        # Stats and scans run on a separate read-only connection, which
+        # may memory map up to `mmap_size` bytes of the file
+        self.mmap_size = mmap_size
+        self._reader_lock = threading.RLock()
+        # Large text/blob values of `compress_columns` (all columns if
+        # None, the payload in payload mode) are stored compressed
+        self.compressor = get_compressor(compress)
+        self.compress_columns = compress_columns
+        # Row codecs per list of column names, dropped whenever the
+        # table schema changes
+        self._codecs = {}
         if table_name:
             self._TABLE_NAME = table_name
+        self._init_metrics(registry or REGISTRY)
         self.sql = self._SQL_CREATE_UNIQUE if unique_column else self._SQL_CREATE
-        self.con.execute(
-            self.sql.format(table_name=self._TABLE_NAME, key_column=self._KEY_COLUMN,
-                            unique_column=unique_column)
-        )
-        self.columns = self.read_columns()
-        if unique_column and unique_column not in self.columns:
-            self.columns.append(unique_column)
-        self.con.commit()
+        # Queues on the same file may share one connection (and its
+        # write-behind buffer) so that writes to several tables can be
+        # committed together
+        if share_with is not None:
+            con = share_with.con
+            self._committer = share_with._committer
+            self._lock = share_with._lock
+            self._attachments = share_with._attachments
+        else:
+            con = self.con
+            # Database path -> schema name, for files attached to `con`
+            self._attachments = {}
+            if wal:
+                # Readers then never block the writer and vice versa
+                con.execute("PRAGMA journal_mode=WAL")
+            self._committer = None
+            if write_behind:
+                self._committer = GroupCommitter(con, flush_size, flush_interval,
+                                                 commit_seconds=self._m_commit_seconds)
+            self._lock = self._committer.lock if self._committer else threading.RLock()
+        self._con = con
+        # Handler threads of a queue server open queues on the shared
+        # connection while its writer has a batch open
+        with self._locked():
+            in_transaction = con.in_transaction
+            # A table that does not exist yet is not created by opening
+            # the queue but on first access, a read such as count() as
+            # much as a write; payload and priority queues need their
+            # extra columns right away and create it here
+            columns = self._load_schema(con)
+            self._created = columns is not None
+            self.columns = columns or []
+            if unique_column and unique_column not in self.columns:
+                self.columns.append(unique_column)
+            # In payload mode each item is stored whole as one serialized
+            # BLOB; only the promoted columns are real, indexed SQL columns
+            self.payload = payload
+            if payload:
+                self.codec = get_serializer(serializer)
+                self.promoted_columns = list(promoted_columns)
+                if unique_column and unique_column not in self.promoted_columns:
+                    self.promoted_columns.insert(0, unique_column)
+                if self._PAYLOAD_COLUMN not in self.columns:
+                    self.create_column(self._PAYLOAD_COLUMN, b"")
+            # Rows are claimed by priority, highest first. With aging every
+            # `aging_interval` seconds of waiting counts as one more level,
+            # which is folded into a static rank at insert so it can be
+            # indexed: priority + age / interval orders like
+            # priority - insert time / interval
+            self.priorities = priorities
+            self.aging_interval = aging_interval
+            if priorities:
+                self._init_priorities()
+            # A claim returns rows sharing one value of `group_column`, and
+            # at most `group_limit` rows of a group are checked out at once
+            self.group_column = group_column
+            self.group_limit = group_limit
+            if group_column and group_column in self.columns and self._created:
+                self._init_group_index()
+            # Pass `dedup=True`, or a dict of DedupFilter kwargs, to drop
+            # duplicate unique values in memory before they reach SQL
+            self._dedup = None
+            if dedup:
+                if not unique_column:
+                    raise ValueError("dedup needs a unique_column")
+                self._dedup = DedupFilter(**(dedup if isinstance(dedup, dict) else {}))
+                self.dedup_path = None if path == ":memory:" else f"{path}.{self._TABLE_NAME}.bloom"
+                self._warm_dedup()
+                if self.dedup_path:
+                    # Only a weak reference, so that exit does not keep every
+                    # queue ever opened alive
+                    self._save_at_exit = partial(_save_dedup_at_exit, weakref.ref(self))
+                    atexit.register(self._save_at_exit)
+            # Never commit a transaction of the connection we joined
+            if not in_transaction:
+                con.commit()
+
+    def _load_schema(self, con):
+        """ Columns of the table, from the catalog if the schema has not
+        changed since they were recorded, or None if there is no table.
+        """
+        # Unlike any query of a table, this does not make a new
+        # connection parse the whole schema
+        (version,), = con.execute(self._SQL_SCHEMA_VERSION).fetchall()
+        if self.path == ":memory:":
+            schemas = self._catalog(con, version)
+        else:
+            cached = _SCHEMAS.get(os.path.abspath(self.path))
+            if cached is None or cached[0] != version:
+                cached = (version, self._catalog(con, version))
+                _SCHEMAS[os.path.abspath(self.path)] = cached
+            schemas = cached[1]
+        if self._TABLE_NAME in schemas:
+            return list(schemas[self._TABLE_NAME])
+        if con.execute(self._SQL_TABLE_EXISTS, (self._TABLE_NAME,)).fetchone() is None:
+            return None
+        con.execute(self._SQL_CREATE_CATALOG)
+        # Read the version first: a change made meanwhile by someone
+        # else then leaves an entry that never matches
+        (version,), = con.execute(self._SQL_SCHEMA_VERSION).fetchall()
+        columns = self._read_columns(con)
+        self._save_schema(columns, version)
+        return columns
+
+    def _catalog(self, con, version):
+        """ Columns of every table in the catalog that were recorded at
+        schema `version`, by table name.
+        """
+        try:
+            rows = con.execute(self._SQL_CATALOG_SELECT_ALL).fetchall()
+        except sqlite3.OperationalError:
+            return {}
+        return {table: json.loads(columns) for (table, columns, v) in rows if v == version}
+
+    def _save_schema(self, columns, version=None):
+        """ Record `columns` in the catalog, at the current schema
+        version unless given.
+        """
+        con = self._con
+        if version is None:
+            (version,), = con.execute(self._SQL_SCHEMA_VERSION).fetchall()
+        con.execute(self._SQL_CATALOG_UPSERT, (self._TABLE_NAME, json.dumps(columns), version))
+        if self.path != ":memory:":
+            path = os.path.abspath(self.path)
+            if _SCHEMAS.get(path, (None,))[0] != version:
+                _SCHEMAS[path] = (version, {})
+            _SCHEMAS[path][1][self._TABLE_NAME] = list(columns)
+
+    def _ensure_table(self):
+        """ Create the table now if that was deferred. Every access
+        through `con` or `reader` calls this, so reads create it too.
+        """
+        if not self._created:
+            self._connect()
+            with self._locked():
+                if not self._created:
+                    self._create_table()
+
+    def _create_table(self):
+        con = self._con
+        in_transaction = con.in_transaction
+        con.execute(self._SQL_CREATE_CATALOG)
+        exists = con.execute(self._SQL_TABLE_EXISTS, (self._TABLE_NAME,)).fetchone() is not None
+        con.execute(self.sql.format(table_name=self._TABLE_NAME, key_column=self._KEY_COLUMN,
+                                    unique_column=self.unique_column))
+        if exists:
+            # Another queue object created the table since we looked, and
+            # may have added columns
+            self.columns = self._read_columns(con)
+            self._codecs.clear()
+        self._save_schema(self.columns)
+        if self.group_column in self.columns:
+            self._init_group_index()
+        # Commit unless this joined a transaction of the caller's
+        if not in_transaction:
+            con.commit()
+        self._created = True
+
+    def _warm_dedup(self):
+        """ Load the saved filter and add the rows inserted since. """
+        if self.dedup_path:
+            self._dedup.load(self.dedup_path)
+        query = self._SQL_DEDUP_WARM.format(table_name=self._TABLE_NAME,
+                                            key_column=self._KEY_COLUMN,
+                                            unique_column=self.unique_column)
+        cursor = self.con.execute(query, (self._dedup.max_key,))
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows:
+                break
+            for key, value in rows:
+                if value is not None:
+                    self._dedup.add(str(value))
+            self._dedup.max_key = max(self._dedup.max_key, rows[-1][0])
+
+    def save_dedup(self):
+        """ Save the dedup filter next to the database. """
+        if self._dedup is None or not self.dedup_path:
+            return
+        with self._locked():
+            query = self._SQL_MAX_KEY.format(table_name=self._TABLE_NAME,
+                                             key_column=self._KEY_COLUMN)
+            (max_key,) = self.con.execute(query).fetchone()
+        # Rows other processes added are not in the filter, but filter
+        # misses still go through INSERT OR IGNORE so that only costs time
+        self._dedup.max_key = max_key or 0
+        self._dedup.save(self.dedup_path)
+
+    def _drop_duplicates(self, items, priority):
+        """ Items whose unique value is not yet in the table, the
+        matching priorities and the unique values to remember.
+        """
+        column = self.unique_column
+        values = [None if item.get(column) is None else str(item[column]) for item in items]
+        _, maybe_seen = self._dedup.split(dict.fromkeys(v for v in values if v is not None))
+        known = set()
+        # Filter hits are only probable duplicates, look them up
+        for start in range(0, len(maybe_seen), 500):
+            chunk = maybe_seen[start:start + 500]
+            query = self._SQL_DEDUP_CHECK.format(table_name=self._TABLE_NAME,
+                                                 unique_column=column,
+                                                 values=", ".join("?" for _ in chunk))
+            for (value,) in self.con.execute(query, chunk).fetchall():
+                known.add(str(value))
+        priorities = priority if isinstance(priority, (list, tuple)) else None
+        kept, kept_priorities, added = [], [], {}
+        for i, (item, value) in enumerate(zip(items, values)):
+            if value is not None:
+                if value in known or value in added:
+                    continue
+                added[value] = None
+            kept.append(item)
+            if priorities is not None:
+                kept_priorities.append(priorities[i])
+        self._m_dedup_dropped.inc(len(items) - len(kept))
+        return kept, kept_priorities if priorities is not None else priority, list(added)
+
+    def _init_priorities(self):
+        con = self.con
+        table_columns = [row[1] for row in con.execute(
+            self._SQL_READ_COLUMNS.format(table_name=self._TABLE_NAME)).fetchall()]
+        for name, v_type in zip(self._PRIORITY_COLUMNS, ("INTEGER", "REAL")):
+            if name not in table_columns:
+                con.execute(self._SQL_CREATE_COLUMN.format(table_name=self._TABLE_NAME,
+                                                           column_name=name, column_type=v_type))
+        con.execute(self._SQL_RANK_BACKFILL.format(table_name=self._TABLE_NAME,
+                                                   rank=self._rank_sql("0")))
+        con.execute(self._SQL_CREATE_PRIORITY_INDEX.format(table_name=self._TABLE_NAME,
+                                                           key_column=self._KEY_COLUMN))
+
+    def _init_group_index(self):
+        fmt = dict(table_name=self._TABLE_NAME, key_column=self._KEY_COLUMN,
+                   group_column=self.group_column)
+        self._con.execute(self._SQL_CREATE_GROUP_INDEX.format(**fmt))
+        if self.group_limit:
+            self._con.execute(self._SQL_CREATE_GROUP_ACTIVE_INDEX.format(**fmt))
+
+    def _rank_sql(self, priority):
+        """ SQL for the rank of a row with SQL expression `priority`. """
+        if self.aging_interval:
+            return f"{priority} - timestamp / {float(self.aging_interval)}"
+        return priority
+
+    def _init_metrics(self, registry):
+        table = self._TABLE_NAME
+        self._m_puts = registry.counter("io_queue_puts", "Rows inserted", table=table)
+        self._m_claims = registry.counter("io_queue_claims", "Rows claimed", table=table)
+        self._m_acks = registry.counter("io_queue_acks", "Rows acked", table=table)
+        self._m_recycled = registry.counter(
+            "io_queue_timeout_recycled", "Unacked rows returned to the queue by the timeout",
+            table=table)
+        self._m_claim_seconds = registry.histogram(
+            "io_queue_claim_seconds", "Time to claim a batch", table=table)
+        self._m_commit_seconds = registry.histogram(
+            "io_queue_commit_seconds", "Time spent in commit", table=table)
+        self._m_dedup_dropped = registry.counter(
+            "io_queue_dedup_dropped", "Duplicate rows dropped before reaching SQL", table=table)
+        self._m_lock_wait = registry.histogram(
+            "io_queue_lock_wait_seconds", "Time waiting for the queue lock", table=table)
+
+    @contextmanager
+    def _locked(self):
+        t0 = time.perf_counter()
+        with self._lock:
+            self._m_lock_wait.observe(time.perf_counter() - t0)
+            yield
 
     @property
     def con(self):
         self.apply_timeout()
-        if self._con is None:
-            self._con = sqlite3.connect(self.path)
+        self._connect()
+        self._ensure_table()
         return self._con
 
+    def _connect(self):
+        if self._con is None:
+            # The write-behind flusher commits from its own thread
+            self._con = sqlite3.connect(self.path, check_same_thread=False)
+            if self.profiler is not None:
+                self._con = self.profiler.wrap(self._con)
+
+    @property
+    def reader(self):
+        """ A read-only connection for stats and scans. """
+        if self._reader is None:
+            # The file and table must exist before they can be read
+            self._ensure_table()
+            uri = f"file:{os.path.abspath(self.path)}?mode=ro"
+            # Autocommit, so only read_snapshot ever holds a transaction
+            self._reader = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                                           isolation_level=None)
+            if self.mmap_size:
+                self._reader.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+            for path, schema in self._attachments.items():
+                self._reader.execute(self._SQL_ATTACH.format(schema=schema), (f"file:{path}?mode=ro",))
+            if self.profiler is not None:
+                self._reader = self.profiler.wrap(self._reader)
+        return self._reader
+
+    def attach(self, path):
+        """ Make the tables of the database file at `path` visible to
+        this queue's connections and return the schema name to qualify
+        them with. Pending write-behind rows are committed first since
+        SQLite cannot attach inside a transaction.
+        """
+        path = os.path.abspath(path)
+        if path == os.path.abspath(self.path):
+            return "main"
+        if path not in self._attachments:
+            schema = f"db{len(self._attachments)}"
+            with self._locked():
+                if self.con.in_transaction:
+                    self.con.commit()
+                self.con.execute(self._SQL_ATTACH.format(schema=schema), (path,))
+            if self._reader is not None:
+                with self._reader_lock:
+                    self._reader.execute(self._SQL_ATTACH.format(schema=schema),
+                                         (f"file:{path}?mode=ro",))
+            self._attachments[path] = schema
+        return self._attachments[path]
+
+    def _use_reader(self):
+        """ Whether the reader sees what the writer sees, i.e. this
+        queue has no uncommitted writes of its own.
+        """
+        if self._pinned:
+            return True
+        if self.path == ":memory:" or self._committer is not None:
+            return False
+        return self._con is None or not self._con.in_transaction
+
+    def _read(self, query, params=()):
+        """ Run a read-only query and return all its rows. """
+        self._ensure_table()
+        self.apply_timeout()
+        if self._use_reader():
+            with self._reader_lock:
+                return self.reader.execute(query, params).fetchall()
+        with self._locked():
+            return self.con.execute(query, params).fetchall()
+
+    @contextmanager
+    def read_snapshot(self):
+        """ Pin one snapshot of the database for all stats and scans in
+        the block, so they are consistent with each other. In WAL mode
+        writers carry on meanwhile.
+        """
+        with self._reader_lock:
+            con = self.reader
+            con.execute("BEGIN")
+            # The snapshot is taken by the first read
+            con.execute(self._SQL_COUNT.format(table_name=self._TABLE_NAME)).fetchone()
+            self._pinned = True
+            try:
+                yield self
+            finally:
+                self._pinned = False
+                con.execute("COMMIT")
+
+    def enable_profiling(self, profiler=None, **kwargs):
+        """ Time every statement on this queue's connection. Returns the
+        `QueryProfiler` collecting the timings.
+        """
+        from profiling import QueryProfiler
+        self.profiler = profiler or QueryProfiler(**kwargs)
+        if self._con is not None:
+            self._con = self.profiler.wrap(self._con)
+        return self.profiler
+
     def get(self):
         return self.gets(1)
 
     def gets(self, n, random_offset=False, ack=True, return_keys=False,
              read_all=False):
-        offset = 0
+        t0 = time.perf_counter()
+        with self._locked():
+            ret = self._gets(n, random_offset=random_offset, ack=ack,
+                             return_keys=return_keys, read_all=read_all)
+            self._commit(len(ret[0]) if return_keys else len(ret))
+        self._m_claim_seconds.observe(time.perf_counter() - t0)
+        return ret
+
+    def _gets(self, n, random_offset=False, ack=True, return_keys=False,
+              read_all=False):
+        """ Select and check out up to `n` items without committing. """
         if random_offset:
-            offset = random.randint(0, n * 100)
+            warnings.warn("random_offset is deprecated, call register_consumer() instead",
+                          DeprecationWarning, stacklevel=3)
+            if self.consumer_id is None:
+                self.register_consumer()
         # Select rows to update
-        rows = self.select(n, offset, read_all=read_all)
-        # Skip the id & timestamp  & status fields by only
-        # reading from the 3rd field onward
-        items = self._process_rows(rows)
-        items = self.unflatten_array_columns(items)
-        keys = [row[0] for row in rows]
+        if self.group_column is not None and not read_all:
+            rows = self._select_group(n)
+        elif self.consumer_id is not None and not read_all and not self.priorities:
+            rows = self._select_partitioned(n)
+        else:
+            rows = self.select(n, read_all=read_all)
         # Mark them as checked out
-        if ack:
-            self.updates(keys, AckStatus.unack)
-        self.con.commit()
+        if ack and not read_all:
+            claimed = self._claim([row[0] for row in rows])
+            if len(claimed) < len(rows):
+                rows = [row for row in rows if row[0] in claimed]
+            self._m_claims.inc(len(rows))
+        elif ack:
+            self._updates([row[0] for row in rows], AckStatus.unack)
+            self._m_claims.inc(len(rows))
+        items = self._items_from_rows(list(self._INTERNAL_COLUMNS) + self.columns, rows)
+        keys = [row[0] for row in rows]
         if return_keys:
             return keys, items
         return items
 
-    def _process_rows(self, rows):
-        items = [{k: v for (k, v) in zip(self.columns, row[3:])} for row in rows]
-        return items
+    def _claim(self, keys):
+        """ Check out those of `keys` that are still waiting and return
+        the set of keys claimed.
+        """
+        if len(keys) == 0:
+            return set()
+        qclaim = self._SQL_CLAIM.format(table_name=self._TABLE_NAME,
+                                        key_column=self._KEY_COLUMN,
+                                        indices=",".join(str(k) for k in keys))
+        return {key for (key,) in self.con.execute(qclaim).fetchall()}
+
+    def register_consumer(self, consumer_id=None, refresh=5.0):
+        """ Join the consumers of this table. Each registered consumer
+        claims from its own contiguous slice of the key space and only
+        steals from the other slices once its own is drained, so parallel
+        consumers rarely select the same rows. Slices are recomputed
+        every `refresh` seconds as consumers come and go; consumers that
+        stop refreshing drop out after `timeout` seconds.
+        """
+        from uuid import uuid4
+        self.consumer_id = consumer_id or uuid4().hex
+        self._consumer_refresh = refresh
+        self._partition_refreshed = 0
+        self._claim_cursor = None
+        with self._locked():
+            self.con.execute(self._SQL_CREATE_CONSUMERS.format(table_name=self._TABLE_NAME))
+            self._refresh_partition()
+            self._commit()
+        return self.consumer_id
+
+    def unregister_consumer(self):
+        if self.consumer_id is None:
+            return
+        with self._locked():
+            self.con.execute(self._SQL_UNREGISTER_CONSUMER.format(table_name=self._TABLE_NAME),
+                             (self.consumer_id,))
+            self._commit()
+        self.consumer_id = None
+
+    def _refresh_partition(self):
+        now = time.time()
+        if now - self._partition_refreshed < self._consumer_refresh:
+            return
+        table_name = self._TABLE_NAME
+        self.con.execute(self._SQL_CONSUMER_HEARTBEAT.format(table_name=table_name),
+                         (self.consumer_id, now))
+        expired = now - max(self.timeout, 3 * self._consumer_refresh)
+        live = [c for (c,) in self.con.execute(self._SQL_CONSUMERS.format(table_name=table_name),
+                                               (expired,)).fetchall()]
+        self.consumer_index, self.n_consumers = live.index(self.consumer_id), len(live)
+        self._partition_refreshed = now
+
+    def _select_range(self, start, end, n):
+        if n <= 0 or start >= end:
+            return []
+        query = self._SQL_SELECT_RANGE.format(
+            table_name=self._TABLE_NAME,
+            key_column=self._KEY_COLUMN,
+            table_columns="".join("," + c for c in self.columns),
+            limit=n,
+        )
+        return self.con.execute(query, (start, end)).fetchall()
+
+    def _select_partitioned(self, n):
+        """ Select up to `n` waiting rows, preferring this consumer's
+        slice of the key space.
+        """
+        self._refresh_partition()
+        lo, hi = self.con.execute(self._SQL_KEY_RANGE.format(table_name=self._TABLE_NAME,
+                                                             key_column=self._KEY_COLUMN)).fetchone()
+        if lo is None:
+            return []
+        span = hi + 1 - lo
+        start = lo + span * self.consumer_index // self.n_consumers
+        end = lo + span * (self.consumer_index + 1) // self.n_consumers
+        # Continue after the last row claimed in our slice rather than
+        # walking over the rows we already finished
+        cursor = self._claim_cursor
+        if cursor is None or not start <= cursor < end:
+            cursor = start
+        rows = self._select_range(cursor, end, n)
+        if rows:
+            self._claim_cursor = rows[-1][0] + 1
+        # Rows behind the cursor may have been recycled by the timeout
+        rows += self._select_range(start, cursor, n - len(rows))
+        # Steal from the other slices once ours is drained
+        rows += self._select_range(end, hi + 1, n - len(rows))
+        rows += self._select_range(lo, start, n - len(rows))
+        return rows
+
+    def _items_from_rows(self, names, rows):
+        """ Turn selected rows with column `names` back into items. """
+        if self.payload:
+            i_payload = names.index(self._PAYLOAD_COLUMN)
+            loads = self.codec.loads
+            if self.compressor is not None:
+                decompress = self.compressor.decompress
+                return [loads(decompress(row[i_payload])) for row in rows]
+            return [loads(row[i_payload]) for row in rows]
+        if self.compressor is not None:
+            rows = self._decompress_rows(names, rows)
+        return self._row_codec(names).decode(rows, skip=self._HIDDEN_COLUMNS)
+
+    def _row_codec(self, names):
+        names = tuple(names)
+        codec = self._codecs.get(names)
+        if codec is None:
+            codec = self._codecs[names] = RowCodec(names)
+        return codec
+
+    def _compressed_indices(self, names):
+        return [i for (i, name) in enumerate(names)
+                if name not in self._HIDDEN_COLUMNS
+                and (self.compress_columns is None or name in self.compress_columns)]
+
+    def _compress_rows(self, names, rows):
+        compress = self.compressor.compress
+        indices = self._compressed_indices(names)
+        for row in rows:
+            for i in indices:
+                row[i] = compress(row[i])
+        return rows
+
+    def _decompress_rows(self, names, rows):
+        decompress = self.compressor.decompress
+        indices = self._compressed_indices(names)
+        rows = [list(row) for row in rows]
+        for row in rows:
+            for i in indices:
+                row[i] = decompress(row[i])
+        return rows
+
+    def _select_group(self, n):
+        """ Up to `n` waiting rows of the first group in claim order that
+        is below its cap.
+        """
+        if self.group_column not in self.columns:
+            # No row has a group yet
+            return self.select(n)
+        fmt = dict(table_name=self._TABLE_NAME, key_column=self._KEY_COLUMN,
+                   group_column=self.group_column)
+        order_by = f"_rank DESC, {self._KEY_COLUMN}" if self.priorities else self._KEY_COLUMN
+        if self.group_limit:
+            first, first_order = self._group_first(self._TABLE_NAME)
+            query = self._SQL_NEXT_GROUP_UNDER_CAP.format(
+                first=first, first_order=first_order, group_limit=int(self.group_limit),
+                active=self._SQL_GROUP_ACTIVE_COUNTS.format(**fmt), **fmt)
+        else:
+            query = self._SQL_NEXT_GROUP.format(order_by=order_by, **fmt)
+        found = self.con.execute(query).fetchall()
+        if not found:
+            return []
+        (group,), = found
+        if self.group_limit:
+            ((active,),) = self.con.execute(self._SQL_GROUP_ACTIVE.format(**fmt), (group,)).fetchall()
+            n = max(0, min(n, int(self.group_limit) - active))
+        query = self._SQL_SELECT_GROUP.format(table_columns="," + ", ".join(self.columns),
+                                              limit=n, order_by=order_by, **fmt)
+        return self.con.execute(query, (group,)).fetchall()
+
+    def _group_first(self, table_name):
+        """ SQL for the first row of a group of `table_name` in claim
+        order, and the order of groups by it.
+        """
+        if self.priorities:
+            # The key is taken from the row of highest rank
+            return (f"MAX({table_name}._rank) AS first_rank, {table_name}.{self._KEY_COLUMN} AS first",
+                    "first_rank DESC, first")
+        return f"MIN({table_name}.{self._KEY_COLUMN}) AS first", "first"
 
     def select(self, n, offset=0, read_all=False):
+        qwhere = self._format_select(n, offset, read_all=read_all)
+        cursor = self.con.execute(qwhere)
+        rows = list(cursor.fetchall())
+        return rows
 
+    def _format_select(self, n, offset=0, read_all=False):
         qwhere = self._SQL_SELECT_ALL if read_all else self._SQL_SELECT
-        qwhere = qwhere.format(
+        if self.priorities and not read_all:
+            qwhere = self._SQL_SELECT_PRIORITY
+        return qwhere.format(
             table_name=self._TABLE_NAME,
             key_column=self._KEY_COLUMN,
             table_columns = "," + ", ".join(self.columns) if len(self.columns) > 0 else "",
             limit=n,
             offset=offset,
         )
-        cursor = self.con.execute(qwhere)
-        rows = list(cursor.fetchall())
-        return rows
+
+    def iter_batches(self, batch_size=1000, where=None, params=(), columns=None,
+                     return_keys=False, prefetch=False):
+        """ Yield every row as lists of at most `batch_size` items, in key
+        order, without claiming them. Pages continue from the last key
+        seen, so each page costs the same however deep the scan is and
+        memory stays constant.
+
+        `where` is an extra SQL condition with `params` bound to it, e.g.
+        `where="status = ?", params=(AckStatus.acked,)`. `columns` limits
+        the columns read. With `prefetch=True` the next page is read on a
+        background thread with its own connection while the caller works
+        on the current one; it only sees committed rows.
+        """
+        if prefetch:
+            # Buffered writes are invisible to the prefetch connection
+            self.flush()
+            return prefetched(self._pages(batch_size, where, params, columns, return_keys,
+                                          own_connection=True))
+        return self._pages(batch_size, where, params, columns, return_keys)
+
+    def iter_rows(self, batch_size=1000, **kwargs):
+        """ Yield rows one at a time; see `iter_batches`. """
+        for batch in self.iter_batches(batch_size, **kwargs):
+            yield from batch
+
+    def _pages(self, batch_size, where, params, columns, return_keys, own_connection=False):
+        selected = self.columns
+        if columns is not None and not self.payload:
+            selected = [c for c in self.columns
+                        if c in columns or (_array_column(c) or (None,))[0] in columns]
+        names = list(self._INTERNAL_COLUMNS) + selected
+        query = self._SQL_ITER.format(
+            table_name=self._TABLE_NAME,
+            key_column=self._KEY_COLUMN,
+            table_columns="".join("," + c for c in selected),
+            where=f"AND ({where})" if where else "",
+            limit=batch_size,
+        )
+        con = sqlite3.connect(self.path) if own_connection else None
+        try:
+            last_key = -1
+            while True:
+                if own_connection:
+                    rows = con.execute(query, (last_key, *params)).fetchall()
+                else:
+                    rows = self._read(query, (last_key, *params))
+                if not rows:
+                    return
+                last_key = rows[-1][0]
+                items = self._items_from_rows(names, rows)
+                if columns is not None and self.payload:
+                    items = [{k: v for (k, v) in item.items() if k in columns} for item in items]
+                if return_keys:
+                    yield [row[0] for row in rows], items
+                else:
+                    yield items
+        finally:
+            if con is not None:
+                con.close()
 
     def put(self, item):
         key, = self.puts([item])
         return key
 
-    def puts(self, items):
+    def puts(self, items, return_keys=True, priority=0):
+        """ Insert items and return their keys. With `return_keys=False`
+        rows are bulk inserted and only their number is returned.
+
+        On queues with `priorities=True`, `priority` is an integer for
+        every item or a list with one per item; higher is claimed first.
+        """
+        # Wait for room before locking, so that consumers can drain and
+        # no write-behind transaction is held open meanwhile
+        if items:
+            self.max_size_block()
+        with self._locked():
+            keys = self._puts(items, return_keys=return_keys, priority=priority)
+            self._commit(len(items))
+        return keys
+
+    def _puts(self, items, return_keys=True, priority=0):
+        """ Insert items without committing. """
         if len(items) == 0:
-            return []
+            return [] if return_keys else 0
         if not all(isinstance(i, dict) for i in items):
             raise ValueError("Items must be dicts")
         if not all(len(i) > 0 for i in items):
             raise ValueError("Dicts cannot be empty")
-        self.max_size_block()
-        items = self.flatten_array_columns(items)
-        self.update_table_schema(items[0])
-        items = self.reorder_to_match_table_schema(items)
-        cols_str = ", ".join(self.columns)
-        vals_str = ", ".join("?" for _ in self.columns)
+        added = []
+        if self._dedup is not None:
+            items, priority, added = self._drop_duplicates(items, priority)
+            if len(items) == 0:
+                return [] if return_keys else 0
+        if self.payload:
+            ret = self._puts_payload(items, return_keys, priority)
+        else:
+            self.update_table_schema(self.flatten_array_columns(items[:1])[0])
+            rows = self._row_codec(self.columns).encode(items, time.time())
+            if self.compressor is not None:
+                rows = self._compress_rows(["timestamp"] + self.columns, rows)
+            ret = self._insert(self.columns, rows, return_keys, priority)
+        for value in added:
+            self._dedup.add(value)
+        return ret
+
+    def _insert(self, columns, rows, return_keys=True, priority=0):
+        """ Insert encoded `rows` of timestamp followed by `columns`. """
+        if self.priorities:
+            columns = columns + list(self._PRIORITY_COLUMNS)
+            priorities = priority if isinstance(priority, (list, tuple)) else [priority] * len(rows)
+            if len(priorities) != len(rows):
+                raise ValueError("Need one priority per item")
+            aging = self.aging_interval
+            for row, p in zip(rows, priorities):
+                row.extend((p, p - row[0] / aging if aging else p))
+        query = self._SQL_INSERT if return_keys else self._SQL_INSERT_MANY
+        insert = query.format(table_name=self._TABLE_NAME,
+                              table_columns=", ".join(columns),
+                              table_values=", ".join("?" for _ in columns),
+                              key_column=self._KEY_COLUMN)
+        if not return_keys:
+            n = self.con.executemany(insert, rows).rowcount
+            self._m_puts.inc(n)
+            return n
         keys = []
-        for item in items:
-            insert = self._SQL_INSERT.format(table_name=self._TABLE_NAME,
-                                             table_columns=cols_str,
-                                             table_values=vals_str,
-                                             key_column=self._KEY_COLUMN)
-            cursor = self.con.execute(insert, item)
+        for row in rows:
+            cursor = self.con.execute(insert, row)
             ret = cursor.fetchone()
             if ret is not None:
                 key, = ret
                 keys.append(key)
-        self.con.commit()
+        self._m_puts.inc(len(keys))
         return keys
 
+    def _puts_payload(self, items, return_keys=True, priority=0):
+        for column in self.promoted_columns:
+            if column not in self.columns:
+                # Typed from the first value seen, like regular columns
+                value = next((i[column] for i in items if i.get(column) is not None), None)
+                if value is not None:
+                    self.create_column(column, value)
+                    self.create_index(column)
+        promoted = [c for c in self.promoted_columns if c in self.columns]
+        dumps = self.codec.dumps
+        if self.compressor is not None:
+            codec_dumps, compress = dumps, self.compressor.compress
+
+            def dumps(item):
+                return compress(codec_dumps(item))
+        now = time.time()
+        rows = [[now] + [item.get(c) for c in promoted] + [dumps(item)] for item in items]
+        return self._insert(promoted + [self._PAYLOAD_COLUMN], rows, return_keys, priority)
+
     def flatten_array_columns(self, items):
         new_items = []
         for item in items:
@@ -247,9 +1281,9 @@ class SQLiteAckQueue:
             new_item = {}
             arrays = {}
             for key, value in item.items():
-                if '_dim_' in key:
-                    column_name = key.split('_')[0]
-                    column_idim = int(key.split('_')[2])
+                array = _array_column(key)
+                if array is not None:
+                    column_name, column_idim = array
                     arr = arrays.get(column_name, DynamicList())
                     arr[column_idim] = value
                     arrays[column_name] = arr
@@ -275,29 +1309,33 @@ class SQLiteAckQueue:
             v_type = "REAL"
         elif isinstance(value, int):
             v_type = "INTEGER"
+        elif isinstance(value, bytes):
+            v_type = "BLOB"
         elif isinstance(value, dict):
             raise ValueError("Cannot have nested dictionaries")
         else:
             v_type = "TEXT"
         query = self._SQL_CREATE_COLUMN.format(table_name=self._TABLE_NAME, column_name=name, column_type=v_type) 
+        self.con.execute(self._SQL_CREATE_CATALOG)
         self.con.execute(query)
         self.columns.append(name)
+        self._codecs.clear()
+        self._save_schema(self.columns)
+        if name == self.group_column:
+            self._init_group_index()
 
-    def reorder_to_match_table_schema(self, rows):
-        new_rows = []
-        for i, row in enumerate(rows):
-            new_row = [time.time()]
-            for column in self.columns:
-                new_row.append(row.pop(column, None))
-            assert len(row) == 0, f"Extra columns not present in table found in {i}th row"
-            new_rows.append(new_row)
-        return new_rows
+    def create_index(self, name):
+        query = self._SQL_CREATE_INDEX.format(table_name=self._TABLE_NAME, column_name=name)
+        self.con.execute(query)
 
     def read_columns(self):
-        cursor = self.con.execute(self._SQL_READ_COLUMNS.format(table_name=self._TABLE_NAME))
+        return self._read_columns(self.con)
+
+    def _read_columns(self, con):
+        cursor = con.execute(self._SQL_READ_COLUMNS.format(table_name=self._TABLE_NAME))
         rows = cursor.fetchall()
         column_names = [row[1] for row in rows]
-        column_names = [n for n in column_names if n not in ("_id", "timestamp", "status")]
+        column_names = [n for n in column_names if n not in self._HIDDEN_COLUMNS]
         return column_names
 
     def max_size_block(self):
@@ -315,6 +1353,11 @@ class SQLiteAckQueue:
                 logger.info(f"Finished waiting after {i} sec")
 
     def updates(self, keys, status=AckStatus.unack):
+        with self._locked():
+            self._updates(keys, status)
+            self._commit(len(keys))
+
+    def _updates(self, keys, status=AckStatus.unack):
         indices = ",".join((str(r) for r in keys))
         qupdat = self._SQL_MARK_ACK_UPDATE.format(
             table_name=self._TABLE_NAME,
@@ -326,12 +1369,65 @@ class SQLiteAckQueue:
         rows = cursor.fetchall()
         if len(rows) != len(keys):
             raise KeyError("Could not update all keys")
-        self.con.commit()
+
+    def set_priority(self, keys, priority):
+        """ Change the priority of rows `keys`, e.g. to expedite items
+        that are already queued. Their age is kept.
+        """
+        with self._locked():
+            self._set_priority(keys, priority)
+            self._commit(len(keys))
+
+    def _set_priority(self, keys, priority):
+        if not self.priorities:
+            raise ValueError("Queue was not created with priorities=True")
+        qset = self._SQL_SET_PRIORITY.format(table_name=self._TABLE_NAME,
+                                             key_column=self._KEY_COLUMN,
+                                             rank=self._rank_sql("?"),
+                                             indices=",".join(str(k) for k in keys))
+        self.con.execute(qset, (priority, priority))
+
+    def _heartbeat(self, key):
+        """ Refresh the timestamp of row `key` without committing. """
+        self.con.execute(self._SQL_HEARTBEAT.format(table_name=self._TABLE_NAME,
+                                                    key_column=self._KEY_COLUMN),
+                         (time.time(), key))
+
+    def statuses(self, keys):
+        """ Return a dict mapping each existing key to its status.
+        """
+        if len(keys) == 0:
+            return {}
+        indices = ",".join((str(r) for r in keys))
+        qstat = self._SQL_STATUSES.format(
+            table_name=self._TABLE_NAME,
+            key_column=self._KEY_COLUMN,
+            indices=indices,
+        )
+        return {key: str(status) for (key, status) in self._read(qstat)}
+
+    def active_keys(self, n):
+        """ Keys of up to `n` rows that are waiting or checked out but
+        not yet finished, newest first.
+        """
+        qkeys = self._SQL_ACTIVE_KEYS.format(
+            table_name=self._TABLE_NAME,
+            key_column=self._KEY_COLUMN,
+            limit=n,
+        )
+        return [key for (key,) in self._read(qkeys)]
 
     def set(self, row_key_dict, **field_dict):
         return self.sets([row_key_dict], [field_dict])
  
     def sets(self, row_key_dicts, field_dicts):
+        with self._locked():
+            self._sets(row_key_dicts, field_dicts)
+            self._commit(len(row_key_dicts))
+
+    def _sets(self, row_key_dicts, field_dicts):
+        if self.payload:
+            return self._sets_payload(row_key_dicts, field_dicts)
         for row_key_dict, field_dict in zip(row_key_dicts, field_dicts):
             (row_id_col, row_id_val), = list(row_key_dict.items())
             for column_name, column_value in field_dict.items():
@@ -346,7 +1442,39 @@ class SQLiteAckQueue:
                 rows = cursor.fetchall()
                 assert len(rows) == 1, f"Did not find row for {row_id_col}={row_id_val}"
 
+    def _sets_payload(self, row_key_dicts, field_dicts):
+        """ Merge fields into the stored payloads, keeping promoted
+        columns in step.
+        """
+        for row_key_dict, field_dict in zip(row_key_dicts, field_dicts):
+            (row_id_col, row_id_val), = list(row_key_dict.items())
+            qry = self._SQL_SELECT_PAYLOAD.format(table_name=self._TABLE_NAME,
+                                                  key_column=self._KEY_COLUMN,
+                                                  payload_column=self._PAYLOAD_COLUMN,
+                                                  row_id_col=row_id_col)
+            rows = self.con.execute(qry, (row_id_val,)).fetchall()
+            assert len(rows) == 1, f"Did not find row for {row_id_col}={row_id_val}"
+            (key, data), = rows
+            if self.compressor is not None:
+                data = self.compressor.decompress(data)
+            item = self.codec.loads(data)
+            item.update(field_dict)
+            columns = [c for c in field_dict if c in self.promoted_columns and c in self.columns]
+            assignments = ", ".join(f"{c} = ?" for c in columns + [self._PAYLOAD_COLUMN])
+            qry = self._SQL_UPDATE_PAYLOAD.format(table_name=self._TABLE_NAME,
+                                                  key_column=self._KEY_COLUMN,
+                                                  assignments=assignments)
+            data = self.codec.dumps(item)
+            if self.compressor is not None:
+                data = self.compressor.compress(data)
+            self.con.execute(qry, [item[c] for c in columns] + [data, key])
+
     def delete(self, keys):
+        with self._locked():
+            self._delete(keys)
+            self._commit(len(keys))
+
+    def _delete(self, keys):
         indices = ",".join((str(r) for r in keys))
         qdel = self._SQL_DELETE.format(
             table_name=self._TABLE_NAME,
@@ -354,68 +1482,137 @@ class SQLiteAckQueue:
             indices=indices,
         )
         self.con.execute(qdel)
-        self.con.commit()
 
     def acks(self, keys, status=AckStatus.acked):
-        self.updates(keys, status)
+        with self._locked():
+            self._acks(keys, status)
+            self._commit(len(keys))
+
+    def _acks(self, keys, status=AckStatus.acked):
+        self._updates(keys, status)
+        self._m_acks.inc(len(keys))
         if self.delete_on_ack:
-            self.delete(keys)
+            self._delete(keys)
+
+    def _commit(self, n_rows=1):
+        """ Commit now, or hand the rows to the write-behind buffer. """
+        if self._committer is not None:
+            self._committer.add(n_rows)
+        else:
+            t0 = time.perf_counter()
+            self.con.commit()
+            self._m_commit_seconds.observe(time.perf_counter() - t0)
+
+    def flush(self):
+        """ Commit any writes buffered by write-behind mode. """
+        if self._committer is not None:
+            self._committer.flush()
+        else:
+            self.con.commit()
+
+    def close(self):
+        """ Flush buffered writes and stop the write-behind flusher. """
+        self.unregister_consumer()
+        if self._reader is not None:
+            with self._reader_lock:
+                self._reader.close()
+                self._reader = None
+        if self._dedup is not None and self.dedup_path:
+            self.save_dedup()
+            atexit.unregister(self._save_at_exit)
+        if self._committer is not None:
+            self._committer.close()
+        else:
+            self.con.commit()
 
     def apply_timeout(self):
         # Chane unack to ready
         # Don't apply time out if connection isnt open yet
-        if self._con is None:
+        if self._con is None or not self._created:
             return
         # Make sure we do not apply the timeout logic too frequently
         dt = time.time() - self.last_timeout_application
         if dt < self.timeout:
             return
-        logger.debug(f"Applying timeout on old unack messages on {self.path}")
-        logger.debug(f"Last applied timeout {dt:1.1f} sec ago")
-        time_cutoff = time.time() - self.timeout
-        qtimeout = self._SQL_TIMEOUT.format(
-            table_name=self._TABLE_NAME, timeout=time_cutoff
-        )
-        self._con.execute(qtimeout)
-        self._con.commit()
-        self.last_timeout_application = time.time()
+        # Other threads, such as a queue server's writer, may be in the
+        # middle of a transaction on a shared connection
+        with self._locked():
+            if time.time() - self.last_timeout_application < self.timeout:
+                return
+            logger.debug(f"Applying timeout on old unack messages on {self.path}")
+            logger.debug(f"Last applied timeout {dt:1.1f} sec ago")
+            time_cutoff = time.time() - self.timeout
+            qtimeout = self._SQL_TIMEOUT.format(
+                table_name=self._TABLE_NAME, timeout=time_cutoff
+            )
+            # An open transaction (a write-behind batch or a caller's
+            # uncommitted writes) takes the update along with it; never
+            # commit on its behalf
+            in_transaction = self._con.in_transaction
+            cursor = self._con.execute(qtimeout)
+            self._m_recycled.inc(cursor.rowcount)
+            if not in_transaction:
+                self._con.commit()
+            self.last_timeout_application = time.time()
         logger.debug(f"Finished recycling messages at {self.last_timeout_application}")
 
     def free(self):
-        cursor = self.con.execute(self._SQL_FREE.format(table_name=self._TABLE_NAME))
-        (n,) = cursor.fetchone()
-        self.con.commit()
+        ((n,),) = self._read(self._SQL_FREE.format(table_name=self._TABLE_NAME))
         return n
 
     def done(self):
-        cursor = self.con.execute(self._SQL_DONE.format(table_name=self._TABLE_NAME))
-        (n,) = cursor.fetchone()
-        self.con.commit()
+        ((n,),) = self._read(self._SQL_DONE.format(table_name=self._TABLE_NAME))
         return n
 
     def active(self):
-        cursor = self.con.execute(self._SQL_ACTIVE.format(table_name=self._TABLE_NAME))
-        (n,) = cursor.fetchone()
-        self.con.commit()
+        ((n,),) = self._read(self._SQL_ACTIVE.format(table_name=self._TABLE_NAME))
         return n
 
-    @cachetools.func.ttl_cache(maxsize=1, ttl=10)
-    def approx_count(self):
-        return self._count()
+    def approx_count(self, ttl=10):
+        """ The row count, cached for `ttl` seconds. """
+        now = time.time()
+        if self._approx_count is None or now - self._approx_count[0] > ttl:
+            self._approx_count = (now, self._count())
+        return self._approx_count[1]
 
     def _count(self):
-        cursor = self.con.execute(self._SQL_COUNT.format(table_name=self._TABLE_NAME))
-        (n,) = cursor.fetchone()
+        ((n,),) = self._read(self._SQL_COUNT.format(table_name=self._TABLE_NAME))
         return n
     
     def count(self):
         return self._count()
 
-    def clear_acked_data(self):
-        pass
+    def clear_acked_data(self, older_than=0):
+        """ Delete finished rows written more than `older_than` seconds
+        ago. Returns the number of rows deleted.
+        """
+        with self._locked():
+            query = self._SQL_CLEAR_ACKED.format(table_name=self._TABLE_NAME,
+                                                 statuses=",".join(FINISHED_STATUSES))
+            cursor = self.con.execute(query, (time.time() - older_than,))
+            self._commit(cursor.rowcount)
+        return cursor.rowcount
+
+    def load_file(self, path, format=None, batch_size=65536):
+        """ Bulk insert the rows of a Parquet, Arrow IPC or NDJSON file;
+        see `bulk.load_file`.
+        """
+        from bulk import load_file
+        return load_file(self, path, format=format, batch_size=batch_size)
+
+    def dump(self, path, status=None, format=None, batch_size=65536):
+        """ Write rows, optionally only those with `status`, to a
+        Parquet, Arrow IPC or NDJSON file; see `bulk.dump`.
+        """
+        from bulk import dump
+        return dump(self, path, status=status, format=format, batch_size=batch_size)
 
     def shrink_disk_usage(self):
-        pass
+        """ Give free pages back to the file system. """
+        from admin import shrink
+        with self._locked():
+            self.flush()
+            shrink(self.con)
 
 
 def test():
@@ -512,9 +1709,396 @@ def test_vec():
     q.puts([{'vec': [1, 2, 3]}])
     row, = q.gets(1)
     assert sum(row['vec']) == 6
+
+    # Names with underscores and shorter vectors round trip
+    q.puts([{'my_vec': [1.5, 2.5], 'id': "a"}])
+    q.puts([{'my_vec': [3.5], 'id': "b"}])
+    rows = q.gets(2)
+    assert [r['my_vec'] for r in rows] == [[1.5, 2.5], [3.5]]
+    assert rows[0]['vec'] == []
+    assert q.unflatten_array_columns(q.flatten_array_columns([{'my_vec': [1, 2]}])) == \
+        [{'my_vec': [1, 2]}]
+
+    # New keys still need the schema of the first item
+    try:
+        q.puts([{'id': "c"}, {'id': "d", 'unknown': 1}])
+        raise RuntimeError("Expected to raise AssertionError")
+    except AssertionError:
+        pass
+    os.remove('temp.db')
+
+
+def test_write_behind(n_threads=8, n=250):
+    if os.path.exists("temp.db"):
+        os.remove("temp.db")
+
+    # A long interval so that nothing is flushed before the checks below
+    q = SQLiteAckQueue("temp.db", unique_column="id", write_behind=True,
+                       flush_size=10 ** 6, flush_interval=60)
+
+    def put_many(i_thread):
+        for i in range(n):
+            q.put({'id': f"{i_thread}-{i}"})
+
+    threads = [threading.Thread(target=put_many, args=(i,)) for i in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # Writes are visible on the writing connection right away but
+    # are not yet committed for other readers
+    assert q.count() == n_threads * n
+    other = sqlite3.connect("temp.db")
+    (count,) = other.execute("SELECT COUNT(*) FROM ack_unique_queue_default").fetchone()
+    assert count < n_threads * n
+    q.flush()
+    (count,) = other.execute("SELECT COUNT(*) FROM ack_unique_queue_default").fetchone()
+    assert count == n_threads * n
+
+    # Acks are buffered too until an explicit flush
+    keys, items = q.gets(10, return_keys=True)
+    q.acks(keys)
+    q.flush()
+    (done,) = other.execute("SELECT COUNT(*) FROM ack_unique_queue_default "
+                            "WHERE status = %s" % AckStatus.acked).fetchone()
+    assert done == 10
+
+    # Timeouts still apply while a batch is open and commit with it
+    q.gets(5)
+    q.put({'id': "late"})
+    assert q.con.in_transaction
+    q.timeout, q.last_timeout_application = 0, 0
+    assert q.free() == n_threads * n - 10 + 1
+    q.flush()
+    (free,) = other.execute("SELECT COUNT(*) FROM ack_unique_queue_default "
+                            "WHERE status < %s" % AckStatus.unack).fetchone()
+    assert free == n_threads * n - 10 + 1
+    q.close()
+    other.close()
+    os.remove('temp.db')
+
+
+def test_payload():
+    if os.path.exists("temp.db"):
+        os.remove("temp.db")
+
+    q = SQLiteAckQueue("temp.db", unique_column="id", payload=True,
+                       serializer="pickle", promoted_columns=["shard"])
+    # Irregular and nested items go in without any schema change
+    q.puts([{'id': 0, 'shard': "a", 'nested': {'x': [1, 2]}}])
+    q.puts([{'id': 1, 'shard': "b", 'wide': list(range(100)), 'blob': b"\x00"}])
+    q.puts([{'id': 1, 'other': 1}])
+    assert q.count() == 2
+    assert sorted(q.read_columns()) == ["_payload", "id", "shard"]
+    indices = [row[1] for row in q.con.execute("PRAGMA index_list(ack_unique_queue_default)")]
+    assert "ack_unique_queue_default_shard" in indices
+
+    # Fields can be updated through promoted columns
+    q.sets([{'id': 1}], [{'shard': "c", 'score': 0.5}])
+    (n,) = q.con.execute("SELECT COUNT(*) FROM ack_unique_queue_default "
+                         "WHERE shard = 'c'").fetchone()
+    assert n == 1
+
+    keys, items = q.gets(5, return_keys=True)
+    assert items[0] == {'id': 0, 'shard': "a", 'nested': {'x': [1, 2]}}
+    assert items[1]['wide'] == list(range(100)) and items[1]['score'] == 0.5
+    q.acks(keys)
+    assert q.done() == 2
+
+    # Reopening the table keeps payload mode working
+    q = SQLiteAckQueue("temp.db", unique_column="id", payload=True, serializer="pickle")
+    assert len(q.gets(5, read_all=True)) == 2
+    os.remove('temp.db')
+
+
+def test_compress():
+    from compression import is_compressed
+    if os.path.exists("temp.db"):
+        os.remove("temp.db")
+
+    html = "<html>" + "<p>page</p>" * 500 + "</html>"
+    q = SQLiteAckQueue("temp.db", unique_column="id", compress=True,
+                       compress_columns=["html"])
+    q.puts([{'id': 0, 'html': html, 'title': "x" * 1000}, {'id': 1, 'html': "<p/>"}])
+    stored = q.con.execute("SELECT html, title FROM ack_unique_queue_default "
+                           "ORDER BY _id").fetchall()
+    # Only large values of the chosen columns are compressed
+    assert is_compressed(stored[0][0]) and not is_compressed(stored[1][0])
+    assert stored[0][1] == "x" * 1000
+    items = q.gets(2)
+    assert items[0]['html'] == html and items[1]['html'] == "<p/>"
+
+    # In payload mode the whole serialized item is compressed
+    p = SQLiteAckQueue("temp.db", table_name="payloadq", payload=True, compress=True)
+    p.puts([{'idx': 0, 'html': html}])
+    (data,) = p.con.execute("SELECT _payload FROM payloadq").fetchone()
+    assert is_compressed(data) and len(data) < len(html) // 10
+    assert p.gets(1) == [{'idx': 0, 'html': html}]
+
+    # Raw bytes starting like a compressed cell read back unchanged
+    from compression import MAGIC
+    r = SQLiteAckQueue("temp.db", table_name="rawq", compress=True)
+    raws = [MAGIC + bytes(range(40)), MAGIC + bytes(range(256)) * 4]
+    r.puts([{'raw': raw} for raw in raws])
+    assert [row['raw'] for row in r.iter_rows()] == raws
+    os.remove('temp.db')
+
+
+def test_iter(n=2500):
+    if os.path.exists("temp.db"):
+        os.remove("temp.db")
+
+    q = SQLiteAckQueue("temp.db", unique_column="id")
+    q.puts([{'id': i, 'vec': [i, i + 1], 'name': f"n{i}"} for i in range(n)])
+    keys, _ = q.gets(100, return_keys=True)
+    q.acks(keys)
+
+    # Pages never overlap and nothing is claimed
+    batches = list(q.iter_batches(1000))
+    assert [len(b) for b in batches] == [1000, 1000, 500]
+    assert [r['id'] for b in batches for r in b] == [str(i) for i in range(n)]
+    assert q.free() == n - 100
+
+    done = list(q.iter_rows(30, where="status = ?", params=(AckStatus.acked,),
+                            columns=["vec"]))
+    assert len(done) == 100 and done[5] == {'vec': [5, 6]}
+
+    # Prefetching yields the same pages and stops cleanly when abandoned
+    assert list(q.iter_batches(1000, prefetch=True)) == batches
+    for keys, batch in q.iter_batches(10, prefetch=True, return_keys=True):
+        assert keys[0] == 1
+        break
+    os.remove('temp.db')
+
+
+def test_consumers(n=200):
+    if os.path.exists("temp.db"):
+        os.remove("temp.db")
+
+    q = SQLiteAckQueue("temp.db", unique_column="id")
+    q.puts([{'id': i} for i in range(n)])
+    a = SQLiteAckQueue("temp.db", unique_column="id")
+    b = SQLiteAckQueue("temp.db", unique_column="id")
+    a.register_consumer("a")
+    b.register_consumer("b")
+    a._partition_refreshed = 0
+
+    # Each consumer starts in its own half of the key space
+    keys_a, _ = a.gets(10, return_keys=True)
+    keys_b, _ = b.gets(10, return_keys=True)
+    assert max(keys_a) <= n // 2 < min(keys_b)
+
+    # Draining from both claims every row exactly once, stealing at the end
+    claimed = keys_a + keys_b
+    for _ in range(n):
+        keys, _ = a.gets(7, return_keys=True)
+        claimed += keys
+        keys, _ = b.gets(13, return_keys=True)
+        claimed += keys
+    assert sorted(claimed) == list(range(1, n + 1))
+    assert a.free() == 0
+
+    # A row claimed by one consumer is never handed to another
+    q.puts([{'id': "x"}])
+    rows = a._select_partitioned(5)
+    assert b.gets(5) == [{'id': "x"}]
+    assert a._claim([row[0] for row in rows]) == set()
+    a.con.commit()
+
+    # Consumers leave the partitioning when they close
+    b.close()
+    a._partition_refreshed = 0
+    a._refresh_partition()
+    a.con.commit()
+    assert a.n_consumers == 1
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        q.gets(1, random_offset=True)
+    assert caught[0].category is DeprecationWarning
+    assert q.consumer_id is not None
+    os.remove('temp.db')
+
+
+def test_priorities():
+    from profiling import explain
+    if os.path.exists("temp.db"):
+        os.remove("temp.db")
+
+    q = SQLiteAckQueue("temp.db", unique_column="id", priorities=True)
+    q.puts([{'id': i} for i in range(500)])
+    q.puts([{'id': "urgent"}], priority=10)
+    q.puts([{'id': "a"}, {'id': "b"}], priority=[1, 5])
+    assert [i['id'] for i in q.gets(4)] == ["urgent", "b", "a", "0"]
+    plan = " ".join(explain(q.con, q._format_select(4)))
+    assert "ack_unique_queue_default_rank" in plan and "TEMP B-TREE" not in plan
+
+    # Queued rows can be expedited
+    (key,) = q.con.execute("SELECT _id FROM ack_unique_queue_default WHERE id = '400'").fetchone()
+    q.set_priority([key], 3)
+    assert q.gets(1) == [{'id': "400"}]
+
+    # With aging, waiting long enough beats a higher priority
+    q = SQLiteAckQueue("temp.db", table_name="agedq", priorities=True, aging_interval=0.05)
+    q.puts([{'idx': "old"}], priority=0)
+    time.sleep(0.2)
+    q.puts([{'idx': "new"}], priority=2)
+    assert q.gets(1) == [{'idx': "old"}]
+    os.remove('temp.db')
+
+
+def test_dedup():
+    from metrics import Registry
+    from metrics import exposition
+    for fn in ("temp.db", "temp.db.ack_unique_queue_default.bloom"):
+        if os.path.exists(fn):
+            os.remove(fn)
+
+    registry = Registry()
+    q = SQLiteAckQueue("temp.db", unique_column="url", dedup=dict(capacity=1000),
+                       registry=registry, priorities=True)
+    urls = [{'url': f"https://a.com/{i}"} for i in range(20)]
+    assert len(q.puts(urls)) == 20
+    # Filter hits are checked exactly, and duplicates never reach INSERT
+    assert q.puts(urls + [{'url': "https://b.com"}] * 2, priority=list(range(22))) == [21]
+    assert q.count() == 21
+    assert 'io_queue_dedup_dropped_total{table="ack_unique_queue_default"} 21' in \
+        exposition(registry)
+
+    # Deleted rows can be inserted again
+    keys, _ = q.gets(1, return_keys=True)
+    q.delete(keys)
+    assert q.puts([{'url': "https://b.com"}]) == [22]
+    # So can rows deleted by another connection
+    con = sqlite3.connect("temp.db")
+    con.execute("DELETE FROM ack_unique_queue_default WHERE url = 'https://b.com'")
+    con.commit()
+    assert q.puts([{'url': "https://b.com"}]) == [23]
+
+    # The filter is saved and topped up with rows added while it was closed
+    q.close()
+    SQLiteAckQueue("temp.db", unique_column="url").puts([{'url': "https://c.com"}])
+    q = SQLiteAckQueue("temp.db", unique_column="url", dedup=dict(capacity=1000))
+    assert "https://a.com/3" in q._dedup.bloom and "https://c.com" in q._dedup.bloom
+    assert q.puts([{'url': "https://c.com"}, {'url': "https://a.com/3"}]) == []
+    q.close()
+    os.remove("temp.db")
+    os.remove("temp.db.ack_unique_queue_default.bloom")
+
+
+def test_reader():
+    for fn in ("temp.db", "temp.db-wal", "temp.db-shm"):
+        if os.path.exists(fn):
+            os.remove(fn)
+
+    q = SQLiteAckQueue("temp.db", unique_column="id", wal=True, mmap_size=2 ** 20)
+    q.puts([{'id': i} for i in range(10)])
+    assert q.count() == 10 and q.free() == 10
+    # Stats ran on the read-only connection
+    assert q._reader is not None
+    try:
+        q.reader.execute("DELETE FROM ack_unique_queue_default")
+        raise RuntimeError("Expected to raise OperationalError")
+    except sqlite3.OperationalError:
+        pass
+
+    # A pinned snapshot does not see later writes, which are not blocked
+    with q.read_snapshot():
+        q.puts([{'id': 10}])
+        keys, _ = q.gets(3, return_keys=True)
+        assert q.count() == 10 and q.free() == 10 and q.active() == 0
+        assert len(list(q.iter_rows())) == 10
+    assert q.count() == 11 and q.free() == 8 and q.statuses(keys[:1]) == {keys[0]: AckStatus.unack}
+
+    # Uncommitted writes of the queue itself are read on the writer
+    q.con.execute("DELETE FROM ack_unique_queue_default")
+    assert q.count() == 0
+    q.con.rollback()
+    assert q.count() == 11
+    q.close()
+    for fn in ("temp.db", "temp.db-wal", "temp.db-shm"):
+        if os.path.exists(fn):
+            os.remove(fn)
+
+
+def test_schema_catalog():
+    if os.path.exists("temp.db"):
+        os.remove("temp.db")
+
+    def tables():
+        return {n for (n,) in sqlite3.connect("temp.db").execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+    # Nothing is created until the queue is first used
+    q = SQLiteAckQueue("temp.db", table_name="lazy", unique_column="id")
+    assert "lazy" not in tables()
+    assert q.count() == 0 and "lazy" in tables()
+    q.puts([{'id': "a", 'x': 1.5}])
+
+    # Reopening takes the columns from the catalog
+    _SCHEMAS.clear()
+    q2 = SQLiteAckQueue("temp.db", table_name="lazy", unique_column="id")
+    assert q2.columns == ["id", "x"]
+    (version,), = q2.con.execute(q2._SQL_SCHEMA_VERSION).fetchall()
+    assert q2.con.execute(q2._SQL_CATALOG_SELECT, ("lazy",)).fetchone() == ('["id", "x"]', version)
+
+    # A column added behind its back changes the schema version, so the
+    # entry is not trusted and the table is read again
+    con = sqlite3.connect("temp.db")
+    con.execute("ALTER TABLE lazy ADD COLUMN y TEXT")
+    con.commit()
+    assert SQLiteAckQueue("temp.db", table_name="lazy", unique_column="id").columns == ["id", "x", "y"]
+
+    # A queue whose table was created by another object meanwhile
+    # records the columns that table has, not its own empty list
+    a = SQLiteAckQueue("temp.db", table_name="late")
+    SQLiteAckQueue("temp.db", table_name="late").puts([{'x': 1}])
+    assert a.free() == 1 and a.columns == ["x"]
+    _SCHEMAS.clear()
+    assert SQLiteAckQueue("temp.db", table_name="late").gets(1) == [{'x': 1}]
+    os.remove("temp.db")
+
+
+def test_groups():
+    from profiling import explain
+    if os.path.exists("temp.db"):
+        os.remove("temp.db")
+
+    q = SQLiteAckQueue("temp.db", table_name="urls", group_column="host", group_limit=3)
+    q.puts([{'url': f"{host}/{i}", 'host': host} for host in "abc" for i in range(5)])
+    # A batch holds one host, the first waiting one under its cap
+    assert {item['host'] for item in q.gets(10)} == {"a"}
+    batch = q.gets(2)
+    assert [item['host'] for item in batch] == ["b", "b"]
+    assert [item['host'] for item in q.gets(2)] == ["b"]
+    assert [item['host'] for item in q.gets(10)] == ["c", "c", "c"]
+    assert q.gets(10) == []
+    plan = " ".join(explain(q.con, q._SQL_SELECT_GROUP.format(
+        table_name="urls", key_column="_id", group_column="host", table_columns="",
+        order_by="_id", limit=10).replace("?", "'a'")))
+    assert "urls_group" in plan
+    # The next group comes from one pass over each group index
+    fmt = dict(table_name="urls", key_column="_id", group_column="host")
+    first, first_order = q._group_first("urls")
+    plan = explain(q.con, q._SQL_NEXT_GROUP_UNDER_CAP.format(
+        first=first, first_order=first_order, group_limit=3,
+        active=q._SQL_GROUP_ACTIVE_COUNTS.format(**fmt), **fmt))
+    assert "SCAN urls USING INDEX urls_group" in plan
+    assert "SCAN urls USING INDEX urls_group_active" in plan
     os.remove('temp.db')
 
 
 if __name__ == "__main__":
     test_vec()
     test()
+    test_write_behind()
+    test_payload()
+    test_compress()
+    test_iter()
+    test_consumers()
+    test_priorities()
+    test_dedup()
+    test_reader()
+    test_schema_catalog()
+    test_groups()
@@ -1,4 +1,9 @@
 """Test cases for the __main__ module."""
+import json
+import sqlite3
+import time
+from pathlib import Path
+
 import pytest
 from click.testing import CliRunner
 
@@ -15,3 +20,58 @@ def test_main_succeeds(runner: CliRunner) -> None:
     """It exits with a status code of zero."""
     result = runner.invoke(__main__.main)
     assert result.exit_code == 0
+
+
+@pytest.fixture
+def queue_file(tmp_path: Path) -> str:
+    """A queue file with ready, claimed, acked and failed rows."""
+    path = str(tmp_path / "queue.db")
+    con = sqlite3.connect(path)
+    con.execute(
+        "CREATE TABLE inq (_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "timestamp FLOAT, status INTEGER, idx INTEGER)"
+    )
+    statuses = [0] * 6 + [2] * 2 + [5] * 3 + [9]
+    con.executemany(
+        "INSERT INTO inq (timestamp, status, idx) VALUES (?, ?, ?)",
+        [(time.time() - 60, status, i) for (i, status) in enumerate(statuses)],
+    )
+    con.commit()
+    con.close()
+    return path
+
+
+def test_stats(runner: CliRunner, queue_file: str) -> None:
+    """It reports counts per status."""
+    result = runner.invoke(__main__.main, ["stats", "--json", queue_file])
+    assert result.exit_code == 0
+    info = json.loads(result.output)
+    assert info["tables"]["inq"]["by_status"] == {
+        "inited": 6,
+        "unack": 2,
+        "acked": 3,
+        "ack_failed": 1,
+    }
+
+
+def test_top(runner: CliRunner, queue_file: str) -> None:
+    """It prints the backlog per table."""
+    result = runner.invoke(
+        __main__.main, ["top", "--iterations", "1", "--interval", "0", queue_file]
+    )
+    assert result.exit_code == 0
+    assert "inq" in result.output
+
+
+def test_requeue(runner: CliRunner, queue_file: str) -> None:
+    """It moves unack and failed rows back to ready."""
+    result = runner.invoke(__main__.main, ["requeue", queue_file])
+    assert result.exit_code == 0
+    assert "inq: requeued 3 rows" in result.output
+
+
+def test_compact(runner: CliRunner, queue_file: str) -> None:
+    """It deletes finished rows."""
+    result = runner.invoke(__main__.main, ["compact", "--older-than", "1", queue_file])
+    assert result.exit_code == 0
+    assert "inq: deleted 3 rows" in result.output